@@ -0,0 +1,89 @@
+import os
+import time
+import argparse
+import numpy as np
+import cv2
+import pandas as pd
+from helpers.frame_source import read_frames
+from helpers.detector import backends, load_model, detect, iterate_batches
+from helpers.atomic_write import atomic_write
+
+# Check for argv
+parser = argparse.ArgumentParser(description='Compare model backends and batch sizes on one video')
+parser.add_argument('user_id')
+parser.add_argument('scenario_id')
+parser.add_argument('--start', type=int, default=0, help='first frame of the measured range')
+parser.add_argument('--frames', type=int, default=256, help='number of measured frames')
+parser.add_argument('--batch-sizes', type=int, nargs='+', default=[4, 8, 16, 32])
+parser.add_argument('--image-size', type=int, default=None, help='image size of the hub and local backends')
+parser.add_argument('--backends', choices=backends, nargs='+', default=['hub'], help='the first one is the reference for the others')
+args = parser.parse_args()
+
+mp4_file = os.path.join('../simulator_data/videos', f'user_{args.user_id}_s{args.scenario_id}.mp4')
+
+# Decode the frames up front, so only the inference is measured
+cap = cv2.VideoCapture(mp4_file)
+frames = [frame for _, frame in read_frames(cap, range(args.start, args.start + args.frames))]
+cap.release()
+
+# Same number of labels with the same classes, boxes and confidences only differ by rounding
+def same_detections(detections, reference, atol=1e-4):
+    return all(
+        np.array_equal(labels, ref_labels) and np.allclose(cord_thres, ref_cord_thres, atol=atol)
+        for (labels, cord_thres), (ref_labels, ref_cord_thres) in zip(detections, reference)
+    )
+
+# One row per backend and batch size, written next to the other results so the measurements are kept
+results = []
+reference = None
+for backend in args.backends:
+    # @ STARTUP @ #
+    # Loading and warming up the model
+    start = time.perf_counter()
+    try:
+        model = load_model(backend, args.image_size if backend in ('hub', 'local') else None)
+    except Exception as e:
+        print(f'{backend}: could not be loaded, {e!r}')
+        continue
+    startup = time.perf_counter() - start
+    print(f'{backend}: startup {startup:.2f}s')
+
+    # @ SINGLE FRAME @ #
+    # The way video_analysis.py used to call the model
+    start = time.perf_counter()
+    single_detections = []
+    for frame in frames:
+        single_detections += detect(model, [frame])
+    single_fps = len(frames) / (time.perf_counter() - start)
+    print(f'  batch size  1: {1000 / single_fps:8.2f} ms/frame, {single_fps:8.2f} fps')
+    results.append({'BACKEND': backend, 'BATCH_SIZE': 1, 'MS_PER_FRAME': 1000 / single_fps, 'FPS': single_fps, 'SPEEDUP': 1.0, 'SAME_DETECTIONS': True, 'STARTUP': startup})
+
+    # Detections of the other backends are compared with the first one, a looser tolerance
+    # allows for the different runtimes
+    if reference is None:
+        reference = single_detections
+    else:
+        print(f'  same detections as {args.backends[0]}: {same_detections(single_detections, reference, atol=1e-3)}')
+
+    # @ BATCHED @ #
+    for batch_size in args.batch_sizes:
+        start = time.perf_counter()
+        detections = []
+        for batch in iterate_batches(frames, batch_size):
+            detections += detect(model, batch)
+        fps = len(frames) / (time.perf_counter() - start)
+
+        # The batched results have to be the same as the single frame ones
+        same = same_detections(detections, single_detections)
+        print(f'  batch size {batch_size:2d}: {1000 / fps:8.2f} ms/frame, {fps:8.2f} fps, {fps / single_fps:5.2f}x, same detections: {same}')
+        results.append({'BACKEND': backend, 'BATCH_SIZE': batch_size, 'MS_PER_FRAME': 1000 / fps, 'FPS': fps, 'SPEEDUP': fps / single_fps, 'SAME_DETECTIONS': same, 'STARTUP': startup})
+
+# @ RESULTS @ #
+benchmarks_dir = '../post_analysis/benchmarks'
+os.makedirs(benchmarks_dir, exist_ok=True)
+results_path = os.path.join(benchmarks_dir, f'inference_user_{args.user_id}_s{args.scenario_id}.csv')
+results = pd.DataFrame(results)
+results.insert(1, 'IMAGE_SIZE', args.image_size)
+results.insert(0, 'FRAMES', len(frames))
+atomic_write(results_path, lambda path: results.to_csv(path, index=False, sep=';'))
+print(f'Written into {results_path}')
@@ -0,0 +1,158 @@
+import os
+import time
+import random
+import argparse
+import cv2
+from helpers.frame_source import read_frames
+from helpers.detector import backends, onnx_path, int8_onnx_path, load_model, detect, iterate_batches, letterbox, prepare_batch
+from helpers.labels import label_names
+from helpers.attribution import attribute_batch
+from helpers.precision import detection_agreement, seen_objects_agreement, save_approval
+from helpers.progress_bar import printProgressBar
+from helpers.atomic_write import atomic_write
+
+# Check for argv
+parser = argparse.ArgumentParser(description='Calibrate a reduced precision model on sample frames and let it through only if it agrees with the fp32 model')
+parser.add_argument('--int8', action='store_true', help='quantize best.onnx into best.int8.onnx with the calibration frames and check the onnx_int8 backend')
+parser.add_argument('--image-size', type=int, default=None, help='check the reference backend at a smaller image size')
+parser.add_argument('--reference', choices=backends, default='hub', help='fp32 backend the detections are compared with')
+parser.add_argument('--frames-per-video', type=int, default=10, help='random frames of every video, half for the calibration and half for the check')
+parser.add_argument('--seed', type=int, default=0, help='seed of the random frames')
+parser.add_argument('--batch-size', type=int, default=8, help='number of frames sent through the models at once')
+parser.add_argument('--min-detection-agreement', type=float, default=0.95, help='lowest accepted share of the confident detections both models find')
+parser.add_argument('--min-seen-objects-agreement', type=float, default=0.98, help='lowest accepted share of the frames with the same SEEN_OBJECTS')
+args = parser.parse_args()
+
+if args.int8 == (args.image_size is not None):
+    print('Pick one of --int8 and --image-size')
+    exit(1)
+
+if args.image_size is not None and args.reference not in ('hub', 'local'):
+    print('--image-size only works with the hub and local backends')
+    exit(1)
+
+# The setup being checked
+backend = 'onnx_int8' if args.int8 else args.reference
+image_size = args.image_size
+
+# @ SAMPLE FRAMES @ #
+# The same random frames of every video on every run with the same seed, every other one is used for the
+# calibration and the rest for the check, so the check never sees a frame the model was calibrated on
+videos_dir = '../simulator_data/videos'
+videos = sorted(video for video in os.listdir(videos_dir) if video.split('.', 1)[-1] == 'mp4')
+rng = random.Random(args.seed)
+calibration_frames = {}
+check_frames = {}
+for video in videos:
+    cap = cv2.VideoCapture(os.path.join(videos_dir, video))
+    num_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    sample = rng.sample(range(num_frames), min(args.frames_per_video, num_frames))
+    # Without a calibration all of the frames are checked
+    calibration_frames[video] = sorted(sample[0::2]) if args.int8 else []
+    check_frames[video] = sorted(sample[1::2]) if args.int8 else sorted(sample)
+
+# Frames of every video are read one video at a time, so only one video's frames are held at once
+def iterate_video_frames(frames_by_video):
+    for video, frame_numbers in frames_by_video.items():
+        cap = cv2.VideoCapture(os.path.join(videos_dir, video))
+        yield video, [frame for _, frame in read_frames(cap, frame_numbers)]
+        cap.release()
+
+# @ INT8 CALIBRATION @ #
+# Static quantization with ONNX Runtime, the activation ranges are measured on the calibration frames
+# Only the convolutions are quantized, the detection head that decodes the boxes stays in float
+def quantize_int8():
+    # ONNX Runtime is only needed for the int8 model
+    import onnxruntime
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+
+    model_input = onnxruntime.InferenceSession(onnx_path, providers=['CPUExecutionProvider']).get_inputs()[0]
+    batch_size, _, height, width = model_input.shape
+    batch_size = batch_size if isinstance(batch_size, int) else 1
+
+    # The calibration frames are letterboxed right away, that's all the calibration needs of them
+    inputs = []
+    for video, frames in iterate_video_frames(calibration_frames):
+        inputs += [letterbox(frame, (height, width)) for frame in frames]
+    if not inputs:
+        raise ValueError('No calibration frames, check the videos in ' + videos_dir)
+    print(f'Calibrating on {len(inputs)} frames')
+
+    class FramesReader(CalibrationDataReader):
+        def __init__(self):
+            self.batches = iterate_batches(inputs, batch_size)
+
+        def get_next(self):
+            batch = next(self.batches, None)
+            if batch is None:
+                return None
+            # A model with a fixed batch gets full batches, the last one is filled up with its first frame
+            batch = batch + batch[:1] * (batch_size - len(batch))
+            return {model_input.name: prepare_batch(batch, (height, width))}
+
+    atomic_write(int8_onnx_path, lambda path: quantize_static(
+        onnx_path,
+        path,
+        FramesReader(),
+        quant_format=QuantFormat.QDQ,
+        op_types_to_quantize=['Conv'],
+        per_channel=True,
+        activation_type=QuantType.QUInt8,
+        weight_type=QuantType.QInt8,
+    ))
+
+if args.int8:
+    quantize_int8()
+
+# @ ACCURACY GATE @ #
+# Both models see the same check frames, their detections and the looked at objects they lead to are compared
+reference_model = load_model(args.reference)
+model = load_model(backend, image_size)
+
+detections = []
+reference = []
+seen_objects = []
+reference_seen_objects = []
+seconds = 0.0
+reference_seconds = 0.0
+printProgressBar(0, len(videos), prefix = 'Checking:', suffix = 'Complete', length = 50)
+for done, (video, frames) in enumerate(iterate_video_frames(check_frames)):
+    for batch in iterate_batches(frames, args.batch_size):
+        start = time.perf_counter()
+        batch_reference = detect(reference_model, batch)
+        reference_seconds += time.perf_counter() - start
+        start = time.perf_counter()
+        batch_detections = detect(model, batch)
+        seconds += time.perf_counter() - start
+
+        height, width = batch[0].shape[:2]
+        reference_seen_objects += [objects for _, objects, _ in attribute_batch(batch_reference, width, height, label_names)]
+        seen_objects += [objects for _, objects, _ in attribute_batch(batch_detections, width, height, label_names)]
+        reference += batch_reference
+        detections += batch_detections
+
+    printProgressBar(done + 1, len(videos), prefix = 'Checking:', suffix = 'Complete', length = 50)
+
+report = {
+    'reference': args.reference,
+    'frames': len(detections),
+    'detection_agreement': detection_agreement(detections, reference),
+    'seen_objects_agreement': seen_objects_agreement(seen_objects, reference_seen_objects),
+    'speedup': reference_seconds / seconds if seconds else 0.0,
+    'min_detection_agreement': args.min_detection_agreement,
+    'min_seen_objects_agreement': args.min_seen_objects_agreement,
+}
+passed = (
+    report['frames'] > 0 and
+    report['detection_agreement'] >= args.min_detection_agreement and
+    report['seen_objects_agreement'] >= args.min_seen_objects_agreement
+)
+save_approval(backend, image_size, report, passed)
+
+setup = backend if image_size is None else f'{backend} at image size {image_size}'
+print(f'{setup} on {report["frames"]} frames: detections agree {report["detection_agreement"]:.2%}, SEEN_OBJECTS agree {report["seen_objects_agreement"]:.2%}, {report["speedup"]:.2f}x the speed of {args.reference}')
+if not passed:
+    print(f'Refused, below the minimum of {args.min_detection_agreement:.2%} for the detections or {args.min_seen_objects_agreement:.2%} for SEEN_OBJECTS')
+    exit(1)
+print(f'Let through, use it with video_analysis.py --backend {backend}' + (f' --image-size {image_size}' if image_size is not None else ''))
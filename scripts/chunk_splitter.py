@@ -1,8 +1,13 @@
 import os
+import sys
 import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from scipy.interpolate import interp1d
 from helpers.progress_bar import printProgressBar
+from helpers.ingest_cache import iterate_session
+from helpers.chunk_store import write_chunk_store, remove_chunk_store
+from helpers.atomic_write import atomic_write
 
 # Paths to data directories
 parent_dir = '../simulator_data'
@@ -18,169 +23,262 @@ with open('helpers/user_ids.txt', 'r') as f:
 target_fps = 50
 target_time_step = 1 / target_fps
 
+# Columns that get resampled to match the video framerate
+data_columns = [
+    'AUTO_DRIVE',
+    'LEAD_TIME',
+    'HUD_5019',
+    'STEERING_WHEEL_ANGLE',
+    'SPEED',
+    'SPEED_LIMIT',
+    'ACCELERATION',
+    'ACCELERATION_Y',
+    'BRAKE_PEDAL',
+    'INDICATORS'
+]
+
+# @ RESAMPLING @ #
+# Resample the chunks read from the csv onto one continuous 50 Hz grid
+# The last samples and the position on the grid are carried over to the next chunk,
+# so the interpolation doesn't restart at chunk boundaries and the output doesn't depend on the chunksize
+def resample_chunks(df_iterator):
+    grid_start = None
+    grid_step = None
+    next_index = 0
+    last_timestamps = None
+    last_values = None
+
+    for chunk in df_iterator:
+        if len(chunk) == 0:
+            continue
+        # Convert to seconds, because miliseconds are too much to handle
+        timestamps = chunk['TIMESTAMP'].to_numpy() / 1000
+        values = chunk[data_columns].to_numpy(dtype=float)
+
+        if last_timestamps is None:
+            # Same grid as np.arange(timestamps[0], ..., target_time_step) would generate
+            grid_start = timestamps[0]
+            grid_step = (grid_start + target_time_step) - grid_start
+        else:
+            # Prepend the last two samples of the previous chunk to interpolate over the boundary, a grid point
+            # on the last sample is interpolated between it and the one before, like in one big chunk
+            timestamps = np.concatenate((last_timestamps, timestamps))
+            values = np.vstack((last_values, values))
+
+        last_timestamps = timestamps[-2:]
+        last_values = values[-2:]
+        last_timestamp = timestamps[-1]
+        if len(timestamps) < 2:
+            continue
+
+        # Generate the grid points before the last timestamp of this chunk, the one at or after it belongs to the next
+        # chunk. The stop is looked up among the grid values themselves, a division could round it to the wrong side
+        stop_index = grid_stop(grid_start, grid_step, last_timestamp)
+        if stop_index <= next_index:
+            continue
+        new_timestamps = grid_start + np.arange(next_index, stop_index) * grid_step
+        next_index = stop_index
+
+        # Interpolate all of the columns at once, every grid point lies between the samples of this chunk
+        interp = interp1d(timestamps, values, kind='linear', axis=0, bounds_error=True)
+        yield new_timestamps, interp(new_timestamps)
+
+# Number of grid points grid_start + k * grid_step before timestamp
+def grid_stop(grid_start, grid_step, timestamp):
+    estimate = max(int(np.ceil((timestamp - grid_start) / grid_step)) - 2, 0)
+    candidates = grid_start + np.arange(estimate, estimate + 4) * grid_step
+    return estimate + int(np.searchsorted(candidates, timestamp, side='left'))
+
+# Resample the whole session and cut it where the video starts
+def resample_session(df_iterator, timestamp):
+    timestamps_list = []
+    values_list = []
+    for new_timestamps, resampled_values in resample_chunks(df_iterator):
+        timestamps_list.append(new_timestamps)
+        values_list.append(resampled_values)
+
+    if timestamps_list:
+        new_timestamps = np.concatenate(timestamps_list)
+        resampled_values = np.concatenate(values_list)
+    else:
+        new_timestamps = np.empty(0)
+        resampled_values = np.empty((0, len(data_columns)))
+
+    # ! There are more frames than data samples, most likely because of the resampling ! #
+    # ? Right now this does nothing, but that's fine for out semi-automatic purposes ? #
+    # Cut where video starts, the data is left as is if the video starts after the last sample
+    start = np.searchsorted(new_timestamps, timestamp, side='left')
+    if start < len(new_timestamps):
+        new_timestamps = new_timestamps[start:]
+        resampled_values = resampled_values[start:]
+
+    # Combine the resampled data into a single DataFrame
+    resampled_df = pd.DataFrame(resampled_values, columns=data_columns)
+    resampled_df.insert(0, 'TIMESTAMP', new_timestamps)
+    resampled_df.insert(0, 'FRAME', range(len(new_timestamps)))
+    return resampled_df
+
+# Amount of frames after driving mode switch
+next_frames = target_fps * 15
+
+# @ SEGMENTATION @ #
+# Find the rows where a TAKE OVER request or AUTO DRIVE request is present
+def find_request_windows(resampled_df):
+    lead_time = resampled_df['LEAD_TIME'].to_numpy()
+    hud_5019 = resampled_df['HUD_5019'].to_numpy()
+    auto_drive = resampled_df['AUTO_DRIVE'].to_numpy()
+    is_request = (lead_time > 0) | ((hud_5019 > 0) & (auto_drive < 4))
+
+    # Run-length detection, +1 marks the first row of a window and -1 the first row after it
+    edges = np.diff(np.concatenate(([0], is_request.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    return starts, ends
+
+# Find the rows of every chunk, each one a request window followed by next_frames frames
+# Returns the (start, stop) rows of the chunks and of the unfinished window at the end, if there is one
+def find_chunk_bounds(resampled_df):
+    total_frames = len(resampled_df)
+    starts, ends = find_request_windows(resampled_df)
+
+    bounds = []
+    remaining_bounds = None
+    for start, end in zip(starts, ends):
+        # A window running until the last row has no frames after the switch
+        if end == total_frames:
+            remaining_bounds = (start, end)
+            break
+        # Prevent going over the last row if there are less left than next_frames
+        stop = min(end + next_frames + 1, total_frames)
+        bounds.append((start, stop))
+
+    return bounds, remaining_bounds
+
+# Cut the resampled data into chunks
+def split_into_chunks(resampled_df):
+    # The chunks were always written with every column as float (FRAME included), keep it that way
+    resampled_df = resampled_df.astype(float)
+    bounds, remaining_bounds = find_chunk_bounds(resampled_df)
+
+    chunks = [resampled_df.iloc[start:stop] for start, stop in bounds]
+    remaining_df = None
+    if remaining_bounds is not None:
+        remaining_df = resampled_df.iloc[remaining_bounds[0]:remaining_bounds[1]]
+
+    return chunks, remaining_df
+
+# @ SPLITTING ONE SESSION @ #
+# Resample and split the data of one user in one scenario, returns False if the files are missing
+def split_user(user_id, scenario, use_store=False):
+    # Construct the filename for the csv and txt files
+    generic_file_name = f'user_{user_id}_s{scenario}'
+    csv_file = os.path.join(user_data_dir, generic_file_name) + '.csv'
+    txt_file = os.path.join(timestamps_dir, generic_file_name) + '.txt'
+
+    # Check if the .csv and .txt files exist in the current directory
+    if not os.path.isfile(csv_file) or not os.path.isfile(txt_file):
+        return False
+
+    # Import .csv data, through the typed cache so it's only parsed the first time
+    df_iterator = iterate_session(csv_file, ['TIMESTAMP'] + data_columns, chunksize=1000000)
+
+    # Read the starting timestamp to sync with video
+    with open(txt_file, 'r') as file:
+        timestamp = int(file.read())
+
+    # Resample the data inside all chunks to match the video framerate
+    resampled_df = resample_session(df_iterator, timestamp)
+
+    # Create directory for chunks, several workers might be creating the parent directories at once
+    post_analysis_dir = '../post_analysis'
+    parent_chunks_dir = os.path.join(post_analysis_dir, 'chunks')
+    child_chunks_dir = f'chunks_user_{user_id}_s{scenario}'
+    os.makedirs(parent_chunks_dir, exist_ok=True)
+
+    # Split into chunks and save them
+    # Only saving data, where TAKE OVER request or AUTO DRIVE request is present
+    if use_store:
+        # One binary file per session instead of a directory of .csv files
+        bounds, remaining_bounds = find_chunk_bounds(resampled_df)
+        write_chunk_store(parent_chunks_dir, generic_file_name, resampled_df, bounds)
+        remaining_df = None
+        if remaining_bounds is not None:
+            remaining_df = resampled_df.iloc[remaining_bounds[0]:remaining_bounds[1]].astype(float)
+    else:
+        # Remove an older store of this session, so the .csv chunks aren't shadowed by it
+        remove_chunk_store(parent_chunks_dir, generic_file_name)
+        os.makedirs(os.path.join(parent_chunks_dir, child_chunks_dir), exist_ok=True)
+
+        chunks, remaining_df = split_into_chunks(resampled_df)
+        for chunk_num, chunk_df in enumerate(chunks):
+            current_chunk = f'chunk_{chunk_num}.csv'
+            current_chunk_path = os.path.join(parent_chunks_dir, child_chunks_dir, current_chunk)
+            chunk_df.to_csv(current_chunk_path, index=False)
+
+    # Save any remaining data, replaced in one step so parallel workers can't interleave their writes
+    if remaining_df is not None:
+        atomic_write('temp/remaining_data.csv', lambda path: remaining_df.to_csv(path, index=False))
+
+    return True
+
 # @ MAIN LOOP @ #
 # Iterate over each directory
-def iterate_for_scenario(scenario):
+def iterate_for_scenario(scenario, use_store=False):
     # Print progress bar
     printProgressBar(0, len(user_ids), prefix = f'Splitting for scenario {scenario}:', suffix = 'Complete', length = 50)
 
     for idx, user_id in enumerate(user_ids):
-        # Construct the filename for the csv and txt files
-        generic_file_name = f'user_{user_id}_s{scenario}'
-        csv_file = os.path.join(user_data_dir, generic_file_name) + '.csv'
-        txt_file = os.path.join(timestamps_dir, generic_file_name) + '.txt'
-
-        # Check if the .csv and .txt files exist in the current directory and import .csv data
-        if os.path.isfile(csv_file) and os.path.isfile(txt_file):
-            df_iterator = pd.read_csv(
-                csv_file,
-                usecols=[
-                    'TIMESTAMP',
-                    'AUTO_DRIVE',
-                    'LEAD_TIME',
-                    'HUD_5019',
-                    'STEERING_WHEEL_ANGLE',
-                    'SPEED',
-                    'SPEED_LIMIT',
-                    'ACCELERATION',
-                    'ACCELERATION_Y',
-                    'BRAKE_PEDAL',
-                    'INDICATORS'
-                ],
-                chunksize=1000000,
-                low_memory=False,
-                delimiter=';'
-            )
-
-            # Read the starting timestamp to sync with video
-            with open(txt_file, 'r') as file:
-                timestamp = int(file.read())
-
-            # Declare resampled df
-            resampled_df = pd.DataFrame()
-
-            # Resample the data inside all chunks to match the video framerate
-            for chunk in df_iterator:
-                # Get the timestamps from the current chunk of data
-                timestamps = chunk['TIMESTAMP'].to_numpy()
-
-                # Convert to seconds, because miliseconds are too much to handle
-                timestamps = timestamps / 1000
-
-                # Create an interpolation function for each column
-                interp_auto_drive = interp1d(timestamps, chunk['AUTO_DRIVE'].to_numpy(), kind='linear')
-                interp_lead_time = interp1d(timestamps, chunk['LEAD_TIME'].to_numpy(), kind='linear')
-                interp_hud_5019 = interp1d(timestamps, chunk['HUD_5019'].to_numpy(), kind='linear')
-                interp_steering_wheel_angle = interp1d(timestamps, chunk['STEERING_WHEEL_ANGLE'].to_numpy(), kind='linear')
-                interp_speed = interp1d(timestamps, chunk['SPEED'].to_numpy(), kind='linear')
-                interp_speed_limit = interp1d(timestamps, chunk['SPEED_LIMIT'].to_numpy(), kind='linear')
-                interp_acceleration = interp1d(timestamps, chunk['ACCELERATION'].to_numpy(), kind='linear')
-                interp_acceleration_y = interp1d(timestamps, chunk['ACCELERATION_Y'].to_numpy(), kind='linear')
-                interp_brake_pedal = interp1d(timestamps, chunk['BRAKE_PEDAL'].to_numpy(), kind='linear')
-                interp_indicators = interp1d(timestamps, chunk['INDICATORS'].to_numpy(), kind='linear')
-
-                # Generate a new set of timestamps spaced by the target time step
-                new_timestamps = np.arange(timestamps[0], timestamps[-1], target_time_step)
-
-                # Interpolate the data for each column using the new timestamps
-                resampled_auto_drive = interp_auto_drive(new_timestamps)
-                resampled_lead_time = interp_lead_time(new_timestamps)
-                resampled_hud_5019 = interp_hud_5019(new_timestamps)
-                resampled_steering_wheel_angle = interp_steering_wheel_angle(new_timestamps)
-                resampled_speed = interp_speed(new_timestamps)
-                resampled_speed_limit = interp_speed_limit(new_timestamps)
-                resampled_acceleration = interp_acceleration(new_timestamps)
-                resampled_acceleration_y = interp_acceleration_y(new_timestamps)
-                resampled_brake_pedal = interp_brake_pedal(new_timestamps)
-                resampled_indicators = interp_indicators(new_timestamps)
-
-                # ! There are more frames than data samples, most likely because of the resampling ! #
-                # ? Right now this loop does nothing, but that's fine for out semi-automatic purposes ? #
-                # Cut where video starts
-                for i in range(len(new_timestamps)):
-                    if new_timestamps[i] >= timestamp:
-                        new_timestamps = new_timestamps[i:]
-                        resampled_auto_drive = resampled_auto_drive[i:]
-                        resampled_lead_time = resampled_lead_time[i:]
-                        resampled_hud_5019 = resampled_hud_5019[i:]
-                        resampled_steering_wheel_angle = resampled_steering_wheel_angle[i:]
-                        resampled_speed = resampled_speed[i:]
-                        resampled_speed_limit = resampled_speed_limit[i:]
-                        resampled_acceleration = resampled_acceleration[i:]
-                        resampled_acceleration_y = resampled_acceleration_y[i:]
-                        resampled_brake_pedal = resampled_brake_pedal[i:]
-                        resampled_indicators = resampled_indicators[i:]
-                        break
-
-                # Combine the resampled data into a single DataFrame
-                resampled_df = pd.DataFrame({
-                    'FRAME': range(len(new_timestamps)),
-                    'TIMESTAMP': new_timestamps,
-                    'AUTO_DRIVE': resampled_auto_drive,
-                    'LEAD_TIME': resampled_lead_time,
-                    'HUD_5019': resampled_hud_5019,
-                    'STEERING_WHEEL_ANGLE': resampled_steering_wheel_angle,
-                    'SPEED': resampled_speed,
-                    'SPEED_LIMIT': resampled_speed_limit,
-                    'ACCELERATION': resampled_acceleration,
-                    'ACCELERATION_Y': resampled_acceleration_y,
-                    'BRAKE_PEDAL': resampled_brake_pedal,
-                    'INDICATORS': resampled_indicators
-                })
-
-            # Initialize variables
-            chunk_num = 0
-            temp_df = pd.DataFrame()
-            # Amount of frames after driving mode switch
-            next_frames = target_fps * 15
-
-            # Create directory for chunks
-            post_analysis_dir = '../post_analysis'
-            parent_chunks_dir = 'chunks'
-            child_chunks_dir = f'chunks_user_{user_id}_s{scenario}'
-
-            if not os.path.exists(post_analysis_dir):
-                os.mkdir(post_analysis_dir)
-
-            if not os.path.exists(os.path.join(post_analysis_dir, parent_chunks_dir)):
-                os.mkdir(os.path.join(post_analysis_dir, parent_chunks_dir))
-
-            if not os.path.exists(os.path.join(post_analysis_dir, parent_chunks_dir, child_chunks_dir)):
-                os.mkdir(os.path.join(post_analysis_dir, parent_chunks_dir, child_chunks_dir))
-
-            # Iterate over rows and split into chunks
-            # Only saving data, where TAKE OVER request or AUTO DRIVE request is present
-
-            # Start saving chunks
-            for i, row in resampled_df.iterrows():
-                if row['LEAD_TIME'] > 0 or (row['HUD_5019'] > 0 and row['AUTO_DRIVE'] < 4):
-                    temp_df = pd.concat([temp_df, row.to_frame().transpose()])
-                elif not temp_df.empty:
-                    # Prevent going over the last row if there are less left than next_frames
-                    index = resampled_df.index.get_loc(i)
-                    if (index + next_frames) > len(resampled_df):
-                        next_rows = resampled_df.loc[i:len(resampled_df)]
-                    else:
-                        next_rows = resampled_df.loc[i:index + next_frames]
-                    
-                    # Declare current chunk path
-                    current_chunk = f'chunk_{chunk_num}.csv'
-                    current_chunk_path = os.path.join(post_analysis_dir, parent_chunks_dir, child_chunks_dir, current_chunk)
-
-                    # Add next_frames to the chunk and save it
-                    temp_df = pd.concat([temp_df, next_rows])
-                    temp_df.to_csv(current_chunk_path, index=False)
-                    chunk_num += 1
-                    temp_df = pd.DataFrame()
-
-            # Save any remaining data in temp_df
-            if not temp_df.empty:
-                temp_df.to_csv('temp/remaining_data.csv', index=False)
+        split_user(user_id, scenario, use_store)
 
         # Print progress bar
         printProgressBar(idx + 1, len(user_ids), prefix = f'Splitting for scenario {scenario}:', suffix = 'Complete', length = 50)
 
+# @ PARALLEL MAIN LOOP @ #
+# Every (user, scenario) pair is independent, so spread them over a pool of processes
+# Errors are collected per job and reported at the end instead of stopping the whole batch
+def split_in_parallel(scenarios, workers, use_store=False):
+    jobs = [(user_id, scenario) for scenario in scenarios for user_id in user_ids]
+    errors = {}
+
+    # Print progress bar, only the parent process prints it
+    printProgressBar(0, len(jobs), prefix = f'Splitting with {workers} workers:', suffix = 'Complete', length = 50)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(split_user, user_id, scenario, use_store): (user_id, scenario) for user_id, scenario in jobs}
+        for done, future in enumerate(as_completed(futures)):
+            user_id, scenario = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                errors[f'user_{user_id}_s{scenario}'] = e
+
+            # Print progress bar
+            printProgressBar(done + 1, len(jobs), prefix = f'Splitting with {workers} workers:', suffix = 'Complete', length = 50)
+
+    for session, error in sorted(errors.items()):
+        print(f'{session} failed: {error!r}')
+
+    return errors
+
 # @ CALL MAIN LOOP @ #
-# Each scenario once
-iterate_for_scenario(1)
-iterate_for_scenario(3)
\ No newline at end of file
+if __name__ == '__main__':
+    # Check for argv
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    flags = [a for a in sys.argv[1:] if a.startswith('--')]
+    if len(args) > 1 or (len(args) == 1 and not args[0].isdigit()) or any(f != '--store' for f in flags):
+        print('Incorrectly provided arguments, please run the script as follows:')
+        print('> python3 chunk_splitter.py [number_of_workers] [--store]')
+        exit(1)
+
+    workers = int(args[0]) if len(args) == 1 else 1
+    use_store = '--store' in flags
+
+    if workers > 1:
+        # All of the scenarios in one pool
+        errors = split_in_parallel([1, 3], workers, use_store)
+        if errors:
+            exit(1)
+    else:
+        # Each scenario once
+        iterate_for_scenario(1, use_store)
+        iterate_for_scenario(3, use_store)
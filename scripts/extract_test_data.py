@@ -2,8 +2,22 @@ import sys
 import os
 import cv2
 import random
+import argparse
+from helpers.frame_source import decoders, open_video, read_frames
 from helpers.progress_bar import *
 
+# Check for argv
+parser = argparse.ArgumentParser(description='Extract random frames of the videos as train, val and test images')
+parser.add_argument('--decoder', choices=decoders, default='opencv', help='ffmpeg decodes the frames in its own process')
+args = parser.parse_args()
+
+# Number of frames of a video found by decoding all of them, leaves cap at the end of the video
+def count_frames(cap):
+    num_frames = 0
+    while cap.grab():
+        num_frames += 1
+    return num_frames
+
 # Extract program arguments
 video_folder_path = '../simulator_data/videos'
 num_train_images = 210
@@ -39,43 +53,41 @@ for idx, video_name in enumerate(os.listdir(video_folder_path)):
         continue
 
     video_path = os.path.join(video_folder_path, video_name)
-    cap = cv2.VideoCapture(video_path)
+    cap = open_video(video_path, args.decoder)
     num_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
 
+    # ffmpeg reports no frame count for some containers, the frames are counted by decoding through the video then
+    if num_frames <= 0:
+        num_frames = count_frames(cap)
+        cap.release()
+        cap = open_video(video_path, args.decoder)
+    if num_frames <= 0:
+        sys.exit(f'{video_name}: the number of frames is unknown and no frame could be decoded')
+
     # Sample random frames
     sample_frames = random.sample(
         range(0, num_frames),
         num_train_images_per_video + num_val_images_per_video + num_test_images_per_video
     )
 
-    # Divide the sampled frames into train, val and test groups
-    train_frames = sample_frames[0:num_train_images_per_video]
-    val_frames = sample_frames[num_train_images_per_video:num_train_images_per_video + num_val_images_per_video]
-    test_frames = sample_frames[num_train_images_per_video + num_val_images_per_video:]
-    print(val_frames)
-    # Extract the frames and save them into appropriate folders
-    for i in range(0, len(train_frames)):
-        cap.set(cv2.CAP_PROP_POS_FRAMES, train_frames[i])
-        ret, frame = cap.read()
-        train_img_path = os.path.join(train_path, video_name.partition('.')[0] + '_' + str(i) + '.jpg')
-        cv2.imwrite(train_img_path, frame)
+    # Divide the sampled frames into train, val and test groups, each sorted so the images are numbered in video order
+    train_frames = sorted(sample_frames[0:num_train_images_per_video])
+    val_frames = sorted(sample_frames[num_train_images_per_video:num_train_images_per_video + num_val_images_per_video])
+    test_frames = sorted(sample_frames[num_train_images_per_video + num_val_images_per_video:])
 
-    sys.stdout.flush()
-
-    for i in range(0, len(val_frames)):
-        cap.set(cv2.CAP_PROP_POS_FRAMES, val_frames[i])
-        ret, frame = cap.read()
-        val_img_path = os.path.join(val_path, video_name.partition('.')[0] + '_' + str(i) + '.jpg')
-        cv2.imwrite(val_img_path, frame)
-
-    sys.stdout.flush()
+    # Image path of every sampled frame
+    img_paths = {}
+    for frames, path in [(train_frames, train_path), (val_frames, val_path), (test_frames, test_path)]:
+        for i, f in enumerate(frames):
+            img_paths[f] = os.path.join(path, video_name.partition('.')[0] + '_' + str(i) + '.jpg')
 
-    for i in range(0, len(test_frames)):
-        cap.set(cv2.CAP_PROP_POS_FRAMES, test_frames[i])
-        ret, frame = cap.read()
-        test_img_path = os.path.join(test_path, video_name.partition('.')[0] + '_' + str(i) + '.jpg')
-        cv2.imwrite(test_img_path, frame)
+    # Extract the frames in ascending order and save them into appropriate folders, seeking backwards would restart
+    # the ffmpeg decoder
+    for f, frame in read_frames(cap, img_paths):
+        cv2.imwrite(img_paths.pop(f), frame)
 
+    if img_paths:
+        print(f'{video_name}: {len(img_paths)} frames could not be read')
     sys.stdout.flush()
 
     cap.release()
@@ -1,196 +1,487 @@
 import os
+import argparse
+import itertools
+import numpy as np
 import pandas as pd
+from helpers.labels import object_names, objects_mask, seen_objects_masks
+from helpers.file_hash import file_hash
+from helpers.grading_cache import GradingCache
 
 # @ GLOBAL @ #
-# Construct dataframe structure
-data = {
-    'USER': [], # user ID
-    'HUD': [], # user has HUD
-    'REQUEST_TYPE': [], # type of transition, either from AUTOMATIC to MANUAL or vice versa
-    'ADL_UNDER_THRESHOLD': [], # switched to auto mode in under 5 seconds
-    'ADL_FAIL': [], # unintended ADL activation
-    'ADL_ROAD': [], # % of road watchtime after ADL activation (5s)
-    'ADL_DISTRACTION': [], # % of distraction watchtime after ADL activation (5s)
-    'ADL_OTHER_OR_UNDEFINED': [], # % of undefined looking at frames (either nothing relevant or eyetracker lost)
-    'TOR_RT': [], # reaction time between TOR and TO
-    'TOR_RESPONSE': [], # did the user respond to visual or auditory warning or did he not respond at all
-    'TOR_MIRRORS': [], # checked at least one mirror
-    'TOR_ROAD': [], # % of road watchtime between TOR and TO
-    'TOR_DASHBOARD': [],
-    'TOR_HUD': [],
-    'TOR_OTHER_OR_UNDEFINED': [], # % of undefined looking at frames (either nothing relevant or eyetracker lost)
-    'TOR_SPEEDING': [], # % of time speeding after TO (5s)
-    'TOR_ACC': [], # % of time acceleration exceeds a threshold (5s)
-    'TOR_DCC': [], # % of time decceleration exceeds a threshold (5s)
-    'TOR_ACC_Y': [], # % of time acceleration_y exceeds a threshold (5s)
-}
+# Columns of the grading table
+grading_columns = [
+    'USER', # user ID
+    'HUD', # user has HUD
+    'REQUEST_TYPE', # type of transition, either from AUTOMATIC to MANUAL or vice versa
+    'ADL_UNDER_THRESHOLD', # switched to auto mode in under 5 seconds
+    'ADL_FAIL', # unintended ADL activation
+    'ADL_ROAD', # % of road watchtime after ADL activation (5s)
+    'ADL_DISTRACTION', # % of distraction watchtime after ADL activation (5s)
+    'ADL_OTHER_OR_UNDEFINED', # % of undefined looking at frames (either nothing relevant or eyetracker lost)
+    'TOR_RT', # reaction time between TOR and TO
+    'TOR_RESPONSE', # did the user respond to visual or auditory warning or did he not respond at all
+    'TOR_MIRRORS', # checked at least one mirror
+    'TOR_ROAD', # % of road watchtime between TOR and TO
+    'TOR_DASHBOARD',
+    'TOR_HUD',
+    'TOR_OTHER_OR_UNDEFINED', # % of undefined looking at frames (either nothing relevant or eyetracker lost)
+    'TOR_SPEEDING', # % of time speeding after TO (5s)
+    'TOR_ACC', # % of time acceleration exceeds a threshold (5s)
+    'TOR_DCC', # % of time decceleration exceeds a threshold (5s)
+    'TOR_ACC_Y', # % of time acceleration_y exceeds a threshold (5s)
+]
 
 FPS = 50
 
-# @ FUNCTIONS @ #
-def fill_empty_tor():
-    data['TOR_RT'].append('-')
-    data['TOR_RESPONSE'].append('-')
-    data['TOR_MIRRORS'].append('-')
-    data['TOR_ROAD'].append('-')
-    data['TOR_DASHBOARD'].append('-')
-    data['TOR_HUD'].append('-')
-    data['TOR_OTHER_OR_UNDEFINED'].append('-')
-    data['TOR_SPEEDING'].append('-')
-    data['TOR_ACC'].append('-')
-    data['TOR_DCC'].append('-')
-    data['TOR_ACC_Y'].append('-')
-
-def fill_empty_adl():
-    data['ADL_UNDER_THRESHOLD'].append('-')
-    data['ADL_ROAD'].append('-')
-    data['ADL_DISTRACTION'].append('-')
-    data['ADL_OTHER_OR_UNDEFINED'].append('-')
-
-def check_adl_switch(chunk: pd.DataFrame):
-    threshold = 5 * FPS # 5 seconds
-
-    mask = (chunk['DRIVING_MODE'] == 'MANUAL')
-    frames_before_adl = len(chunk[mask])
-
-    if frames_before_adl < threshold:
-        data['ADL_UNDER_THRESHOLD'].append(True)
-    else:
-        data['ADL_UNDER_THRESHOLD'].append(False)
-
-def adl_looking(chunk: pd.DataFrame):
-    mask = (chunk['DRIVING_MODE'] == 'AUTOMATIC')
-
-    all_frames = len(chunk[mask].head(5 * FPS))
-    road_frames = 0
-    disctraction_frames = 0
-    other_frames = 0
-
-    for idx, row in chunk[mask].head(5 * FPS).iterrows():
-        objects = str(row['SEEN_OBJECTS']).split(',')
-
-        if 'road' in objects:
-            road_frames += 1
-        elif 'distraction' in objects:
-            disctraction_frames += 1
-        else:
-            other_frames += 1
-
-    data['ADL_ROAD'].append(road_frames / all_frames)
-    data['ADL_DISTRACTION'].append(disctraction_frames / all_frames)
-    data['ADL_OTHER_OR_UNDEFINED'].append(other_frames / all_frames)
-
-def tor_reaction(chunk: pd.DataFrame):
-    mask = (chunk['DRIVING_MODE'] == 'AUTOMATIC')
-
-    rt = len(chunk[mask]) / FPS
-    data['TOR_RT'].append(rt)
-
-    visual_threshold = 10
-    auditory_threshold = 15
-
-    if rt < visual_threshold:
-        data['TOR_RESPONSE'].append('VISUAL')
-    elif rt < auditory_threshold:
-        data['TOR_RESPONSE'].append('AUDITORY')
-    else:
-        data['TOR_RESPONSE'].append('NO_RESPONSE')
-
-def tor_looking(chunk: pd.DataFrame):
-    mask = (chunk['DRIVING_MODE'] == 'AUTOMATIC')
-
-    all_frames = len(chunk[mask])
-    mirror_frames = 0
-    road_frames = 0
-    dashboard_frames = 0
-    hud_frames = 0
-    other_frames = 0
-
-    for idx, row in chunk[mask].iterrows():
-        objects = str(row['SEEN_OBJECTS']).split(',')
-
-        if 'road' in objects:
-            road_frames += 1
-        elif 'mirror' in objects or 'rearview_mirror' in objects or 'right_mirror' in objects or 'left_mirror' in objects:
-            mirror_frames += 1
-        elif 'dashboard' in objects:
-            dashboard_frames += 1
-        elif 'header_display' in objects:
-            hud_frames += 1
-        else:
-            other_frames += 1
-
-    data['TOR_MIRRORS'].append(mirror_frames / all_frames)
-    data['TOR_ROAD'].append(road_frames / all_frames)
-    data['TOR_DASHBOARD'].append(dashboard_frames / all_frames)
-    data['TOR_HUD'].append(hud_frames / all_frames)
-    data['TOR_OTHER_OR_UNDEFINED'].append(other_frames / all_frames)
-
-def after_tor(chunk: pd.DataFrame):
-    mask = (chunk['DRIVING_MODE'] == 'MANUAL')
-    chunk = chunk[mask].head(5 * FPS)
-
-    all_frames = len(chunk)
-
-    data['TOR_SPEEDING'].append(chunk[(chunk['SPEED'] > (chunk['SPEED_LIMIT'])*1.10)]['FRAME'].count() / all_frames)
-    data['TOR_ACC'].append(chunk[(chunk['ACCELERATION'] > 1.0)]['ACCELERATION'].count() / all_frames)
-    data['TOR_DCC'].append(chunk[(chunk['ACCELERATION'] < -2.0)]['ACCELERATION'].count() / all_frames)
-    data['TOR_ACC_Y'].append(chunk[(chunk['ACCELERATION_Y'].abs() > 0.5)]['ACCELERATION_Y'].count() / all_frames)
-
-# @ MAIN LOOP @ #
-
-post_video_anaylsis_dir = '../post_analysis/video_analysis'
-
-for user in sorted(os.listdir(post_video_anaylsis_dir)):
-    # Skip if not .csv
-    if user.split('.', 1)[-1] != 'csv':
-        continue
+# Bits of the looked at objects in SEEN_OBJECTS
+ROAD = objects_mask('road')
+DISTRACTION = objects_mask('distraction')
+MIRRORS = objects_mask('mirror', 'rearview_mirror', 'right_mirror', 'left_mirror')
+DASHBOARD = objects_mask('dashboard')
+HUD = objects_mask('header_display')
+
+# Columns that are repeated for every extra window after ADL and TO
+adl_window_columns = ['ADL_ROAD', 'ADL_DISTRACTION', 'ADL_OTHER_OR_UNDEFINED']
+after_tor_columns = ['TOR_SPEEDING', 'TOR_ACC', 'TOR_DCC', 'TOR_ACC_Y']
+
+# Seconds after the mode switch of the windows in grading_columns
+default_window = (0, 5)
+
+# Thresholds of the grading, sweep_thresholds evaluates other values of them
+default_thresholds = {
+    'adl_seconds': 5, # ADL_UNDER_THRESHOLD, switched to AUTOMATIC in under this many seconds
+    'visual_seconds': 10, # TOR_RESPONSE is VISUAL under this reaction time
+    'auditory_seconds': 15, # and AUDITORY under this one
+    'speeding_factor': 1.10, # TOR_SPEEDING, over this many times the speed limit
+    'acceleration': 1.0, # TOR_ACC, acceleration over this
+    'deceleration': -2.0, # TOR_DCC, acceleration under this
+    'lateral_acceleration': 0.5, # TOR_ACC_Y, absolute acceleration_y over this
+}
 
-    scenario = user.split('_s', 1)
-    user_data_path = os.path.join(post_video_anaylsis_dir, user)
-    df = pd.read_csv(user_data_path, sep=';')
+# Grading columns that depend on the thresholds
+threshold_columns = ['ADL_UNDER_THRESHOLD', 'TOR_RESPONSE', 'TOR_SPEEDING', 'TOR_ACC', 'TOR_DCC', 'TOR_ACC_Y']
+
+# Columns of the video analysis results the grading reads
+table_columns = ['CHUNK', 'DRIVING_MODE', 'SEEN_OBJECTS', 'ACCELERATION', 'ACCELERATION_Y', 'SPEED', 'SPEED_LIMIT']
+
+# @ FRAME TABLE @ #
+def read_session(path):
+    return pd.read_csv(path, sep=';', usecols=table_columns)
+
+# All sessions in one table, SESSION is the position of the session in sessions, a list of (file name, dataframe)
+def frame_table(sessions):
+    if not sessions:
+        return pd.DataFrame(columns=table_columns + ['SESSION'])
+    table = pd.concat([df[table_columns] for _, df in sessions], ignore_index=True)
+    table['SESSION'] = np.repeat(np.arange(len(sessions)), [len(df) for _, df in sessions])
+    return table
+
+# The rows of every chunk of every session, with the arrays the metrics are computed from
+# The rows are sorted by session and chunk, a chunk keeps the order of its rows like groupby('CHUNK') does
+class Chunks:
+    def __init__(self, table):
+        session = table['SESSION'].to_numpy(np.int64)
+        chunk = table['CHUNK'].to_numpy(np.int64)
+        order = np.lexsort((chunk, session))
+        self.session = session[order]
+        chunk = chunk[order]
+
+        # Chunks follow each other, group is the number of the chunk of every row
+        is_start = np.r_[True, (self.session[1:] != self.session[:-1]) | (chunk[1:] != chunk[:-1])] if len(order) else np.zeros(0, dtype=bool)
+        self.starts = np.flatnonzero(is_start)
+        self.group = np.cumsum(is_start) - 1
+        self.count = len(self.starts)
+        self.chunk_session = self.session[self.starts]
+        self.chunk_number = chunk[self.starts]
+
+        driving_mode = table['DRIVING_MODE'].to_numpy()[order]
+        self.manual = driving_mode == 'MANUAL'
+        self.automatic = driving_mode == 'AUTOMATIC'
+        self.first_mode = driving_mode[self.starts]
+        self.objects = seen_objects_masks(table['SEEN_OBJECTS'].to_numpy())[order]
+        self.speed = table['SPEED'].to_numpy(np.float64)[order]
+        self.speed_limit = table['SPEED_LIMIT'].to_numpy(np.float64)[order]
+        self.acceleration = table['ACCELERATION'].to_numpy(np.float64)[order]
+        self.acceleration_y = table['ACCELERATION_Y'].to_numpy(np.float64)[order]
+
+    # Number of rows per chunk where mask is set
+    def counts(self, mask):
+        return np.bincount(self.group[mask], minlength=self.count)
+
+    # Position of every row among the rows of its chunk where mask is set, like after chunk[mask]
+    def ranks(self, mask):
+        before = np.cumsum(mask) - mask
+        return before - before[self.starts][self.group]
+
+    # The first frames of every chunk where mask is set, like chunk[mask].head(frames)
+    def head(self, mask, frames):
+        return mask & (self.ranks(mask) < frames)
+
+# Share of the frames of every chunk, chunks without frames get nan
+def shares(counts, all_frames):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return counts / all_frames
+
+# Every frame counts for the first category that it sees, the rest count as other
+# Returns the frames of every category and the other frames
+def category_frames(chunks, mask, categories):
+    counted = np.zeros(len(mask), dtype=bool)
+    frames = []
+    for bits in categories:
+        seen = mask & ~counted & ((chunks.objects & bits) != 0)
+        counted |= seen
+        frames.append(seen)
+    return frames, mask & ~counted
+
+# Number of frames of every category per chunk and of the other frames
+def category_counts(chunks, mask, categories):
+    frames, other = category_frames(chunks, mask, categories)
+    return [chunks.counts(seen) for seen in frames], chunks.counts(other)
+
+# @ WINDOWS @ #
+# The frames of every chunk where mask is set, one chunk after the other, with the cumulative sums of the indicators
+# over them. The sums are built once, after that any window is two lookups per chunk
+class WindowSums:
+    def __init__(self, chunks, mask, indicators):
+        self.lengths = chunks.counts(mask)
+        self.offsets = np.cumsum(self.lengths) - self.lengths
+        self.sums = {name: np.r_[0, np.cumsum(indicator[mask])] for name, indicator in indicators.items()}
+
+    # Positions of the first and past the last frame of the window in every chunk, start and end in frames
+    def bounds(self, start, end):
+        return self.offsets + np.minimum(start, self.lengths), self.offsets + np.minimum(end, self.lengths)
+
+    # Number of frames of every chunk in the window, like chunk[mask].iloc[start:end]
+    def frames(self, start, end):
+        first, last = self.bounds(start, end)
+        return last - first
+
+    # Number of frames of every chunk in the window where the indicator is set
+    def counts(self, name, start, end):
+        first, last = self.bounds(start, end)
+        return self.sums[name][last] - self.sums[name][first]
+
+# A window in seconds after the mode switch, in frames
+def window_frames(window):
+    start, end = window
+    return int(round(start * FPS)), int(round(end * FPS))
+
+# Suffix of the columns of an extra window, e.g. _5-10s
+def window_suffix(window):
+    start, end = window
+    return f'_{start:g}-{end:g}s'
+
+# Windows are given as START-END in seconds, e.g. 0-2
+def parse_window(text):
+    try:
+        start, end = (float(value) for value in text.split('-'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'{text} is not a window, use START-END in seconds')
+    if not 0 <= start < end:
+        raise argparse.ArgumentTypeError(f'{text} is not a window, it has to start at 0 or later and end after it starts')
+    return start, end
+
+# Columns of the extra windows, each window gets all of its columns one after the other
+def window_columns(windows):
+    return [column + window_suffix(window) for window in windows for column in adl_window_columns + after_tor_columns]
+
+# @ METRICS @ #
+# Every function returns the values of its columns for all chunks, the chunks they don't apply to are filled in later
+
+# Switched to AUTOMATIC in under 5 seconds
+def check_adl_switch(chunks, thresholds=default_thresholds):
+    threshold = thresholds['adl_seconds'] * FPS
+    return {'ADL_UNDER_THRESHOLD': chunks.counts(chunks.manual) < threshold}
+
+# % of looked at objects in windows after ADL, the first 5 seconds by default
+# windows is a list of (column suffix, (start, end) in seconds)
+def adl_looking(chunks, windows=(('', default_window),)):
+    (road, distraction), other = category_frames(chunks, chunks.automatic, (ROAD, DISTRACTION))
+    sums = WindowSums(chunks, chunks.automatic, {'road': road, 'distraction': distraction, 'other': other})
+    columns = {}
+    for suffix, window in windows:
+        start, end = window_frames(window)
+        all_frames = sums.frames(start, end)
+        columns['ADL_ROAD' + suffix] = shares(sums.counts('road', start, end), all_frames)
+        columns['ADL_DISTRACTION' + suffix] = shares(sums.counts('distraction', start, end), all_frames)
+        columns['ADL_OTHER_OR_UNDEFINED' + suffix] = shares(sums.counts('other', start, end), all_frames)
+    return columns
+
+# Reaction time between TOR and TO in seconds
+def reaction_times(chunks):
+    return chunks.counts(chunks.automatic) / FPS
+
+# The warning the user responded to, rt and the thresholds are broadcast against each other
+def responses(rt, visual_threshold, auditory_threshold):
+    return np.where(rt < visual_threshold, 'VISUAL', np.where(rt < auditory_threshold, 'AUDITORY', 'NO_RESPONSE'))
+
+# Reaction time and type
+def tor_reaction(chunks, thresholds=default_thresholds):
+    rt = reaction_times(chunks)
+    response = responses(rt, thresholds['visual_seconds'], thresholds['auditory_seconds'])
+    return {'TOR_RT': rt, 'TOR_RESPONSE': response}
+
+# % of looked at objects before TO
+def tor_looking(chunks):
+    all_frames = chunks.counts(chunks.automatic)
+    (road_frames, mirror_frames, dashboard_frames, hud_frames), other_frames = category_counts(
+        chunks, chunks.automatic, (ROAD, MIRRORS, DASHBOARD, HUD)
+    )
+    return {
+        'TOR_MIRRORS': shares(mirror_frames, all_frames),
+        'TOR_ROAD': shares(road_frames, all_frames),
+        'TOR_DASHBOARD': shares(dashboard_frames, all_frames),
+        'TOR_HUD': shares(hud_frames, all_frames),
+        'TOR_OTHER_OR_UNDEFINED': shares(other_frames, all_frames),
+    }
+
+# Situational awareness in windows after TO, the first 5 seconds by default
+# windows is a list of (column suffix, (start, end) in seconds)
+def after_tor(chunks, windows=(('', default_window),), thresholds=default_thresholds):
+    # Comparisons with nan are False, so frames without a value aren't counted, like count() did
+    sums = WindowSums(chunks, chunks.manual, {
+        'speeding': chunks.speed > chunks.speed_limit * thresholds['speeding_factor'],
+        'acc': chunks.acceleration > thresholds['acceleration'],
+        'dcc': chunks.acceleration < thresholds['deceleration'],
+        'acc_y': np.abs(chunks.acceleration_y) > thresholds['lateral_acceleration'],
+    })
+    columns = {}
+    for suffix, window in windows:
+        start, end = window_frames(window)
+        all_frames = sums.frames(start, end)
+        columns['TOR_SPEEDING' + suffix] = shares(sums.counts('speeding', start, end), all_frames)
+        columns['TOR_ACC' + suffix] = shares(sums.counts('acc', start, end), all_frames)
+        columns['TOR_DCC' + suffix] = shares(sums.counts('dcc', start, end), all_frames)
+        columns['TOR_ACC_Y' + suffix] = shares(sums.counts('acc_y', start, end), all_frames)
+    return columns
+
+# @ GRADING @ #
+# User of every session and if it had the HUD, from file names like user_151_s1.csv
+def session_users(sessions):
+    scenarios = [user.split('_s', 1) for user, _ in sessions]
+    for (user, _), scenario in zip(sessions, scenarios):
+        if scenario[-1] not in ('1.csv', '3.csv'):
+            raise ValueError(f'{user} is not a scenario with or without HUD')
+    users = np.array([scenario[0] for scenario in scenarios], dtype=object)
+    huds = np.array([scenario[-1] == '1.csv' for scenario in scenarios], dtype=bool)
+    return users, huds
+
+# Chunks with an ADL request start in MANUAL, chunks with a TOR in AUTOMATIC
+def request_types(chunks):
+    return chunks.first_mode == 'MANUAL', chunks.first_mode == 'AUTOMATIC'
+
+# Grade every chunk of every session at once, sessions is a list of (file name, dataframe) and the rows come out
+# in that order, a row per chunk
+# windows are extra (start, end) windows in seconds after ADL and TO, each one adds its own columns
+def grade_sessions(sessions, windows=(), thresholds=default_thresholds):
+    chunks = Chunks(frame_table(sessions))
 
     # ! Do something with files that have more than 8 chunks (0-7)
-    num_of_chunks = df['CHUNK'].tail(1).values[0]
-    if num_of_chunks != 7:
-        print(user, str(num_of_chunks))
-
-    # Separate dataframe by chunks
-    chunks = df.groupby('CHUNK')
+    # The number of chunks is the CHUNK of the last row of a file
+    num_of_chunks = np.zeros(len(sessions), dtype=np.int64)
+    for i, (user, df) in enumerate(sessions):
+        if len(df) == 0:
+            continue
+        num_of_chunks[i] = df['CHUNK'].iloc[-1]
+        if num_of_chunks[i] != 7:
+            print(user, str(num_of_chunks[i]))
+
+    users, huds = session_users(sessions)
+
+    # ADL request is present when the chunk starts in MANUAL, TOR when it starts in AUTOMATIC,
+    # the columns of the other one are filled with empty
+    is_adl, is_tor = request_types(chunks)
+    session = chunks.chunk_session
+    columns = {
+        'USER': users[session],
+        'HUD': huds[session],
+        'REQUEST_TYPE': np.where(is_adl, 'AUTO_DRIVE', np.where(is_tor, 'TAKE_OVER', '-')),
+        # ! FIX later
+        'ADL_FAIL': num_of_chunks[session] != 7,
+    }
+    windows = [('', default_window)] + [(window_suffix(window), window) for window in windows]
+    metrics = (
+        (check_adl_switch(chunks, thresholds), is_adl),
+        (adl_looking(chunks, windows), is_adl),
+        (tor_looking(chunks), is_tor),
+        (tor_reaction(chunks, thresholds), is_tor),
+        (after_tor(chunks, windows, thresholds), is_tor),
+    )
+    for metric_columns, applies in metrics:
+        for column, values in metric_columns.items():
+            columns[column] = np.where(applies, np.asarray(values).astype(object), '-')
+
+    # Lists of python values, so the columns get the same types as when they were appended one by one
+    output_columns = grading_columns + window_columns([window for _, window in windows[1:]])
+    return pd.DataFrame.from_dict({column: columns[column].tolist() for column in output_columns})
+
+# @ THRESHOLD SWEEP @ #
+# Number of frames of every chunk where mask is set with a value over each of the thresholds, a row per chunk
+# and a column per threshold. The values are sorted by chunk once, after that every threshold is a binary search
+# per chunk. Frames without a value are left out, a comparison with nan is False
+def counts_over(chunks, mask, values, thresholds):
+    mask = mask & ~np.isnan(values)
+    group, values = chunks.group[mask], values[mask]
+    levels = np.unique(values)
+    # Every frame as the number of its chunk followed by the position of its value among all of the values,
+    # sorted these are the frames sorted by chunk and value
+    stride = len(levels) + 1
+    keys = np.sort(group * stride + np.searchsorted(levels, values))
+    bases = np.arange(chunks.count)[:, None] * stride
+    not_over = np.searchsorted(keys, bases + np.searchsorted(levels, thresholds, side='right')[None, :]) - np.searchsorted(keys, bases)
+    return np.bincount(group, minlength=chunks.count)[:, None] - not_over
+
+# Number of frames of every chunk where mask is set and the speed is over the speed limit times each of the factors,
+# a row per chunk and a column per factor. The speeding depends on two values per frame, so every factor is compared
+# the way after_tor does it, speed / speed_limit > factor rounds differently, e.g. at 44 with a speed limit of 40
+def speeding_counts(chunks, mask, factors):
+    counts = np.zeros((chunks.count, len(factors)), dtype=np.int64)
+    for i, factor in enumerate(factors):
+        counts[:, i] = chunks.counts(mask & (chunks.speed > chunks.speed_limit * factor))
+    return counts
+
+# Grade every combination of the threshold values in grid, a dict of threshold names and their values, the ones
+# that aren't in it keep their default. Every value of a threshold is evaluated once for all chunks and the
+# combinations only pick their columns, so a big grid costs little more than its distinct values
+# Returns a row per parameter set and chunk, indexed by PARAMETER_SET, with the values of the thresholds and
+# threshold_columns, empty where a column doesn't apply to the chunk
+def sweep_thresholds(sessions, grid, window=default_window):
+    unknown = set(grid) - set(default_thresholds)
+    if unknown:
+        raise ValueError(f'Unknown thresholds {", ".join(sorted(unknown))}, pick from {", ".join(default_thresholds)}')
+    values = {name: np.unique(np.asarray(grid.get(name, [default]), dtype=np.float64)) for name, default in default_thresholds.items()}
+    # Position of the value of every threshold in every parameter set
+    sets = np.array(list(itertools.product(*(range(len(v)) for v in values.values()))), dtype=np.int64)
+    picks = dict(zip(values, sets.T))
+    num_of_sets = len(sets)
+
+    chunks = Chunks(frame_table(sessions))
+    users, huds = session_users(sessions)
+    is_adl, is_tor = request_types(chunks)
+
+    # Every value of a threshold for all chunks, a row per chunk and a column per value
+    under_threshold = chunks.counts(chunks.manual)[:, None] < values['adl_seconds'][None, :] * FPS
+    start, end = window_frames(window)
+    ranks = chunks.ranks(chunks.manual)
+    window = chunks.manual & (ranks >= start) & (ranks < end)
+    all_frames = chunks.counts(window)[:, None]
+    speeding = shares(speeding_counts(chunks, window, values['speeding_factor']), all_frames)
+    acc = shares(counts_over(chunks, window, chunks.acceleration, values['acceleration']), all_frames)
+    # Under a threshold is over its negative
+    dcc = shares(counts_over(chunks, window, -chunks.acceleration, -values['deceleration']), all_frames)
+    acc_y = shares(counts_over(chunks, window, np.abs(chunks.acceleration_y), values['lateral_acceleration']), all_frames)
+
+    # The columns of every parameter set, a row per parameter set and a column per chunk
+    def pick(per_value, name):
+        return per_value[:, picks[name]].T
+    responses_of_sets = responses(
+        reaction_times(chunks)[None, :],
+        values['visual_seconds'][picks['visual_seconds']][:, None],
+        values['auditory_seconds'][picks['auditory_seconds']][:, None],
+    )
+    adl = np.broadcast_to(is_adl, (num_of_sets, chunks.count))
+    tor = np.broadcast_to(is_tor, (num_of_sets, chunks.count))
+
+    columns = {'PARAMETER_SET': np.repeat(np.arange(num_of_sets), chunks.count)}
+    for name in values:
+        columns[name] = np.repeat(values[name][picks[name]], chunks.count)
+    columns['USER'] = np.tile(users[chunks.chunk_session], num_of_sets)
+    columns['HUD'] = np.tile(huds[chunks.chunk_session], num_of_sets)
+    columns['CHUNK'] = np.tile(chunks.chunk_number, num_of_sets)
+    columns['REQUEST_TYPE'] = np.tile(np.where(is_adl, 'AUTO_DRIVE', np.where(is_tor, 'TAKE_OVER', None)), num_of_sets)
+    columns['ADL_UNDER_THRESHOLD'] = pd.arrays.BooleanArray(pick(under_threshold, 'adl_seconds').ravel(), ~adl.ravel())
+    columns['TOR_RESPONSE'] = np.where(tor, responses_of_sets, None).ravel()
+    for column, per_value, name in (
+        ('TOR_SPEEDING', speeding, 'speeding_factor'),
+        ('TOR_ACC', acc, 'acceleration'),
+        ('TOR_DCC', dcc, 'deceleration'),
+        ('TOR_ACC_Y', acc_y, 'lateral_acceleration'),
+    ):
+        columns[column] = np.where(tor, pick(per_value, name), np.nan).ravel()
+    return pd.DataFrame(columns).set_index('PARAMETER_SET')
+
+# Threshold values are given as NAME=VALUE,VALUE,... e.g. speeding_factor=1.05,1.10,1.15
+def parse_sweep(text):
+    name, _, values = text.partition('=')
+    if name not in default_thresholds:
+        raise argparse.ArgumentTypeError(f'{name} is not a threshold, pick from {", ".join(default_thresholds)}')
+    try:
+        return name, [float(value) for value in values.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'{text} has a value that is not a number')
 
-    for chunk_num, chunk in chunks:
-        # Add user to df
-        data['USER'].append(scenario[0])
+post_video_anaylsis_dir = '../post_analysis/video_analysis'
 
-        # Determine if user has HUD
-        if scenario[-1] == '1.csv':
-            data['HUD'].append(True)
-        elif scenario[-1] == '3.csv':
-            data['HUD'].append(False)
+# Every .csv file of the results directory, sorted by name
+def read_sessions(results_dir):
+    return [
+        (user, read_session(os.path.join(results_dir, user)))
+        for user in sorted(os.listdir(results_dir))
+        # Skip if not .csv
+        if user.split('.', 1)[-1] == 'csv'
+    ]
+
+# @ INCREMENTAL GRADING @ #
+# Everything the graded rows depend on besides the results files, the code of the grading included
+def grading_config(windows, thresholds):
+    return {
+        'fps': FPS,
+        'windows': [list(window) for window in windows],
+        'thresholds': thresholds,
+        'objects': object_names,
+        'code': file_hash(os.path.abspath(__file__)),
+    }
+
+# Grade the .csv files of results_dir like read_sessions and grade_sessions do, but only the sessions whose results
+# or grading settings changed since the last run are graded, the rows of the others come from the grading cache
+# Returns the rows as text and the number of sessions that were graded
+def grade_incrementally(results_dir, windows=(), thresholds=default_thresholds, force=False):
+    names = sorted(user for user in os.listdir(results_dir) if user.split('.', 1)[-1] == 'csv')
+    sources = {name: file_hash(os.path.join(results_dir, name)) for name in names}
+    cache = GradingCache(grading_config(windows, thresholds))
+    stale = names if force else cache.stale(sources)
+
+    if stale:
+        sessions = [(name, read_session(os.path.join(results_dir, name))) for name in stale]
+        graded = grade_sessions(sessions, windows, thresholds)
+        # A row per chunk, the rows of a session follow each other
+        ends = np.cumsum([df['CHUNK'].nunique() for _, df in sessions])
+        for (name, _), start, end in zip(sessions, ends - np.diff(np.r_[0, ends]), ends):
+            cache.write(name, sources[name], graded.iloc[start:end])
+    cache.prune(names)
+    cache.save()
+
+    if not names:
+        return pd.DataFrame(columns=grading_columns + window_columns(windows)), 0
+    return pd.concat([cache.read(name) for name in names], ignore_index=True), len(stale)
 
-        # ! FIX later
-        data['ADL_FAIL'].append(num_of_chunks != 7)
-
-        driving_mode = chunk.head(1)['DRIVING_MODE'].values # First row of a chunk
-        if driving_mode == 'MANUAL':
-            data['REQUEST_TYPE'].append('AUTO_DRIVE')
-            fill_empty_tor() # ADL request is present, fill all TOR columns with empty
-            check_adl_switch(chunk) # Check if user switched to AUTOMATIC in under 5s
-            adl_looking(chunk) # Calculate % of looked at objects after ADL
-        elif driving_mode == 'AUTOMATIC':
-            data['REQUEST_TYPE'].append('TAKE_OVER')
-            fill_empty_adl() # TOR is present, fill all ADL colimns with empty
-            tor_looking(chunk) # Calculate % of looked at objects before TO
-            tor_reaction(chunk) # Determine reaction time and type
-            after_tor(chunk) # Situational awareness after TO
-
-grading_data_path = '../post_analysis/grading'
-if not os.path.exists(grading_data_path):
-    os.mkdir(grading_data_path)
-
-# Iterate through the dictionary and get the lengths of each list
-for key, value in data.items():
-    print("Length of list in key '{}': {}".format(key, len(value)))
-
-res = pd.DataFrame.from_dict(data)
-res.to_csv(f'{grading_data_path}/grading_data.csv', sep=';')
\ No newline at end of file
+# @ MAIN LOOP @ #
+if __name__ == '__main__':
+    # Check for argv
+    parser = argparse.ArgumentParser(description='Grade every chunk of the video analysis results')
+    parser.add_argument('--windows', nargs='+', type=parse_window, default=[], metavar='START-END',
+                        help='extra windows in seconds after ADL and TO, e.g. 0-2 5-10, each one adds its own columns')
+    parser.add_argument('--sweep', nargs='+', type=parse_sweep, default=[], metavar='NAME=VALUES',
+                        help='grade every combination of these threshold values into threshold_sweep.csv instead, '
+                             f'e.g. speeding_factor=1.05,1.10 acceleration=0.5,1.0, thresholds: {", ".join(default_thresholds)}')
+    parser.add_argument('--force', action='store_true', help='grade every session again instead of using the grading cache')
+    args = parser.parse_args()
+
+    grading_data_path = '../post_analysis/grading'
+    if not os.path.exists(grading_data_path):
+        os.mkdir(grading_data_path)
+
+    if args.sweep:
+        sweep = sweep_thresholds(read_sessions(post_video_anaylsis_dir), dict(args.sweep))
+        sweep.to_csv(f'{grading_data_path}/threshold_sweep.csv', sep=';')
+        print(f'{sweep.index.nunique()} parameter sets written into {grading_data_path}/threshold_sweep.csv')
+        exit(0)
+
+    res, graded = grade_incrementally(post_video_anaylsis_dir, args.windows, force=args.force)
+    print(f'{graded} sessions graded, the rest came from the grading cache')
+
+    # Iterate through the columns and get the lengths of each one
+    for key in res.columns:
+        print("Length of list in key '{}': {}".format(key, len(res[key])))
+
+    res.to_csv(f'{grading_data_path}/grading_data.csv', sep=';')
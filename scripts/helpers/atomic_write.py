@@ -0,0 +1,23 @@
+import os
+import numpy as np
+
+# Write a file in one step, writer is called with a temporary path next to it and has to write the whole file there
+# The temporary file is only moved into place once it's complete, so an interrupted write never leaves a broken file
+# and processes writing the same file can't interleave their writes, a failed write is removed
+def atomic_write(path, writer):
+    partial_path = f'{path}.{os.getpid()}.partial'
+    try:
+        writer(partial_path)
+        os.replace(partial_path, path)
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+
+# np.save and np.savez add their extension to a path without it, so the writers give them an open file instead
+def write_npy(path, array):
+    with open(path, 'wb') as file:
+        np.save(file, array)
+
+def write_npz(path, arrays):
+    with open(path, 'wb') as file:
+        np.savez(file, **arrays)
@@ -0,0 +1,168 @@
+import numpy as np
+
+# Labels below this confidence are ignored
+min_confidence = 0.5
+
+# Map normalized coordinates to pixels the way int(x * width) does for a single value
+# The product is computed in the same type a scalar multiplication would give, so the rounding is the same
+def to_pixels(values, size):
+    scalar_type = type(values.dtype.type(0) * size)
+    return (values.astype(scalar_type) * size).astype(np.int64)
+
+# Position of every row inside its own frame, the rows of one frame follow each other
+def positions_in_frames(counts):
+    starts = np.cumsum(counts) - counts
+    return np.arange(counts.sum()) - np.repeat(starts, counts), starts
+
+# @ ATTRIBUTION @ #
+# Find the objects the driver is looking at in a whole batch of frames at once
+# detections holds (labels, cord_thres) per frame, the labels of all frames are put into flat arrays and
+# the view_marker overlaps and mirror names are computed for all of them together
+# view_marker_indexes can set the index of the correct view_marker per frame, -1 keeps the first one
+# Returns (frame_labels, looked_at_objects, looking_at_object) per frame, frame_labels holds the arrays of
+# the labels of that frame, 'shown' marks the ones to draw
+def attribute_batch(detections, width, height, label_names, view_marker_indexes=None):
+    names = np.array(label_names, dtype=object)
+    is_view_marker_label = names == 'view_marker'
+    is_mirror_label = names == 'mirror'
+    is_marker_label = names == 'marker'
+
+    frames = len(detections)
+    labels = np.concatenate([labels for labels, _ in detections])
+    cord_thres = np.concatenate([cord_thres for _, cord_thres in detections])
+    frame_of = np.repeat(np.arange(frames), [len(labels) for labels, _ in detections])
+    index, _ = positions_in_frames(np.bincount(frame_of, minlength=frames))
+
+    # Keep the confident labels, comparing with < keeps the same labels the per-frame check did
+    keep = ~(cord_thres[:, 4] < min_confidence)
+    frame_of = frame_of[keep]
+    index = index[keep]
+    classes = labels[keep].astype(np.int64)
+    cord_thres = cord_thres[keep]
+    counts = np.bincount(frame_of, minlength=frames)
+    position, starts = positions_in_frames(counts)
+
+    x1 = to_pixels(cord_thres[:, 0], width)
+    y1 = to_pixels(cord_thres[:, 1], height)
+    x2 = to_pixels(cord_thres[:, 2], width)
+    y2 = to_pixels(cord_thres[:, 3], height)
+    center_x = np.trunc((x1 + x2) / 2).astype(np.int64)
+    center_y = np.trunc((y1 + y2) / 2).astype(np.int64)
+    name = names[classes]
+    is_view_marker = is_view_marker_label[classes]
+
+    # View markers, the first one in a frame is used unless another one was picked
+    view_marker_index = np.full(frames, -1, dtype=np.int64)
+    view_marker_rows = np.flatnonzero(is_view_marker)
+    view_marker_frames, first = np.unique(frame_of[view_marker_rows], return_index=True)
+    view_marker_index[view_marker_frames] = index[view_marker_rows[first]]
+    if view_marker_indexes is not None:
+        view_marker_index = np.where(np.asarray(view_marker_indexes) >= 0, view_marker_indexes, view_marker_index)
+
+    # The index of the view_marker counts among the confident labels, as labels_in_frame[view_marker_index] did,
+    # the model sorts its results by confidence so that's the view_marker itself
+    has_view_marker = view_marker_index >= 0
+    if np.any(view_marker_index[has_view_marker] >= counts[has_view_marker]):
+        raise IndexError('view_marker index out of range of the labels in frame')
+    view_marker_row = starts + view_marker_index
+    is_chosen = np.zeros(len(classes), dtype=bool)
+    is_chosen[view_marker_row[has_view_marker]] = True
+
+    # Mirrors, sorted by their center x-coordinate per frame, equal ones stay in their order
+    mirror_rows = np.flatnonzero(is_mirror_label[classes])
+    mirror_rows = mirror_rows[np.lexsort((position[mirror_rows], center_x[mirror_rows], frame_of[mirror_rows]))]
+    mirror_frames = frame_of[mirror_rows]
+    is_first = np.r_[True, mirror_frames[1:] != mirror_frames[:-1]] if len(mirror_rows) else np.zeros(0, dtype=bool)
+    is_last = np.r_[mirror_frames[1:] != mirror_frames[:-1], True] if len(mirror_rows) else np.zeros(0, dtype=bool)
+    group = np.cumsum(is_first) - 1
+    left_x = center_x[mirror_rows[is_first]][group]
+    right_x = center_x[mirror_rows[is_last]][group]
+    # The rear-view mirror is the first one between the left and right mirrors
+    mirror_x = center_x[mirror_rows]
+    is_between = ~is_first & ~is_last & (left_x < mirror_x) & (mirror_x < right_x)
+    _, first_between = np.unique(group[is_between], return_index=True)
+
+    # A single mirror is both the left and the right one, it ends up as the right mirror
+    name[mirror_rows[is_first]] = 'left_mirror'
+    name[mirror_rows[is_last]] = 'right_mirror'
+    name[mirror_rows[is_between][first_between]] = 'rearview_mirror'
+
+    # Change the name of 'marker' to 'road'
+    name[is_marker_label[classes]] = 'road'
+
+    # Checking for intersections with the view_marker, duplicate view_markers are skipped
+    tested = np.flatnonzero(has_view_marker[frame_of] & ~is_view_marker)
+    marker = view_marker_row[frame_of[tested]]
+    intersects = (
+        (x1[marker] <= x2[tested]) & (x1[tested] <= x2[marker]) &
+        (y1[marker] <= y2[tested]) & (y1[tested] <= y2[marker])
+    )
+    looked_at = tested[intersects]
+    looked_at_frame = frame_of[looked_at]
+    looked_at_names = name[looked_at]
+
+    # All of the looked at objects of a frame separated by a coma, and the last one of them
+    looked_at_objects = [''] * frames
+    looking_at_object = [''] * frames
+    bounds = np.searchsorted(looked_at_frame, np.arange(frames + 1))
+    for f in np.flatnonzero(bounds[1:] > bounds[:-1]):
+        frame_names = looked_at_names[bounds[f]:bounds[f + 1]]
+        looked_at_objects[f] = ''.join(f'{n},' for n in frame_names)
+        looking_at_object[f] = str(frame_names[-1])
+
+    columns = {
+        'index': index,
+        'class': classes,
+        'name': name,
+        'x1': x1,
+        'y1': y1,
+        'x2': x2,
+        'y2': y2,
+        'center_x': center_x,
+        'center_y': center_y,
+        'is_view_marker': is_view_marker,
+        'shown': ~is_view_marker | is_chosen,
+    }
+    results = []
+    for f in range(frames):
+        rows = slice(starts[f], starts[f] + counts[f])
+        frame_labels = {column: values[rows] for column, values in columns.items()}
+        results.append((frame_labels, looked_at_objects[f], looking_at_object[f]))
+    return results
+
+# How much a view_marker loses against the others for every frame width it moved away from the view_marker
+# of the previous frame, a jump of a tenth of the frame costs as much as 0.5 of confidence
+continuity_weight = 5.0
+
+# @ VIEW MARKER RESOLVER @ #
+# Picks the view_marker of a frame with more than one, without asking
+# Every confident view_marker is scored by its confidence, minus the distance to the view_marker picked in the
+# previous frame of the same chunk, the marker of the driver's gaze doesn't jump around between frames
+# The frames have to be resolved in order
+class ViewMarkerResolver:
+    def __init__(self, label_names):
+        self.view_marker_label = label_names.index('view_marker')
+        # (chunk, position in the chunk, center) of the last picked view_marker
+        self.previous = None
+        self.ambiguous = 0
+
+    # Returns the index of the view_marker to use among the confident labels, the way attribute_batch counts it,
+    # -1 keeps the first one, and whether there was a choice to make
+    def resolve(self, index, fidx, labels, cord_thres):
+        keep = ~(cord_thres[:, 4] < min_confidence)
+        candidates = np.flatnonzero((labels == self.view_marker_label) & keep)
+        if len(candidates) == 0:
+            self.previous = None
+            return -1, False
+
+        centers = (cord_thres[candidates, :2] + cord_thres[candidates, 2:4]) / 2
+        scores = cord_thres[candidates, 4].astype(np.float64)
+        if self.previous is not None and self.previous[:2] == (index, fidx - 1):
+            scores = scores - continuity_weight * np.linalg.norm(centers - self.previous[2], axis=1)
+        best = int(np.argmax(scores))
+        self.previous = (index, fidx, centers[best])
+
+        if len(candidates) == 1:
+            return -1, False
+        self.ambiguous += 1
+        return int(np.count_nonzero(keep[:candidates[best]])), True
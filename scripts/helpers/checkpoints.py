@@ -0,0 +1,85 @@
+import os
+import json
+import shutil
+from helpers.atomic_write import atomic_write
+
+# File with the results of one finished chunk
+def chunk_file_path(checkpoints_dir, user, index):
+    return os.path.join(checkpoints_dir, user, f'chunk_{index:03d}.csv')
+
+# @ CHECKPOINTS @ #
+# The results of every finished chunk are written into their own file right away, next to a manifest with
+# the finished chunks and the signature of everything the results depend on
+# A rerun with the same signature skips the finished chunks, with a different one it starts over
+class SessionCheckpoint:
+    def __init__(self, checkpoints_dir, user, signature):
+        self.checkpoints_dir = checkpoints_dir
+        self.user = user
+        self.dir = os.path.join(checkpoints_dir, user)
+        self.manifest_path = os.path.join(self.dir, 'manifest.json')
+        # Compared with the one read from the manifest, so it has to look the same after a round trip through json
+        self.signature = json.loads(json.dumps(signature))
+        # Number of rows of every finished chunk
+        self.chunks = {}
+        self.complete = False
+        self.load()
+
+    def load(self):
+        if not os.path.isfile(self.manifest_path):
+            return
+        with open(self.manifest_path, 'r') as file:
+            manifest = json.load(file)
+        if manifest['signature'] != self.signature:
+            self.clear()
+            return
+        self.chunks = {int(index): rows for index, rows in manifest['chunks'].items()}
+        self.complete = manifest['complete']
+
+    # Start over, the files of the earlier run are removed
+    def clear(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+        self.chunks = {}
+        self.complete = False
+
+    def is_done(self, index):
+        return index in self.chunks
+
+    def chunk_path(self, index):
+        return chunk_file_path(self.checkpoints_dir, self.user, index)
+
+    # df holds the rows of the final .csv file for one chunk
+    def write_chunk(self, index, df):
+        os.makedirs(self.dir, exist_ok=True)
+        atomic_write(self.chunk_path(index), lambda path: df.to_csv(path, index=False, sep=';'))
+        self.chunks[index] = len(df)
+        self.save()
+
+    # Every chunk of the session is done
+    def finish(self):
+        self.complete = True
+        self.save()
+
+    def save(self):
+        os.makedirs(self.dir, exist_ok=True)
+        atomic_write(self.manifest_path, self.write_manifest)
+
+    def write_manifest(self, path):
+        with open(path, 'w') as file:
+            json.dump({'signature': self.signature, 'chunks': self.chunks, 'complete': self.complete}, file, indent=2)
+
+    # Put the finished chunks together into one .csv file, the header is only written once
+    # empty_df is written when there are no chunks
+    def assemble(self, export_path, empty_df):
+        if not self.chunks:
+            atomic_write(export_path, lambda path: empty_df.to_csv(path, index=False, sep=';'))
+        else:
+            atomic_write(export_path, self.write_chunks)
+
+    def write_chunks(self, path):
+        with open(path, 'wb') as export:
+            for i, index in enumerate(sorted(self.chunks)):
+                with open(self.chunk_path(index), 'rb') as file:
+                    header = file.readline()
+                    if i == 0:
+                        export.write(header)
+                    shutil.copyfileobj(file, export)
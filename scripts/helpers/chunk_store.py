@@ -0,0 +1,45 @@
+import os
+import numpy as np
+from helpers.atomic_write import atomic_write, write_npy
+
+# @ CHUNK STORE @ #
+# Binary alternative to the chunks_user_X_sY/chunk_N.csv directories
+# The whole resampled session is saved once as a structured numpy array, where row N holds FRAME N,
+# next to a small table with the (start, stop) frames of every chunk
+# Both files are memory-mapped when opened, so reading a chunk is a slice without any parsing or copying
+
+def store_paths(chunks_dir, session):
+    data_path = os.path.join(chunks_dir, f'chunks_{session}.npy')
+    offsets_path = os.path.join(chunks_dir, f'chunks_{session}.offsets.npy')
+    return data_path, offsets_path
+
+def store_exists(chunks_dir, session):
+    data_path, offsets_path = store_paths(chunks_dir, session)
+    return os.path.isfile(data_path) and os.path.isfile(offsets_path)
+
+# Write a session and its chunk table, each file is replaced in one step
+def write_chunk_store(chunks_dir, session, resampled_df, bounds):
+    data_path, offsets_path = store_paths(chunks_dir, session)
+
+    data = resampled_df.to_records(index=False)
+    offsets = np.array(bounds, dtype=np.int64).reshape(-1, 2)
+
+    for path, array in ((data_path, data), (offsets_path, offsets)):
+        atomic_write(path, lambda partial_path: write_npy(partial_path, array))
+
+def remove_chunk_store(chunks_dir, session):
+    for path in store_paths(chunks_dir, session):
+        if os.path.isfile(path):
+            os.remove(path)
+
+# Open a session without reading it, returns the memory-mapped data and chunk table
+def open_chunk_store(chunks_dir, session):
+    data_path, offsets_path = store_paths(chunks_dir, session)
+    data = np.load(data_path, mmap_mode='r')
+    offsets = np.load(offsets_path)
+    return data, offsets
+
+# A chunk is a view into the memory-mapped session, the columns are accessed as chunk['FRAME'] etc.
+def read_chunk(data, offsets, chunk_num):
+    start, stop = offsets[chunk_num]
+    return data[start:stop]
@@ -0,0 +1,100 @@
+import numpy as np
+import cv2
+
+# Lowest template match score of the view_marker, below it the tracking counts as lost
+min_match_score = 0.7
+
+# How far around its last position the view_marker is searched for, in sizes of the view_marker
+search_margin = 1.0
+
+# @ COCKPIT LAYOUT @ #
+# The mirrors, dashboard and the rest of the cockpit stay at the same place in the video, only the view_marker moves
+# The full model runs on keyframes and its labels are kept as the layout, in between only the view_marker
+# is found again by template matching around its last position and put into a copy of the layout
+# A new keyframe is taken every keyframe_interval frames, at the start of every chunk and whenever the view_marker is lost
+class CockpitLayout:
+    def __init__(self, label_names, keyframe_interval):
+        self.view_marker_label = label_names.index('view_marker')
+        self.keyframe_interval = keyframe_interval
+        self.chunk = None
+        self.keyframe_fidx = None
+        self.labels = None
+        self.cord_thres = None
+        # Row of the view_marker in the layout, its template and last position in pixels
+        self.marker_row = None
+        self.template = None
+        self.box = None
+        self.keyframes = 0
+        self.tracked = 0
+        self.lost = 0
+
+    def keyframe_due(self, index, fidx):
+        return (
+            self.template is None or
+            index != self.chunk or
+            fidx - self.keyframe_fidx >= self.keyframe_interval
+        )
+
+    # Keep the labels of a full detection as the new layout
+    def update(self, frame, index, fidx, labels, cord_thres):
+        self.chunk = index
+        self.keyframe_fidx = fidx
+        self.keyframes += 1
+
+        # Only the first view_marker is tracked, it's the one the analysis uses, the others are left out
+        view_marker_rows = np.flatnonzero(labels == self.view_marker_label)
+        keep = np.ones(len(labels), dtype=bool)
+        keep[view_marker_rows[1:]] = False
+        self.labels = labels[keep]
+        self.cord_thres = cord_thres[keep]
+
+        self.template = None
+        if len(view_marker_rows) == 0:
+            return
+        self.marker_row = int(np.count_nonzero(keep[:view_marker_rows[0]]))
+        height, width = frame.shape[:2]
+        x1, y1, x2, y2 = self.cord_thres[self.marker_row, :4]
+        x1, x2 = int(x1 * width), int(x2 * width)
+        y1, y2 = int(y1 * height), int(y2 * height)
+        if x2 - x1 < 2 or y2 - y1 < 2:
+            return
+        self.template = cv2.cvtColor(frame[y1:y2, x1:x2], cv2.COLOR_BGR2GRAY)
+        self.box = (x1, y1, x2, y2)
+
+    # Returns (labels, cord_thres) with the view_marker moved to where it's found, or None if it's lost
+    def locate(self, frame):
+        height, width = frame.shape[:2]
+        x1, y1, x2, y2 = self.box
+        margin = int(search_margin * max(x2 - x1, y2 - y1))
+        rx1, ry1 = max(x1 - margin, 0), max(y1 - margin, 0)
+        rx2, ry2 = min(x2 + margin, width), min(y2 + margin, height)
+        template_height, template_width = self.template.shape
+        if rx2 - rx1 < template_width or ry2 - ry1 < template_height:
+            self.lost += 1
+            return None
+
+        region = cv2.cvtColor(frame[ry1:ry2, rx1:rx2], cv2.COLOR_BGR2GRAY)
+        scores = cv2.matchTemplate(region, self.template, cv2.TM_CCOEFF_NORMED)
+        _, score, _, (dx, dy) = cv2.minMaxLoc(scores)
+        if not score >= min_match_score:
+            self.lost += 1
+            return None
+
+        x1, y1 = rx1 + dx, ry1 + dy
+        self.box = (x1, y1, x1 + template_width, y1 + template_height)
+        self.tracked += 1
+
+        # The middle of the pixel, so mapping it back to pixels gives the same pixel
+        cord_thres = self.cord_thres.copy()
+        cord_thres[self.marker_row, :4] = [
+            (x1 + 0.5) / width,
+            (y1 + 0.5) / height,
+            (x1 + template_width + 0.5) / width,
+            (y1 + template_height + 0.5) / height,
+        ]
+        return self.labels, cord_thres
+
+    def report(self):
+        frames = self.keyframes + self.tracked
+        share = self.keyframes / frames if frames else 0.0
+        return f'layout: {self.keyframes} keyframes ({share:.1%} of frames, {self.lost} after losing the view_marker), {self.tracked} frames tracked'
@@ -0,0 +1,75 @@
+import os
+import threading
+import numpy as np
+from helpers.file_hash import file_hash
+from helpers.atomic_write import atomic_write, write_npz
+
+# Directory with the cached detections
+cache_dir = '../post_analysis/detection_cache'
+
+# Hash of the model file, a different model gets a separate cache
+def model_hash(model_path):
+    return file_hash(model_path)[:16]
+
+def video_signature(video_path):
+    stat = os.stat(video_path)
+    return stat.st_mtime_ns, stat.st_size
+
+# @ DETECTION CACHE @ #
+# Raw model results of every analysed frame of one video, before any confidence cutoff or renaming,
+# so the analysis rules can be changed and replayed without running the model again
+# Saved as one .npz file per video and model with the rows of all frames in one array, x1, y1, x2, y2, confidence, class
+class DetectionCache:
+    def __init__(self, video_path, model_key):
+        video_name = os.path.splitext(os.path.basename(video_path))[0]
+        self.path = os.path.join(cache_dir, f'{video_name}.{model_key}.npz')
+        self.signature = video_signature(video_path)
+        self.detections = {}
+        self.changed = False
+        self.lock = threading.Lock()
+        self.load()
+
+    # Cached results are dropped if the video changed since
+    def load(self):
+        if not os.path.isfile(self.path):
+            return
+        with np.load(self.path) as cache:
+            if (int(cache['video_mtime_ns']), int(cache['video_size'])) != self.signature:
+                return
+            frames, offsets, rows = cache['frames'], cache['offsets'], cache['rows']
+        for i, f in enumerate(frames):
+            self.detections[int(f)] = rows[offsets[i]:offsets[i + 1]]
+
+    def __contains__(self, f):
+        return f in self.detections
+
+    # Returns (labels, cord_thres) like detect() does, or None if the frame isn't cached
+    def get(self, f):
+        rows = self.detections.get(f)
+        if rows is None:
+            return None
+        return rows[:, -1], rows[:, :-1]
+
+    def put(self, f, labels, cord_thres):
+        with self.lock:
+            self.detections[f] = np.column_stack((cord_thres, labels)).astype(np.float32)
+            self.changed = True
+
+    def save(self):
+        with self.lock:
+            if not self.changed:
+                return
+            frames = np.array(sorted(self.detections), dtype=np.int64)
+            counts = [len(self.detections[f]) for f in frames]
+            offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+            rows = np.concatenate([self.detections[f] for f in frames]) if len(frames) else np.empty((0, 6), np.float32)
+
+            os.makedirs(cache_dir, exist_ok=True)
+            atomic_write(self.path, lambda path: write_npz(path, dict(
+                video_mtime_ns=np.int64(self.signature[0]),
+                video_size=np.int64(self.signature[1]),
+                frames=frames,
+                offsets=offsets,
+                rows=rows
+            )))
+            self.changed = False
@@ -0,0 +1,241 @@
+import os
+import json
+from abc import ABC, abstractmethod
+import numpy as np
+import cv2
+import torch
+from helpers.detection_cache import model_hash
+
+# Path to the trained model
+model_path = '../yolo/best.pt'
+
+# Versions of the trained model exported with export.py of yolov5, for example
+# python3 export.py --weights best.pt --include torchscript onnx --imgsz 384 640
+torchscript_path = '../yolo/best.torchscript'
+onnx_path = '../yolo/best.onnx'
+
+# int8 version of best.onnx, written by calibrate_precision.py
+int8_onnx_path = '../yolo/best.int8.onnx'
+
+# Checkout of the yolov5 repository, the torch hub cache is used if it's missing
+yolov5_dir = '../yolo/yolov5'
+
+# @ MODEL @ #
+# hub loads yolov5 through torch hub (needs the network the first time), local loads it from a checkout or the
+# torch hub cache, torchscript and onnx run the exported model without the yolov5 code, onnx_int8 runs the
+# quantized one and is only used once calibrate_precision.py let it through
+backends = ['hub', 'local', 'torchscript', 'onnx', 'onnx_int8']
+
+# Longest side of the frames inside the hub model, a smaller size is faster but finds less
+default_image_size = 640
+
+# The same thresholds the hub model uses
+conf_thres = 0.25
+iou_thres = 0.45
+max_det = 1000
+max_nms = 30000
+max_wh = 7680
+
+# Every model is warmed up with a frame of this size once it's loaded, the first calls are always slower
+warmup_shape = (640, 640, 3)
+
+# File the detections of a backend depend on
+def backend_path(backend):
+    if backend == 'torchscript':
+        return torchscript_path
+    if backend == 'onnx':
+        return onnx_path
+    if backend == 'onnx_int8':
+        return int8_onnx_path
+    return model_path
+
+# Key of the detections a backend gives, the hash of its file and the image size if it isn't the default one
+def detections_key(backend, image_size=None):
+    key = model_hash(backend_path(backend))
+    if image_size is not None and image_size != default_image_size:
+        key = f'{key}_{image_size}'
+    return key
+
+# The image size only applies to the hub and local backends, the exported models have the size they were exported at
+def load_model(backend='hub', image_size=None):
+    if image_size is not None and backend not in ('hub', 'local'):
+        raise ValueError(f'The image size of the {backend} backend is set when exporting the model')
+    image_size = image_size or default_image_size
+
+    if backend == 'hub':
+        model = HubModel(torch.hub.load('ultralytics/yolov5', 'custom', path=model_path), image_size)
+    elif backend == 'local':
+        repo_dir = yolov5_dir
+        if not os.path.isdir(repo_dir):
+            repo_dir = os.path.join(torch.hub.get_dir(), 'ultralytics_yolov5_master')
+        if not os.path.isdir(repo_dir):
+            raise FileNotFoundError(f'No yolov5 code in {yolov5_dir} or in the torch hub cache, load the hub backend once first')
+        model = HubModel(torch.hub.load(repo_dir, 'custom', path=model_path, source='local'), image_size)
+    elif backend == 'torchscript':
+        model = TorchScriptModel(torchscript_path)
+    elif backend in ('onnx', 'onnx_int8'):
+        model = OnnxModel(backend_path(backend))
+    else:
+        raise ValueError(f'Unknown model backend {backend}, use one of {", ".join(backends)}')
+
+    model([np.zeros(warmup_shape, dtype=np.uint8)])
+    return model
+
+# Limit the threads torch uses for the inference, so parallel workers don't oversubscribe the cores
+def set_threads(threads):
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+
+# Run the model on a list of frames at once
+# Returns (labels, cord_thres) for every frame, the same arrays as the single frame
+# results.xyxyn[0][:, -1] and results.xyxyn[0][:, :-1]
+def detect(model, frames):
+    return [(xyxyn[:, -1], xyxyn[:, :-1]) for xyxyn in model(frames)]
+
+# Group any iterable into lists of batch_size items, the last one can be shorter
+def iterate_batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+# @ BACKENDS @ #
+# A backend is called with a list of frames and returns the x1, y1, x2, y2, confidence, class rows of every frame,
+# with the coordinates normalized to the frame size like results.xyxyn
+
+class HubModel:
+    def __init__(self, model, image_size=default_image_size):
+        self.model = model
+        self.image_size = image_size
+
+    def __call__(self, frames):
+        return [xyxyn.numpy() for xyxyn in self.model(frames, size=self.image_size).xyxyn]
+
+# Exported models take a fixed input size, frames are letterboxed into it and the NMS of the hub model
+# is done here, so the detections stay the same as long as the model was exported at the size the hub model
+# would pick for the video (384x640 for 16:9 frames)
+# The subclasses run the model itself in forward
+class ExportedModel(ABC):
+    def __init__(self, input_shape, batch_size):
+        # (height, width) of the model input
+        self.input_shape = input_shape
+        # Fixed number of frames per call, None if the model takes any number
+        self.batch_size = batch_size
+
+    # Raw predictions of the model for a batch in the model input layout, as a tensor
+    @abstractmethod
+    def forward(self, batch):
+        pass
+
+    def __call__(self, frames):
+        batch = prepare_batch(frames, self.input_shape)
+
+        # A model exported for a fixed batch gets the frames in batches of that size, the last one padded
+        if self.batch_size is None:
+            predictions = self.forward(batch)
+        else:
+            padded = -len(batch) % self.batch_size
+            batch = np.concatenate((batch, np.zeros((padded,) + batch.shape[1:], dtype=batch.dtype)))
+            predictions = torch.cat([
+                self.forward(batch[i:i + self.batch_size]) for i in range(0, len(batch), self.batch_size)
+            ])[:len(frames)]
+
+        results = []
+        for frame, detections in zip(frames, non_max_suppression(predictions)):
+            height, width = frame.shape[:2]
+            detections[:, :4] = scale_boxes(self.input_shape, detections[:, :4], (height, width))
+            results.append((detections / torch.tensor([width, height, width, height, 1, 1])).numpy())
+        return results
+
+class TorchScriptModel(ExportedModel):
+    def __init__(self, path):
+        # export.py saves the input shape next to the model
+        extra_files = {'config.txt': ''}
+        self.model = torch.jit.load(path, map_location='cpu', _extra_files=extra_files)
+        self.model.eval()
+        shape = json.loads(extra_files['config.txt'])['shape']
+        super().__init__((shape[2], shape[3]), shape[0])
+
+    def forward(self, batch):
+        with torch.no_grad():
+            predictions = self.model(torch.from_numpy(batch))
+        return predictions[0] if isinstance(predictions, (list, tuple)) else predictions
+
+class OnnxModel(ExportedModel):
+    def __init__(self, path):
+        # ONNX Runtime is only needed for this backend
+        import onnxruntime
+        self.session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+        model_input = self.session.get_inputs()[0]
+        batch_size, _, height, width = model_input.shape
+        if not isinstance(height, int) or not isinstance(width, int):
+            raise ValueError(f'{path} has no fixed input size, export it again without --dynamic')
+        self.input_name = model_input.name
+        super().__init__((height, width), batch_size if isinstance(batch_size, int) else None)
+
+    def forward(self, batch):
+        return torch.from_numpy(self.session.run(None, {self.input_name: batch})[0])
+
+# @ PRE AND POST-PROCESSING @ #
+# The same steps the yolov5 hub model takes
+
+# Resize keeping the aspect ratio and pad the rest with gray
+def letterbox(frame, shape):
+    height, width = frame.shape[:2]
+    r = min(shape[0] / height, shape[1] / width)
+    new_width, new_height = int(round(width * r)), int(round(height * r))
+    dw, dh = (shape[1] - new_width) / 2, (shape[0] - new_height) / 2
+    if (width, height) != (new_width, new_height):
+        frame = cv2.resize(frame, (new_width, new_height), interpolation=cv2.INTER_LINEAR)
+    top, bottom = int(round(dh - 0.1)), int(round(dh + 0.1))
+    left, right = int(round(dw - 0.1)), int(round(dw + 0.1))
+    return cv2.copyMakeBorder(frame, top, bottom, left, right, cv2.BORDER_CONSTANT, value=(114, 114, 114))
+
+# Letterboxed frames as one float batch in the channels first layout of the model input
+def prepare_batch(frames, shape):
+    batch = np.stack([letterbox(frame, shape) for frame in frames])
+    return batch.transpose(0, 3, 1, 2).astype(np.float32) / 255
+
+# Map boxes from the letterboxed input back onto the frame
+def scale_boxes(input_shape, boxes, frame_shape):
+    gain = min(input_shape[0] / frame_shape[0], input_shape[1] / frame_shape[1])
+    pad_x = (input_shape[1] - frame_shape[1] * gain) / 2
+    pad_y = (input_shape[0] - frame_shape[0] * gain) / 2
+    boxes[:, [0, 2]] -= pad_x
+    boxes[:, [1, 3]] -= pad_y
+    boxes /= gain
+    boxes[:, [0, 2]] = boxes[:, [0, 2]].clamp(0, frame_shape[1])
+    boxes[:, [1, 3]] = boxes[:, [1, 3]].clamp(0, frame_shape[0])
+    return boxes
+
+# Returns the x1, y1, x2, y2, confidence, class rows of every frame, sorted by confidence
+def non_max_suppression(predictions):
+    # torchvision comes with yolov5
+    import torchvision
+
+    output = []
+    for x in predictions:
+        # Confidence is the object confidence times the class confidence
+        x = x[x[:, 4] > conf_thres]
+        x[:, 5:] *= x[:, 4:5]
+
+        # Center, width and height to corners
+        box = x[:, :4].clone()
+        box[:, 0] = x[:, 0] - x[:, 2] / 2
+        box[:, 1] = x[:, 1] - x[:, 3] / 2
+        box[:, 2] = x[:, 0] + x[:, 2] / 2
+        box[:, 3] = x[:, 1] + x[:, 3] / 2
+
+        conf, j = x[:, 5:].max(1, keepdim=True)
+        x = torch.cat((box, conf, j.float()), 1)[conf.view(-1) > conf_thres]
+        x = x[x[:, 4].argsort(descending=True)[:max_nms]]
+
+        # Boxes of different classes are moved apart, so they never suppress each other
+        offsets = x[:, 5:6] * max_wh
+        keep = torchvision.ops.nms(x[:, :4] + offsets, x[:, 4], iou_thres)[:max_det]
+        output.append(x[keep])
+    return output
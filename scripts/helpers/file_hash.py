@@ -0,0 +1,10 @@
+import hashlib
+
+# SHA-1 of the contents of a file, read in blocks of 1 MiB so big files don't have to fit into memory
+# Used by the caches to find out if a source file changed since it was last read
+def file_hash(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
@@ -0,0 +1,194 @@
+import json
+import subprocess
+import numpy as np
+import cv2
+
+# @ FRAME SOURCE @ #
+# Seeking in an H.264 video jumps to the previous keyframe and decodes up to the wanted frame,
+# so the requested frames are read in contiguous ranges with a single seek per range
+
+# Gaps of up to this many frames are decoded through with grab() instead of seeking again
+max_decode_gap = 10
+
+# Merge the sorted frame numbers into [first, last] ranges
+def frame_ranges(frame_numbers, max_gap=max_decode_gap):
+    ranges = []
+    for f in sorted(set(int(f) for f in frame_numbers)):
+        if ranges and f - ranges[-1][1] <= max_gap + 1:
+            ranges[-1][1] = f
+        else:
+            ranges.append([f, f])
+    return ranges
+
+# Yield (frame_number, frame) for every requested frame in ascending order, stops at the end of the video
+def read_frames(cap, frame_numbers, max_gap=max_decode_gap):
+    wanted = set(int(f) for f in frame_numbers)
+
+    for first, last in frame_ranges(wanted, max_gap):
+        cap.set(cv2.CAP_PROP_POS_FRAMES, first)
+        for f in range(first, last + 1):
+            if f in wanted:
+                ok, frame = cap.read()
+                if not ok:
+                    return
+                yield f, frame
+            # Frames in the gaps are only decoded, not converted into images
+            elif not cap.grab():
+                return
+
+# @ FFMPEG DECODER @ #
+# A local ffmpeg process decodes the video and crops and scales the frames on its side, the raw BGR frames are
+# read from its pipe straight into preallocated buffers
+ffmpeg_binary = 'ffmpeg'
+ffprobe_binary = 'ffprobe'
+
+# Decoders to pick from, opencv is cv2.VideoCapture
+decoders = ['opencv', 'ffmpeg']
+
+# Seeking forward up to this many frames decodes through them instead of starting ffmpeg again
+max_skip_frames = 250
+
+# Size, frame rate and frame count of the first video stream
+def probe_video(path):
+    output = subprocess.run(
+        [ffprobe_binary, '-v', 'error', '-select_streams', 'v:0', '-of', 'json',
+         '-show_entries', 'stream=width,height,r_frame_rate,avg_frame_rate,nb_frames', path],
+        capture_output=True, text=True, check=True
+    ).stdout
+    stream = json.loads(output)['streams'][0]
+    numerator, denominator = (int(x) for x in stream['r_frame_rate'].split('/'))
+    return {
+        'width': int(stream['width']),
+        'height': int(stream['height']),
+        'fps': numerator / denominator if denominator else 0.0,
+        # Seeking by time only finds the exact frame if every frame lasts the same
+        'constant_frame_rate': stream['r_frame_rate'] == stream.get('avg_frame_rate'),
+        'frame_count': int(stream['nb_frames']) if str(stream.get('nb_frames', '')).isdigit() else 0,
+    }
+
+# Works like cv2.VideoCapture for set/read/grab/get, so read_frames and the analysis don't see a difference
+# crop is (width, height, x, y) in pixels of the video and is done before the scaling to width, the height
+# keeps the aspect ratio
+# read() returns one of the buffers, they're reused in turn, so a frame is only valid until buffers more frames
+# have been read
+# The frame numbers are the same as cv2.VideoCapture's, with a constant frame rate ffmpeg seeks to half a frame
+# before the wanted one, otherwise it always decodes from the start of the video and counts the frames
+class FFmpegCapture:
+    def __init__(self, path, width=None, crop=None, buffers=1):
+        self.path = path
+        info = probe_video(path)
+        self.fps = info['fps']
+        self.frame_count = info['frame_count']
+        self.constant_frame_rate = info['constant_frame_rate']
+
+        self.width, self.height = info['width'], info['height']
+        self.filters = []
+        if crop is not None:
+            crop_width, crop_height, x, y = crop
+            self.filters.append(f'crop={crop_width}:{crop_height}:{x}:{y}')
+            self.width, self.height = crop_width, crop_height
+        if width is not None and width != self.width:
+            height = max(2 * round(self.height * width / self.width / 2), 2)
+            self.filters.append(f'scale={width}:{height}')
+            self.width, self.height = width, height
+
+        self.frame_bytes = self.width * self.height * 3
+        self.buffers = [np.empty((self.height, self.width, 3), dtype=np.uint8) for _ in range(max(buffers, 1))]
+        self.next_buffer = 0
+        self.process = None
+        # Number of the frame the next read() returns
+        self.pos = 0
+
+    def start(self):
+        target = self.pos
+        seek = self.constant_frame_rate and self.fps > 0 and target > 0
+        command = [ffmpeg_binary, '-v', 'error', '-nostdin']
+        if seek:
+            command += ['-ss', f'{(target - 0.5) / self.fps:.6f}']
+        command += ['-i', self.path, '-map', '0:v:0', '-an', '-sn', '-fps_mode', 'passthrough']
+        if self.filters:
+            command += ['-vf', ','.join(self.filters)]
+        command += ['-f', 'rawvideo', '-pix_fmt', 'bgr24', 'pipe:1']
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE, stdin=subprocess.DEVNULL)
+
+        self.pos = target if seek else 0
+        while self.pos < target:
+            if not self.grab():
+                return
+
+    def stop(self):
+        if self.process is not None:
+            self.process.stdout.close()
+            self.process.kill()
+            self.process.wait()
+            self.process = None
+
+    # Fill the buffer with the next frame of the pipe, False at the end of the video
+    def read_into(self, buffer):
+        if self.process is None:
+            self.start()
+        view = memoryview(buffer).cast('B')
+        filled = 0
+        while filled < self.frame_bytes:
+            n = self.process.stdout.readinto(view[filled:])
+            if not n:
+                self.stop()
+                return False
+            filled += n
+        self.pos += 1
+        return True
+
+    def read(self):
+        buffer = self.buffers[self.next_buffer]
+        if not self.read_into(buffer):
+            return False, None
+        self.next_buffer = (self.next_buffer + 1) % len(self.buffers)
+        return True, buffer
+
+    # The skipped frame goes into the buffer the next read() overwrites anyway
+    def grab(self):
+        return self.read_into(self.buffers[self.next_buffer])
+
+    def set(self, prop, value):
+        if prop != cv2.CAP_PROP_POS_FRAMES:
+            return False
+        f = int(value)
+        if self.process is not None and self.pos <= f <= self.pos + max_skip_frames:
+            while self.pos < f:
+                if not self.grab():
+                    return False
+            return True
+        # ffmpeg is started at the new position with the next read
+        self.stop()
+        self.pos = f
+        return True
+
+    def get(self, prop):
+        return {
+            cv2.CAP_PROP_FPS: self.fps,
+            cv2.CAP_PROP_FRAME_WIDTH: self.width,
+            cv2.CAP_PROP_FRAME_HEIGHT: self.height,
+            cv2.CAP_PROP_FRAME_COUNT: self.frame_count,
+            cv2.CAP_PROP_POS_FRAMES: self.pos,
+        }.get(prop, 0)
+
+    def isOpened(self):
+        return True
+
+    def release(self):
+        self.stop()
+
+# Open a video with one of the decoders, width and crop are only done by ffmpeg
+def open_video(path, decoder='opencv', width=None, crop=None, buffers=1):
+    if decoder == 'ffmpeg':
+        return FFmpegCapture(path, width, crop, buffers)
+    if width is not None or crop is not None:
+        raise ValueError('Scaling and cropping while decoding needs the ffmpeg decoder')
+    return cv2.VideoCapture(path)
+
+# W:H:X:Y of a --decode-crop argument
+def parse_crop(text):
+    crop = tuple(int(value) for value in text.split(':'))
+    if len(crop) != 4:
+        raise ValueError(f'{text} is not W:H:X:Y')
+    return crop
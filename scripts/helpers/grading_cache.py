@@ -0,0 +1,71 @@
+import os
+import json
+import hashlib
+import pandas as pd
+from helpers.atomic_write import atomic_write
+
+# Directory with the graded rows of every session
+cache_dir = '../post_analysis/grading/.cache'
+
+# Hash of the grading settings, any change of them grades every session again
+def config_hash(config):
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+# @ GRADING CACHE @ #
+# The graded rows of every session are kept in their own partition file, next to a manifest with the hash of the
+# results file each one was graded from and the hash of the grading settings
+# Only sessions whose results changed are graded again, the rows of the others are read from their partitions
+class GradingCache:
+    def __init__(self, config):
+        self.dir = cache_dir
+        self.manifest_path = os.path.join(cache_dir, 'manifest.json')
+        self.config = config_hash(config)
+        # Hash of the results file of every graded session
+        self.sessions = {}
+        self.load()
+
+    def load(self):
+        if not os.path.isfile(self.manifest_path):
+            return
+        with open(self.manifest_path, 'r') as file:
+            manifest = json.load(file)
+        # Partitions graded with other settings are all stale
+        if manifest['config'] == self.config:
+            self.sessions = manifest['sessions']
+
+    def partition_path(self, name):
+        return os.path.join(self.dir, name)
+
+    # Sessions that have to be graded again, sources holds the hash of the results file of every session
+    def stale(self, sources):
+        return [
+            name for name, sha1 in sources.items()
+            if self.sessions.get(name) != sha1 or not os.path.isfile(self.partition_path(name))
+        ]
+
+    # df holds the graded rows of one session
+    def write(self, name, sha1, df):
+        os.makedirs(self.dir, exist_ok=True)
+        atomic_write(self.partition_path(name), lambda partial_path: df.to_csv(partial_path, index=False, sep=';'))
+        self.sessions[name] = sha1
+
+    # Read as text, so the values are written into grading_data.csv exactly as they were graded
+    def read(self, name):
+        return pd.read_csv(self.partition_path(name), sep=';', dtype=str, keep_default_na=False)
+
+    # The partitions of sessions that aren't in names anymore are removed, also the ones left from other settings
+    def prune(self, names):
+        for name in set(self.sessions) - set(names):
+            del self.sessions[name]
+        if os.path.isdir(self.dir):
+            for name in os.listdir(self.dir):
+                if name.split('.', 1)[-1] == 'csv' and name not in self.sessions:
+                    os.remove(self.partition_path(name))
+
+    def save(self):
+        os.makedirs(self.dir, exist_ok=True)
+        atomic_write(self.manifest_path, self.write_manifest)
+
+    def write_manifest(self, path):
+        with open(path, 'w') as file:
+            json.dump({'config': self.config, 'sessions': self.sessions}, file, indent=2)
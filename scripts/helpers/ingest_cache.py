@@ -0,0 +1,183 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+from helpers.file_hash import file_hash
+from helpers.atomic_write import atomic_write
+
+# The multithreaded pyarrow csv reader is optional, pandas is used when it's not installed
+try:
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
+except ImportError:
+    pa_csv = None
+
+# Directory with the cached sessions
+cache_dir = '../post_analysis/ingest_cache'
+
+# Columns holding small integer codes, stored as int8
+small_int_columns = ['AUTO_DRIVE', 'INDICATORS']
+# Columns kept at full width, miliseconds don't fit into float32
+full_width_columns = ['TIMESTAMP']
+# Every other column is continuous and stored as float32
+
+# Rows parsed at once, only this much of a session is ever held in memory while it's ingested
+rows_per_block = 1000000
+# Bytes parsed at once by pyarrow, around as many rows as rows_per_block
+pyarrow_block_size = 64 << 20
+
+# @ SOURCE FILE @ #
+# Size and modification time of the raw csv, a cheap first check on every load
+def source_signature(csv_file):
+    stat = os.stat(csv_file)
+    return stat.st_mtime_ns, stat.st_size
+
+# Every session is a directory with one .npy file per column, next to a manifest with the source it was made from
+def cache_path(csv_file):
+    name = os.path.splitext(os.path.basename(csv_file))[0]
+    return os.path.join(cache_dir, name)
+
+def column_path(path, column):
+    return os.path.join(path, f'{column}.npy')
+
+def manifest_path(path):
+    return os.path.join(path, 'manifest.json')
+
+# @ READING THE CSV @ #
+# Type the values of a column are parsed into, small integer columns are only shrunk once all of them were seen
+def stream_dtype(name):
+    if name in full_width_columns or name in small_int_columns:
+        return np.float64
+    return np.float32
+
+# Type a column is stored as, small_ints tells if every value of a small integer column was a small integer
+def column_dtype(name, small_ints):
+    if name in small_int_columns:
+        return np.int8 if small_ints else np.float32
+    return stream_dtype(name)
+
+# A small integer column fits into int8 if all of its values are small integers
+def are_small_ints(values):
+    return bool(np.all(np.isfinite(values)) and np.all(values == np.round(values))
+                and (len(values) == 0 or (values.min() >= -128 and values.max() <= 127)))
+
+# The needed columns of a semicolon-delimited csv as numpy arrays, a block of rows at a time
+def iterate_csv_blocks(csv_file, columns):
+    if pa_csv is not None:
+        reader = pa_csv.open_csv(
+            csv_file,
+            read_options=pa_csv.ReadOptions(block_size=pyarrow_block_size),
+            parse_options=pa_csv.ParseOptions(delimiter=';'),
+            # Fixed types, otherwise every block after the first one has to look like the first one
+            convert_options=pa_csv.ConvertOptions(include_columns=columns, column_types={c: pa.float64() for c in columns})
+        )
+        for batch in reader:
+            yield {c: batch.column(c).to_numpy(zero_copy_only=False) for c in columns}
+        return
+
+    for chunk in pd.read_csv(csv_file, usecols=columns, chunksize=rows_per_block, delimiter=';', dtype=np.float64):
+        yield {c: chunk[c].to_numpy() for c in columns}
+
+# @ CACHE @ #
+# Write the parsed values of a column into its .npy file, values holds them as raw stream_dtype values
+def write_column(path, values, rows, dtype, stream):
+    with open(path, 'wb') as file, open(values, 'rb') as raw:
+        np.lib.format.write_array_header_1_0(file, {
+            'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+            'fortran_order': False,
+            'shape': (rows,),
+        })
+        while True:
+            block = np.fromfile(raw, dtype=stream, count=rows_per_block)
+            if len(block) == 0:
+                break
+            block.astype(dtype).tofile(file)
+
+# Convert a raw session into the cache and return its columns
+# The csv is parsed a block at a time and every block is appended to the files of its columns right away, so a
+# session never has to fit into memory. The manifest is written last, a cache without one is never loaded
+def ingest_session(csv_file, columns):
+    mtime_ns, size = source_signature(csv_file)
+    path = cache_path(csv_file)
+    os.makedirs(path, exist_ok=True)
+    if os.path.isfile(manifest_path(path)):
+        os.remove(manifest_path(path))
+    # Earlier versions kept the whole session in one .npz file
+    if os.path.isfile(f'{path}.npz'):
+        os.remove(f'{path}.npz')
+
+    values_paths = {c: os.path.join(path, f'{c}.{os.getpid()}.values') for c in columns}
+    try:
+        rows = 0
+        small_ints = {c: True for c in columns if c in small_int_columns}
+        values_files = {c: open(values_paths[c], 'wb') for c in columns}
+        try:
+            for block in iterate_csv_blocks(csv_file, columns):
+                for c in columns:
+                    values = block[c].astype(stream_dtype(c))
+                    if c in small_ints:
+                        small_ints[c] = small_ints[c] and are_small_ints(values)
+                    values.tofile(values_files[c])
+                rows += len(block[columns[0]])
+        finally:
+            for file in values_files.values():
+                file.close()
+
+        for c in columns:
+            dtype = column_dtype(c, small_ints.get(c, False) and rows > 0)
+            atomic_write(column_path(path, c), lambda partial_path: write_column(partial_path, values_paths[c], rows, dtype, stream_dtype(c)))
+    finally:
+        for values_path in values_paths.values():
+            if os.path.exists(values_path):
+                os.remove(values_path)
+
+    atomic_write(manifest_path(path), lambda partial_path: write_manifest(partial_path, {
+        'source_mtime_ns': mtime_ns,
+        'source_size': size,
+        'source_sha1': file_hash(csv_file),
+        'columns': columns,
+        'rows': rows,
+    }))
+    return open_columns(path, columns)
+
+def write_manifest(path, manifest):
+    with open(path, 'w') as file:
+        json.dump(manifest, file, indent=2)
+
+# The columns of a session memory-mapped, nothing is read until it's used
+def open_columns(path, columns):
+    return {c: np.load(column_path(path, c), mmap_mode='r') for c in columns}
+
+# Load the columns of a session from the cache, returns None if the cache is missing or stale
+# The size and modification time miss a file rewritten with the same size within the resolution of the modification
+# time, so the hash is compared too unless verify_hash is False, which trusts the first check and skips reading the file
+# Hashing reads the whole file, but that is still a lot faster than parsing it
+def load_session(csv_file, columns, verify_hash=True):
+    path = cache_path(csv_file)
+    if not os.path.isfile(manifest_path(path)):
+        return None
+
+    with open(manifest_path(path), 'r') as file:
+        manifest = json.load(file)
+    if any(c not in manifest['columns'] for c in columns):
+        return None
+    if (manifest['source_mtime_ns'], manifest['source_size']) != source_signature(csv_file):
+        return None
+    if verify_hash and manifest['source_sha1'] != file_hash(csv_file):
+        return None
+    return open_columns(path, columns)
+
+# Load a session from the cache, ingesting it first if needed
+def read_session(csv_file, columns, verify_hash=True):
+    arrays = load_session(csv_file, columns, verify_hash)
+    if arrays is None:
+        arrays = ingest_session(csv_file, columns)
+    return arrays
+
+# Same as iterating over pd.read_csv(..., chunksize=chunksize), but served from the cache
+# The columns are memory-mapped, only the rows of the current chunk are read
+def iterate_session(csv_file, columns, chunksize=1000000, verify_hash=True):
+    arrays = read_session(csv_file, columns, verify_hash)
+    total_rows = len(arrays[columns[0]])
+    for start in range(0, total_rows, chunksize):
+        yield pd.DataFrame({c: np.array(arrays[c][start:start + chunksize]) for c in columns})
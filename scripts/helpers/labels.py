@@ -0,0 +1,48 @@
+import os
+import numpy as np
+import pandas as pd
+
+# @ LABEL REGISTRY @ #
+# Names of the labels the model was trained on, in the order of their classes
+with open(os.path.join(os.path.dirname(__file__), 'labels.txt'), 'r') as file:
+    label_names = [line.split(' ')[0] for line in file.read().splitlines()]
+
+# Names the attribution gives to some of the labels, the mirrors by their position and 'marker' as 'road'
+attributed_names = ['left_mirror', 'right_mirror', 'rearview_mirror', 'road']
+
+# Every name SEEN_OBJECTS can hold gets its own bit, in this order
+object_names = label_names + [name for name in attributed_names if name not in label_names]
+object_bits = {name: 1 << i for i, name in enumerate(object_names)}
+
+# Bitmask with the bits of all of the names
+def objects_mask(*names):
+    mask = 0
+    for name in names:
+        mask |= object_bits[name]
+    return mask
+
+# Bitmask of comma separated names, like the SEEN_OBJECTS of older results, anything that isn't a name is left out
+def encode_seen_objects(text):
+    mask = 0
+    for name in str(text).split(','):
+        mask |= object_bits.get(name, 0)
+    return mask
+
+# Readable form of a bitmask, the names separated by a comma in the order of the registry
+def decode_seen_objects(mask):
+    return ''.join(f'{name},' for name, bit in object_bits.items() if int(mask) & bit)
+
+# SEEN_OBJECTS values as bitmasks, comma separated names are converted
+# There are only a few different combinations of objects, each one is only parsed once
+def seen_objects_masks(values):
+    values = np.asarray(values)
+    if values.dtype.kind in 'iu':
+        return values.astype(np.int64)
+    # Missing values are kept as nan, which isn't a name
+    inverse, uniques = pd.factorize(values.reshape(-1), use_na_sentinel=False)
+    return np.array([encode_seen_objects(text) for text in uniques], dtype=np.int64)[inverse]
+
+# A results file has bitmasks if every SEEN_OBJECTS value read as text is a number
+def is_mask_column(texts):
+    texts = np.asarray(texts, dtype=str)
+    return len(texts) > 0 and bool(np.char.isdigit(texts).all())
@@ -0,0 +1,96 @@
+import time
+import queue
+import threading
+
+# @ PIPELINE @ #
+# Stages run in their own threads and pass items to the next stage through bounded queues
+# A full queue blocks the stage in front of it, so a slow stage holds the others back instead of using up the memory
+
+# Put into a queue after the last item
+END = None
+
+# Throughput of one stage, only the time spent working is counted, not waiting on the queues
+class StageStats:
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.busy = 0.0
+        self.error = None
+
+    def add(self, items, seconds):
+        self.items += items
+        self.busy += seconds
+
+    def report(self):
+        rate = self.items / self.busy if self.busy > 0 else 0.0
+        return f'{self.name}: {self.items} frames in {self.busy:.2f}s busy, {rate:.1f} frames/s'
+
+def new_queue(size):
+    return queue.Queue(maxsize=size)
+
+def iterate_queue(inputs):
+    while True:
+        item = inputs.get()
+        if item is END:
+            return
+        yield item
+
+def start_thread(target, *args):
+    thread = threading.Thread(target=target, args=args, daemon=True)
+    thread.start()
+    return thread
+
+# First stage, puts everything the generator yields into the queue
+def run_source(generator, outputs, stats):
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(generator)
+            except StopIteration:
+                break
+            stats.add(1, time.perf_counter() - start)
+            outputs.put(item)
+    except Exception as e:
+        stats.error = e
+    finally:
+        outputs.put(END)
+
+# Collects up to batch_size items, work gets the whole list and returns one result per item
+def run_batched_stage(work, inputs, outputs, stats, batch_size):
+    try:
+        items = iterate_queue(inputs)
+        while True:
+            batch = []
+            for item in items:
+                batch.append(item)
+                if len(batch) == batch_size:
+                    break
+            if not batch:
+                break
+
+            start = time.perf_counter()
+            results = work(batch)
+            stats.add(len(batch), time.perf_counter() - start)
+
+            for result in results:
+                outputs.put(result)
+    except Exception as e:
+        stats.error = e
+        # Keep emptying the queue, so the stage in front of it doesn't block forever
+        for _ in iterate_queue(inputs):
+            pass
+    finally:
+        outputs.put(END)
+
+# Last stage, work is called for every item
+def run_sink(work, inputs, stats):
+    try:
+        for item in iterate_queue(inputs):
+            start = time.perf_counter()
+            work(item)
+            stats.add(1, time.perf_counter() - start)
+    except Exception as e:
+        stats.error = e
+        for _ in iterate_queue(inputs):
+            pass
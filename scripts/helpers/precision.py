@@ -0,0 +1,99 @@
+import os
+import json
+import numpy as np
+from helpers.attribution import min_confidence
+from helpers.detector import default_image_size, backend_path, detections_key, onnx_path, model_path
+from helpers.detection_cache import model_hash
+from helpers.atomic_write import atomic_write
+
+# Reduced precision setups that passed the accuracy gate of calibrate_precision.py
+approvals_path = '../yolo/reduced_precision.json'
+
+# Files a reduced precision model was made from, best.int8.onnx is quantized from best.onnx, which is exported from
+# best.pt. Their hashes are part of the key of an approval, so retraining or exporting the model again takes the
+# approval of an int8 file quantized from the old one away
+source_paths = {'onnx_int8': [onnx_path, model_path]}
+
+# Boxes of the same class overlapping at least this much count as the same detection
+match_iou = 0.5
+
+# int8 or a smaller image size trade accuracy for speed, everything else is the full fp32 model
+def is_reduced(backend, image_size=None):
+    return backend == 'onnx_int8' or (image_size is not None and image_size != default_image_size)
+
+# @ AGREEMENT @ #
+# Intersection over union of every box in a with every box in b
+def box_iou(a, b):
+    x1 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x2 = np.minimum(a[:, None, 2], b[None, :, 2])
+    y2 = np.minimum(a[:, None, 3], b[None, :, 3])
+    intersection = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - intersection
+    return np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+
+# Share of the confident detections both models found, as 2 * matched / (detections + reference detections)
+# Every reference box is matched with at most one box of the same class, the most confident ones go first
+def detection_agreement(detections, reference):
+    matched = 0
+    total = 0
+    for (labels, cord_thres), (ref_labels, ref_cord_thres) in zip(detections, reference):
+        keep = ~(cord_thres[:, 4] < min_confidence)
+        ref_keep = ~(ref_cord_thres[:, 4] < min_confidence)
+        labels, boxes = labels[keep], cord_thres[keep, :4]
+        ref_labels, ref_boxes = ref_labels[ref_keep], ref_cord_thres[ref_keep, :4]
+        total += len(labels) + len(ref_labels)
+
+        iou = box_iou(boxes.astype(np.float64), ref_boxes.astype(np.float64))
+        iou[labels[:, None] != ref_labels[None, :]] = 0
+        used = np.zeros(len(ref_labels), dtype=bool)
+        for i in range(len(labels)):
+            candidates = np.where(used, 0, iou[i])
+            if len(candidates) and candidates.max() >= match_iou:
+                used[np.argmax(candidates)] = True
+                matched += 1
+    return 2 * matched / total if total else 1.0
+
+# Share of the frames that get exactly the same looked at objects
+def seen_objects_agreement(seen_objects, reference):
+    if not reference:
+        return 1.0
+    return sum(a == b for a, b in zip(seen_objects, reference)) / len(reference)
+
+# @ APPROVALS @ #
+# Key of an approval, the key of the detections of the setup and the hashes of the files it was made from
+def approval_key(backend, image_size=None):
+    key = detections_key(backend, image_size)
+    for path in source_paths.get(backend, []):
+        key += f'_{model_hash(path) if os.path.isfile(path) else "missing"}'
+    return key
+
+def read_approvals():
+    if not os.path.isfile(approvals_path):
+        return {}
+    with open(approvals_path, 'r') as file:
+        return json.load(file)
+
+# The report of the gate is kept under the approval key of the setup it was measured for, a failed gate
+# removes an earlier approval of the same setup
+def save_approval(backend, image_size, report, passed):
+    approvals = read_approvals()
+    key = approval_key(backend, image_size)
+    if passed:
+        approvals[key] = report
+    else:
+        approvals.pop(key, None)
+
+    atomic_write(approvals_path, lambda path: write_approvals(path, approvals))
+
+def write_approvals(path, approvals):
+    with open(path, 'w') as file:
+        json.dump(approvals, file, indent=2)
+
+# Returns the gate report of a reduced precision setup, None if it wasn't let through for the current model files
+def approval(backend, image_size=None):
+    if not os.path.isfile(backend_path(backend)):
+        return None
+    return read_approvals().get(approval_key(backend, image_size))
@@ -0,0 +1,108 @@
+import os
+import threading
+import numpy as np
+import cv2
+from helpers.atomic_write import atomic_write, write_npz
+
+# Width of the saved thumbnails, the height keeps the aspect ratio of the video
+thumbnail_width = 320
+
+# @ REVIEW QUEUE @ #
+# Frames with more than one view_marker, where the view_marker was picked automatically
+# Every frame keeps the model results it was attributed from (x1, y1, x2, y2, confidence, label per row), the automatic
+# pick, a small .jpg of the frame and the correction made in the review (-1 until it's reviewed), so a correction only
+# needs that frame attributed again
+# The picks count among the confident labels of the frame, like the view_marker_indexes of attribute_batch
+# Entries are keyed by (chunk, frame), the chunks overlap so the same frame can be queued once for every chunk
+# Saved as one .npz file per session, with the rows and thumbnails of all frames in flat arrays
+class ReviewQueue:
+    def __init__(self, path, width, height, resume=True):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.entries = {}
+        self.changed = False
+        self.lock = threading.Lock()
+        if resume:
+            self.load()
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return
+        with np.load(self.path) as queue:
+            frames = queue['frames']
+            row_offsets, rows = queue['row_offsets'], queue['rows']
+            thumbnail_offsets, thumbnails = queue['thumbnail_offsets'], queue['thumbnails']
+            chunks = queue['chunks']
+            for i, f in enumerate(frames):
+                self.entries[(int(chunks[i]), int(f))] = {
+                    'chunk': int(chunks[i]),
+                    'fidx': int(queue['fidx'][i]),
+                    'rows': rows[row_offsets[i]:row_offsets[i + 1]],
+                    'chosen': int(queue['chosen'][i]),
+                    'corrected': int(queue['corrected'][i]),
+                    'thumbnail': thumbnails[thumbnail_offsets[i]:thumbnail_offsets[i + 1]],
+                }
+
+    def __len__(self):
+        return len(self.entries)
+
+    # frame can be the stand-in frame without pixels of a replay, the thumbnail is left empty then
+    def put(self, chunk, fidx, f, frame, labels, cord_thres, chosen):
+        thumbnail = np.empty(0, dtype=np.uint8)
+        if frame.ndim == 3 and frame.shape[2] == 3:
+            height = max(int(round(frame.shape[0] * thumbnail_width / frame.shape[1])), 1)
+            _, thumbnail = cv2.imencode('.jpg', cv2.resize(frame, (thumbnail_width, height), interpolation=cv2.INTER_AREA))
+            thumbnail = np.asarray(thumbnail, dtype=np.uint8).ravel()
+
+        with self.lock:
+            self.entries[(int(chunk), int(f))] = {
+                'chunk': int(chunk),
+                'fidx': int(fidx),
+                # The coordinates keep their type, so they map to the same pixels when the frame is attributed again
+                'rows': np.column_stack((cord_thres, labels)).astype(cord_thres.dtype),
+                'chosen': int(chosen),
+                'corrected': -1,
+                'thumbnail': thumbnail,
+            }
+            self.changed = True
+
+    # key is the (chunk, frame) of the entry
+    def correct(self, key, view_marker_index):
+        with self.lock:
+            self.entries[key]['corrected'] = int(view_marker_index)
+            self.changed = True
+
+    def save(self):
+        with self.lock:
+            if not self.changed:
+                return
+            keys = sorted(self.entries)
+            entries = [self.entries[key] for key in keys]
+            row_offsets = np.concatenate(([0], np.cumsum([len(e['rows']) for e in entries]))).astype(np.int64)
+            thumbnail_offsets = np.concatenate(([0], np.cumsum([len(e['thumbnail']) for e in entries]))).astype(np.int64)
+
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            atomic_write(self.path, lambda path: write_npz(path, dict(
+                width=np.int64(self.width),
+                height=np.int64(self.height),
+                frames=np.array([f for _, f in keys], dtype=np.int64),
+                chunks=np.array([e['chunk'] for e in entries], dtype=np.int64),
+                fidx=np.array([e['fidx'] for e in entries], dtype=np.int64),
+                chosen=np.array([e['chosen'] for e in entries], dtype=np.int64),
+                corrected=np.array([e['corrected'] for e in entries], dtype=np.int64),
+                row_offsets=row_offsets,
+                rows=np.concatenate([e['rows'] for e in entries]) if entries else np.empty((0, 6), np.float32),
+                thumbnail_offsets=thumbnail_offsets,
+                thumbnails=np.concatenate([e['thumbnail'] for e in entries]) if entries else np.empty(0, np.uint8),
+            )))
+            self.changed = False
+
+# Width and height of the video the queue was made from
+def read_frame_size(path):
+    with np.load(path) as queue:
+        return int(queue['width']), int(queue['height'])
+
+# The queue of a session lives next to its results
+def queue_path(results_dir, user):
+    return os.path.join(results_dir, '.review', f'{user}.npz')
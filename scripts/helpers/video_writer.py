@@ -0,0 +1,39 @@
+import queue
+import threading
+import cv2
+
+# Frames waiting to be encoded at most
+max_queued_frames = 64
+
+# @ VIDEO WRITER @ #
+# Encodes frames into an .mp4 file in its own thread, so writing the video doesn't slow down the analysis
+# The queue is bounded, if the encoder falls behind put() waits instead of filling up the memory
+class VideoWriterThread(threading.Thread):
+    def __init__(self, path, fps, max_queued=max_queued_frames):
+        super().__init__(daemon=True)
+        self.path = path
+        self.fps = fps
+        self.frames = queue.Queue(maxsize=max_queued)
+
+    def run(self):
+        writer = None
+        while True:
+            frame = self.frames.get()
+            if frame is None:
+                break
+            # The frame size is only known once the first frame arrives
+            if writer is None:
+                height, width = frame.shape[:2]
+                writer = cv2.VideoWriter(self.path, cv2.VideoWriter_fourcc(*'mp4v'), self.fps, (width, height))
+            writer.write(frame)
+        if writer is not None:
+            writer.release()
+
+    # The frame must not be changed after it's been put into the queue
+    def put(self, frame):
+        self.frames.put(frame)
+
+    # Write the remaining frames and close the file
+    def close(self):
+        self.frames.put(None)
+        self.join()
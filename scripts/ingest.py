@@ -0,0 +1,20 @@
+import os
+from helpers.progress_bar import printProgressBar
+from helpers.ingest_cache import load_session, ingest_session
+from chunk_splitter import user_ids, user_data_dir, data_columns
+
+# Columns needed by the later stages
+columns = ['TIMESTAMP'] + data_columns
+
+# @ MAIN LOOP @ #
+# Convert every raw session into the typed cache, sessions with an up to date cache are skipped
+sessions = [f'user_{user_id}_s{scenario}' for scenario in [1, 3] for user_id in user_ids]
+
+printProgressBar(0, len(sessions), prefix = 'Ingesting:', suffix = 'Complete', length = 50)
+for idx, session in enumerate(sessions):
+    csv_file = os.path.join(user_data_dir, session) + '.csv'
+
+    if os.path.isfile(csv_file) and load_session(csv_file, columns) is None:
+        ingest_session(csv_file, columns)
+
+    printProgressBar(idx + 1, len(sessions), prefix = 'Ingesting:', suffix = 'Complete', length = 50)
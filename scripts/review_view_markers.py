@@ -0,0 +1,134 @@
+import os
+import argparse
+import numpy as np
+import cv2
+import pandas as pd
+from helpers.labels import label_names, encode_seen_objects, is_mask_column
+from helpers.attribution import attribute_batch, min_confidence
+from helpers.review_queue import ReviewQueue, queue_path, read_frame_size
+from helpers.checkpoints import chunk_file_path
+from helpers.atomic_write import atomic_write
+
+# Check for argv
+parser = argparse.ArgumentParser(description='Check the view_markers picked by video_analysis.py --auto-view-markers and correct the results')
+parser.add_argument('user_id')
+parser.add_argument('scenario_id')
+parser.add_argument('--output-dir', default='../post_analysis/video_analysis', help='--output-dir of the analysis')
+parser.add_argument('--all', action='store_true', help='show the frames that were already reviewed too')
+parser.add_argument('--apply-only', action='store_true', help='nothing is shown, only the corrections made earlier are applied')
+args = parser.parse_args()
+
+# The thumbnails are shown this many times bigger
+display_scale = 2
+
+view_marker_label = label_names.index('view_marker')
+
+# Indexes of the view_markers among the confident labels of a queued frame, the same way the picks count them
+def candidates(entry):
+    rows = entry['rows']
+    confident = rows[~(rows[:, 4] < min_confidence)]
+    return confident, np.flatnonzero(confident[:, 5] == view_marker_label)
+
+# Draw the thumbnail of a queued frame with its view_markers numbered, the picked one is green
+def show_entry(key, entry, picked, position, total):
+    confident, view_markers = candidates(entry)
+    if len(entry['thumbnail']):
+        image = cv2.imdecode(entry['thumbnail'], cv2.IMREAD_COLOR)
+    else:
+        # Frames queued during a replay have no thumbnail, only the boxes are drawn
+        image = np.zeros((int(320 * height / width), 320, 3), dtype=np.uint8)
+    image_height, image_width = image.shape[0] * display_scale, image.shape[1] * display_scale
+    image = cv2.resize(image, (image_width, image_height))
+
+    for number, i in enumerate(view_markers):
+        x1, y1, x2, y2 = confident[i, :4]
+        x1, x2 = int(x1 * image_width), int(x2 * image_width)
+        y1, y2 = int(y1 * image_height), int(y2 * image_height)
+        color = (0, 255, 0) if i == picked else (50, 100, 255)
+        cv2.rectangle(image, (x1, y1), (x2, y2), color, 2)
+        cv2.putText(image, str(number + 1), (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.9, color, 2)
+
+    cv2.rectangle(image, (0, 0), (image_width, 40), (0, 0, 0), -1)
+    chunk, f = key
+    cv2.putText(image, f'{position + 1}/{total} chunk {chunk} frame {f}: 1-{len(view_markers)} picks, Enter keeps, B back, Q stops',
+                (10, 25), cv2.FONT_HERSHEY_PLAIN, 1, (255, 255, 255), 1)
+    cv2.imshow('review', image)
+    return view_markers
+
+# @ REVIEW @ #
+# Go through the queued frames one at a time, every answer is saved as the correction of that frame
+def review(queue):
+    keys = [key for key, entry in sorted(queue.entries.items()) if args.all or entry['corrected'] < 0]
+    position = 0
+    while 0 <= position < len(keys):
+        entry = queue.entries[keys[position]]
+        picked = entry['corrected'] if entry['corrected'] >= 0 else entry['chosen']
+        view_markers = show_entry(keys[position], entry, picked, position, len(keys))
+
+        key = cv2.waitKey(0) & 0xFF
+        if ord('1') <= key <= ord('9') and key - ord('1') < len(view_markers):
+            queue.correct(keys[position], view_markers[key - ord('1')])
+            position += 1
+        elif key in (13, 32):
+            queue.correct(keys[position], picked)
+            position += 1
+        elif key == ord('b'):
+            position = max(position - 1, 0)
+        elif key in (ord('q'), 27):
+            break
+
+    cv2.destroyAllWindows()
+    queue.save()
+    print(f'{sum(entry["corrected"] >= 0 for entry in queue.entries.values())} of {len(queue)} frames reviewed')
+
+# @ APPLY CORRECTIONS @ #
+# Every reviewed frame is attributed again, also the ones where the review kept the automatic pick, so a frame
+# that was corrected before and set back to the automatic pick gets its results back too
+def corrected_objects(queue):
+    keys = [key for key, entry in sorted(queue.entries.items()) if entry['corrected'] >= 0]
+    if not keys:
+        return {}
+    entries = [queue.entries[key] for key in keys]
+    attributions = attribute_batch(
+        [(entry['rows'][:, 5], entry['rows'][:, :5]) for entry in entries],
+        width, height, label_names, [entry['corrected'] for entry in entries]
+    )
+    return {key: looked_at_objects for key, (_, looked_at_objects, _) in zip(keys, attributions)}
+
+# Put the corrected looked at objects into a results .csv file, rows are found by their chunk and frame
+# The file is read as text, so every other value is written back exactly as it was, SEEN_OBJECTS stays a bitmask
+# if it was one
+def patch_results(path, seen):
+    if not os.path.isfile(path):
+        return 0
+    df = pd.read_csv(path, sep=';', dtype=str, keep_default_na=False)
+    keys = pd.Series(list(zip(df['CHUNK'].astype(np.int64), df['FRAME'].astype(np.int64))), index=df.index)
+    rows = keys.isin(seen.keys())
+    if not rows.any():
+        return 0
+    objects = keys[rows].map(seen)
+    if is_mask_column(df['SEEN_OBJECTS']):
+        objects = objects.map(lambda text: str(encode_seen_objects(text)))
+    df.loc[rows, 'SEEN_OBJECTS'] = objects
+
+    atomic_write(path, lambda partial_path: df.to_csv(partial_path, index=False, sep=';'))
+    return int(rows.sum())
+
+# @ MAIN @ #
+user = f'user_{args.user_id}_s{args.scenario_id}'
+path = queue_path(args.output_dir, user)
+if not os.path.isfile(path):
+    print(f'No review queue for {user}, run video_analysis.py with --auto-view-markers first')
+    exit(1)
+
+width, height = read_frame_size(path)
+queue = ReviewQueue(path, width, height)
+if not args.apply_only:
+    review(queue)
+
+seen = corrected_objects(queue)
+patched = patch_results(f'{os.path.join(args.output_dir, user)}.csv', seen)
+# The finished chunks get the corrections too, they are put together again if the results are missing
+for chunk in sorted({chunk for chunk, _ in seen}):
+    patch_results(chunk_file_path(os.path.join(args.output_dir, '.checkpoints'), user, chunk), seen)
+print(f'{len(seen)} reviewed frames attributed again, {patched} rows written in {user}.csv')
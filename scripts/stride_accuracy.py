@@ -0,0 +1,73 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from grading import grade_sessions, read_session, post_video_anaylsis_dir
+
+# Check for argv
+parser = argparse.ArgumentParser(description='Compare the gaze percentages of a video_analysis.py --stride run with the full analysis')
+parser.add_argument('stride_dir', help='--output-dir of the run with --stride')
+parser.add_argument('--full-dir', default=post_video_anaylsis_dir, help='results of the run without --stride')
+parser.add_argument('--tolerance', type=float, default=0.01, help='largest accepted difference of a percentage in one chunk')
+args = parser.parse_args()
+
+# Grading columns that depend on the looked at objects
+percentage_columns = [
+    'ADL_ROAD',
+    'ADL_DISTRACTION',
+    'ADL_OTHER_OR_UNDEFINED',
+    'TOR_MIRRORS',
+    'TOR_ROAD',
+    'TOR_DASHBOARD',
+    'TOR_HUD',
+    'TOR_OTHER_OR_UNDEFINED',
+]
+
+def grade_file(results_dir, user):
+    return grade_sessions([(user, read_session(os.path.join(results_dir, user)))])
+
+# @ MAIN LOOP @ #
+# One row per chunk with the difference of every percentage, stride minus full
+report = []
+for user in sorted(os.listdir(args.stride_dir)):
+    # Skip if not .csv or if there is no full analysis of it
+    if user.split('.', 1)[-1] != 'csv' or not os.path.isfile(os.path.join(args.full_dir, user)):
+        continue
+
+    full = grade_file(args.full_dir, user)
+    strided = grade_file(args.stride_dir, user)
+    if len(full) != len(strided):
+        print(f'{user}: {len(strided)} chunks instead of {len(full)}, skipped')
+        continue
+
+    differences = pd.DataFrame({
+        'USER': full['USER'],
+        'HUD': full['HUD'],
+        'CHUNK': np.arange(len(full)),
+        'REQUEST_TYPE': full['REQUEST_TYPE'],
+    })
+    for column in percentage_columns:
+        # '-' marks a percentage the chunk doesn't have
+        differences[column] = pd.to_numeric(strided[column], errors='coerce') - pd.to_numeric(full[column], errors='coerce')
+    report.append(differences)
+
+if not report:
+    print('Nothing to compare')
+    exit(1)
+
+report = pd.concat(report, ignore_index=True)
+grading_data_path = '../post_analysis/grading'
+os.makedirs(grading_data_path, exist_ok=True)
+report.to_csv(f'{grading_data_path}/stride_accuracy.csv', sep=';')
+
+# Summary per percentage
+for column in percentage_columns:
+    errors = report[column].abs().dropna()
+    if len(errors) == 0:
+        continue
+    print(f'{column:24s} mean {errors.mean():.4f}, max {errors.max():.4f}, {(errors > args.tolerance).sum()} of {len(errors)} chunks over {args.tolerance}')
+
+worst = report[percentage_columns].abs().max().max()
+print(f'Largest difference: {worst:.4f}')
+if worst > args.tolerance:
+    exit(1)
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The scripts are run from the scripts directory, their imports and relative paths start there
+scripts_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, scripts_dir)
+os.chdir(scripts_dir)
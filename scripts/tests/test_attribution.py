@@ -0,0 +1,180 @@
+import numpy as np
+import pytest
+from helpers.labels import label_names
+from helpers.attribution import attribute_batch
+
+width, height = 1280, 720
+
+VIEW_MARKER = label_names.index('view_marker')
+MIRROR = label_names.index('mirror')
+MARKER = label_names.index('marker')
+DASHBOARD = label_names.index('dashboard')
+DISTRACTION = label_names.index('distraction')
+
+# @ ORIGINAL ATTRIBUTION @ #
+# Intersection test of the original loop
+def rectangles_intersect(rect1_tl, rect1_br, rect2_tl, rect2_br):
+    x1_tl, y1_tl = rect1_tl
+    x1_br, y1_br = rect1_br
+    x2_tl, y2_tl = rect2_tl
+    x2_br, y2_br = rect2_br
+    w1 = x1_br - x1_tl
+    h1 = y1_br - y1_tl
+    w2 = x2_br - x2_tl
+    h2 = y2_br - y2_tl
+    if x1_tl > x2_tl + w2 or x2_tl > x1_tl + w1:
+        return False
+    if y1_tl > y2_tl + h2 or y2_tl > y1_tl + h1:
+        return False
+    return True
+
+# The per-frame loop video_analysis.py ran before the attribution was batched, without the drawing
+# chosen is the index of the view_marker among the confident labels, None keeps the first one
+def original_attribution(labels, cord_thres, chosen=None):
+    labels_in_frame = []
+    view_marker_index = -1
+    for i in range(len(labels)):
+        if cord_thres[i][4] < 0.5:
+            continue
+        x1 = int(cord_thres[i][0] * width)
+        y1 = int(cord_thres[i][1] * height)
+        x2 = int(cord_thres[i][2] * width)
+        y2 = int(cord_thres[i][3] * height)
+        labels_in_frame.append({
+            'index': i,
+            'name': label_names[int(labels[i])],
+            'x1': x1, 'x2': x2, 'y1': y1, 'y2': y2,
+            'center': (int((x1 + x2) / 2), int((y1 + y2) / 2)),
+        })
+        if label_names[int(labels[i])] == 'view_marker' and view_marker_index == -1:
+            view_marker_index = i
+    if chosen is not None:
+        view_marker_index = chosen
+
+    view_marker = None
+    if view_marker_index != -1:
+        view_marker = labels_in_frame[view_marker_index]
+
+    looking_at_object = ''
+    looked_at_objects = ''
+
+    mirrors = [label for label in labels_in_frame if label['name'] == 'mirror']
+    if len(mirrors) > 0:
+        mirrors_sorted = sorted(mirrors, key=lambda m: m['center'][0])
+        left_mirror = mirrors_sorted[0]
+        right_mirror = mirrors_sorted[-1]
+        rearview_mirror = None
+        for mirror in mirrors_sorted:
+            if mirror != left_mirror and mirror != right_mirror:
+                if left_mirror['center'][0] < mirror['center'][0] < right_mirror['center'][0]:
+                    rearview_mirror = mirror
+                    break
+        for label in labels_in_frame:
+            if label == left_mirror:
+                label['name'] = 'left_mirror'
+            if label == right_mirror:
+                label['name'] = 'right_mirror'
+            if label == rearview_mirror:
+                label['name'] = 'rearview_mirror'
+
+    for label in labels_in_frame:
+        if label['name'] == 'view_marker' and label != view_marker:
+            continue
+        if label['name'] == 'marker':
+            label['name'] = 'road'
+        if label['name'] != 'view_marker' and view_marker is not None:
+            if rectangles_intersect((view_marker['x1'], view_marker['y1']), (view_marker['x2'], view_marker['y2']),
+                                    (label['x1'], label['y1']), (label['x2'], label['y2'])):
+                looking_at_object = str(label['name'])
+                looked_at_objects += f'{looking_at_object},'
+
+    return [label['name'] for label in labels_in_frame], looked_at_objects, looking_at_object
+
+# @ FIXTURES @ #
+# Detections of one frame as the model gives them, rows of (class, x1, y1, x2, y2, confidence)
+def frame(*rows):
+    rows = np.array(rows, dtype=np.float32).reshape(-1, 6)
+    return rows[:, 0], rows[:, 1:]
+
+# A view_marker looking at the middle of the frame
+def view_marker(x=0.5, y=0.5, confidence=0.9):
+    return (VIEW_MARKER, x - 0.02, y - 0.02, x + 0.02, y + 0.02, confidence)
+
+def box(label, x1, y1, x2, y2, confidence=0.8):
+    return (label, x1, y1, x2, y2, confidence)
+
+def assert_same_attribution(detections, chosen=None):
+    results = attribute_batch(detections, width, height, label_names,
+                              None if chosen is None else [-1 if c is None else c for c in chosen])
+    for f, ((labels, cord_thres), (frame_labels, looked_at_objects, looking_at_object)) in enumerate(zip(detections, results)):
+        names, expected_objects, expected_object = original_attribution(labels, cord_thres, None if chosen is None else chosen[f])
+        assert list(frame_labels['name']) == names
+        assert looked_at_objects == expected_objects
+        assert looking_at_object == expected_object
+
+edge_cases = {
+    'empty frame': frame(),
+    'only unconfident labels': frame(view_marker(confidence=0.3), box(DASHBOARD, 0.4, 0.4, 0.6, 0.6, 0.49)),
+    'no view_marker': frame(box(DASHBOARD, 0.4, 0.4, 0.6, 0.6), box(MIRROR, 0.1, 0.1, 0.2, 0.2)),
+    'view_marker alone': frame(view_marker()),
+    'single mirror': frame(view_marker(0.15, 0.15), box(MIRROR, 0.1, 0.1, 0.2, 0.2)),
+    'two mirrors': frame(view_marker(0.85, 0.15), box(MIRROR, 0.8, 0.1, 0.9, 0.2), box(MIRROR, 0.1, 0.1, 0.2, 0.2)),
+    'three mirrors': frame(view_marker(0.5, 0.1), box(MIRROR, 0.8, 0.1, 0.9, 0.2), box(MIRROR, 0.45, 0.05, 0.55, 0.15),
+                           box(MIRROR, 0.1, 0.1, 0.2, 0.2)),
+    # The middle mirror isn't strictly between the others, so there is no rear-view mirror
+    'mirrors with equal centers': frame(view_marker(0.15, 0.15), box(MIRROR, 0.1, 0.1, 0.2, 0.2),
+                                        box(MIRROR, 0.1, 0.3, 0.2, 0.4), box(MIRROR, 0.8, 0.1, 0.9, 0.2)),
+    'marker is road': frame(view_marker(), box(MARKER, 0.3, 0.3, 0.7, 0.7), box(DASHBOARD, 0.45, 0.45, 0.55, 0.55)),
+    'several looked at objects': frame(view_marker(), box(DASHBOARD, 0.4, 0.4, 0.6, 0.6), box(DISTRACTION, 0.49, 0.49, 0.9, 0.9),
+                                       box(MARKER, 0.0, 0.0, 0.1, 0.1)),
+    # Boxes that only touch the view_marker count as looked at
+    'touching boxes': frame(view_marker(), box(DASHBOARD, 0.52, 0.4, 0.6, 0.6)),
+    'duplicate view_markers': frame(view_marker(0.2, 0.2), view_marker(0.7, 0.7, 0.8), box(DASHBOARD, 0.65, 0.65, 0.75, 0.75)),
+    # The index of the first view_marker counts all labels but picks among the confident ones, as it always did
+    'unconfident label before the view_marker': frame(box(DASHBOARD, 0.0, 0.0, 0.05, 0.05, 0.2), view_marker(),
+                                                      box(DISTRACTION, 0.45, 0.45, 0.55, 0.55)),
+}
+
+# @ TESTS @ #
+@pytest.mark.parametrize('case', edge_cases)
+def test_edge_cases_match_the_original_attribution(case):
+    assert_same_attribution([edge_cases[case]])
+
+def test_whole_batch_matches_the_original_attribution():
+    assert_same_attribution(list(edge_cases.values()))
+
+def test_picked_view_marker_matches_the_original_attribution():
+    detections = [edge_cases['duplicate view_markers'], edge_cases['three mirrors'], edge_cases['empty frame']]
+    assert_same_attribution(detections, chosen=[1, None, None])
+
+@pytest.mark.parametrize('seed', range(10))
+def test_random_frames_match_the_original_attribution(seed):
+    rng = np.random.default_rng(seed)
+    detections = []
+    for _ in range(30):
+        n = int(rng.integers(0, 8))
+        corners = np.sort(rng.random((n, 2, 2)).astype(np.float32), axis=1)
+        rows = np.column_stack((
+            rng.choice([VIEW_MARKER, MIRROR, MARKER, DASHBOARD, DISTRACTION], n),
+            corners[:, 0, 0], corners[:, 0, 1], corners[:, 1, 0], corners[:, 1, 1],
+            rng.random(n) * 0.4 + 0.45,
+        ))
+        # The model sorts its detections by confidence
+        detections.append(frame(*rows[np.argsort(-rows[:, 5], kind='stable')]))
+    # A view_marker index past the confident labels raised in both, those frames are left out
+    valid = []
+    for labels, cord_thres in detections:
+        try:
+            original_attribution(labels, cord_thres)
+            valid.append((labels, cord_thres))
+        except IndexError:
+            pass
+    assert_same_attribution(valid)
+
+# Unconfident labels before the only view_marker push its index past the confident labels, that raised before too
+def test_view_marker_index_past_the_confident_labels_raises():
+    labels, cord_thres = frame(box(DASHBOARD, 0.0, 0.0, 0.1, 0.1, 0.2), box(DASHBOARD, 0.2, 0.2, 0.3, 0.3, 0.2), view_marker())
+    with pytest.raises(IndexError):
+        original_attribution(labels, cord_thres)
+    with pytest.raises(IndexError):
+        attribute_batch([(labels, cord_thres)], width, height, label_names)
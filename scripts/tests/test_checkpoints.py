@@ -0,0 +1,60 @@
+import os
+import pandas as pd
+import pytest
+from helpers.checkpoints import SessionCheckpoint
+from helpers.atomic_write import atomic_write
+
+signature = {'video': [1, 2], 'model': 'abc', 'options': {'stride': 1}}
+
+def chunk_rows(index, frames):
+    return pd.DataFrame({'CHUNK': [index] * frames, 'FRAME': range(frames), 'SEEN_OBJECTS': ['road,'] * frames})
+
+# A rerun with the same signature skips the finished chunks and puts the same results together
+def test_resume_and_assemble(tmp_path):
+    checkpoints_dir = str(tmp_path / '.checkpoints')
+    chunks = {0: chunk_rows(0, 3), 2: chunk_rows(2, 5)}
+    checkpoint = SessionCheckpoint(checkpoints_dir, 'user_1_s1', signature)
+    for index, df in chunks.items():
+        checkpoint.write_chunk(index, df)
+
+    resumed = SessionCheckpoint(checkpoints_dir, 'user_1_s1', signature)
+    assert resumed.is_done(0) and resumed.is_done(2) and not resumed.is_done(1)
+    assert not resumed.complete
+    resumed.write_chunk(1, chunk_rows(1, 4))
+    resumed.finish()
+    chunks[1] = chunk_rows(1, 4)
+
+    finished = SessionCheckpoint(checkpoints_dir, 'user_1_s1', signature)
+    assert finished.complete
+    export_path = str(tmp_path / 'user_1_s1.csv')
+    finished.assemble(export_path, chunk_rows(0, 0))
+    expected = pd.concat([chunks[index] for index in sorted(chunks)]).to_csv(index=False, sep=';')
+    with open(export_path, 'r') as file:
+        assert file.read() == expected
+
+def test_other_signature_starts_over(tmp_path):
+    checkpoints_dir = str(tmp_path / '.checkpoints')
+    SessionCheckpoint(checkpoints_dir, 'user_1_s1', signature).write_chunk(0, chunk_rows(0, 3))
+    checkpoint = SessionCheckpoint(checkpoints_dir, 'user_1_s1', {**signature, 'model': 'other'})
+    assert not checkpoint.is_done(0)
+    assert not os.path.exists(checkpoint.chunk_path(0))
+
+def test_assemble_without_chunks_writes_the_empty_table(tmp_path):
+    checkpoint = SessionCheckpoint(str(tmp_path / '.checkpoints'), 'user_1_s1', signature)
+    export_path = str(tmp_path / 'user_1_s1.csv')
+    checkpoint.assemble(export_path, chunk_rows(0, 0))
+    with open(export_path, 'r') as file:
+        assert file.read() == 'CHUNK;FRAME;SEEN_OBJECTS\n'
+
+# A failed write keeps the old file and leaves nothing behind
+def test_failed_atomic_write_keeps_the_old_file(tmp_path):
+    path = str(tmp_path / 'results.csv')
+    atomic_write(path, lambda partial_path: chunk_rows(0, 2).to_csv(partial_path, index=False, sep=';'))
+    def fail(partial_path):
+        with open(partial_path, 'w') as file:
+            file.write('CHUNK;FR')
+        raise OSError('disk full')
+    with pytest.raises(OSError):
+        atomic_write(path, fail)
+    assert os.listdir(tmp_path) == ['results.csv']
+    assert pd.read_csv(path, sep=';').equals(chunk_rows(0, 2))
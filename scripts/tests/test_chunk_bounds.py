@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+import pytest
+import chunk_splitter
+from chunk_splitter import split_into_chunks
+
+# Few frames after the switch, so the windows of neighbouring requests overlap in the small sessions
+short_next_frames = 5
+
+@pytest.fixture(autouse=True)
+def short_chunks(monkeypatch):
+    monkeypatch.setattr(chunk_splitter, 'next_frames', short_next_frames)
+
+# The row by row splitting chunk_splitter.py did before it was vectorized
+def original_split(resampled_df, next_frames):
+    chunks = []
+    temp_df = pd.DataFrame()
+    for i, row in resampled_df.iterrows():
+        if row['LEAD_TIME'] > 0 or (row['HUD_5019'] > 0 and row['AUTO_DRIVE'] < 4):
+            temp_df = pd.concat([temp_df, row.to_frame().transpose()])
+        elif not temp_df.empty:
+            index = resampled_df.index.get_loc(i)
+            if (index + next_frames) > len(resampled_df):
+                next_rows = resampled_df.loc[i:len(resampled_df)]
+            else:
+                next_rows = resampled_df.loc[i:index + next_frames]
+            chunks.append(pd.concat([temp_df, next_rows]))
+            temp_df = pd.DataFrame()
+    return chunks, (temp_df if not temp_df.empty else None)
+
+# A resampled session where requests is a list of 'T' for a TAKE OVER request, 'A' for an AUTO DRIVE request,
+# 'H' for a HUD request while already driving automatically, 'N' for a missing LEAD_TIME and '.' for nothing
+def session(requests):
+    n = len(requests)
+    lead_time = np.array([5.0 if r == 'T' else np.nan if r == 'N' else 0.0 for r in requests])
+    hud_5019 = np.array([1.0 if r in 'AH' else 0.0 for r in requests])
+    auto_drive = np.array([4.0 if r in 'H' else 1.0 for r in requests])
+    df = pd.DataFrame({c: np.arange(n, dtype=float) * (i + 1) for i, c in enumerate(chunk_splitter.data_columns)})
+    df['LEAD_TIME'] = lead_time
+    df['HUD_5019'] = hud_5019
+    df['AUTO_DRIVE'] = auto_drive
+    df.insert(0, 'TIMESTAMP', np.arange(n) / 50)
+    df.insert(0, 'FRAME', range(n))
+    return df
+
+def assert_same_chunks(requests):
+    df = session(requests)
+    chunks, remaining = split_into_chunks(df)
+    expected_chunks, expected_remaining = original_split(df.astype(float), short_next_frames)
+
+    assert len(chunks) == len(expected_chunks)
+    for chunk, expected in zip(chunks, expected_chunks):
+        assert np.array_equal(chunk.to_numpy(dtype=float), expected.to_numpy(dtype=float), equal_nan=True)
+    if expected_remaining is None:
+        assert remaining is None
+    else:
+        assert np.array_equal(remaining.to_numpy(dtype=float), expected_remaining.to_numpy(dtype=float), equal_nan=True)
+
+# @ EDGE CASES @ #
+@pytest.mark.parametrize('requests', [
+    '',
+    '.',
+    'T',
+    '..........',
+    'TTT.........',
+    '...TTT......',
+    # Fewer than next_frames rows after the switch
+    '......TTT..',
+    '......TTT.',
+    # The request runs until the last row, nothing after the switch
+    '.......TTT',
+    '...TT....AAA',
+    # Windows that overlap the frames after the previous switch
+    '.TT.T..AA.....',
+    'T.T.T.T.T.....',
+    # Single row windows, HUD requests in automatic mode and missing values aren't requests
+    '.T.A.H.N.T......',
+    'HHH..NNN..AAA.......',
+])
+def test_chunks_match_the_row_by_row_split(requests):
+    assert_same_chunks(requests)
+
+@pytest.mark.parametrize('seed', range(20))
+def test_chunks_match_the_row_by_row_split_on_random_sessions(seed):
+    rng = np.random.default_rng(seed)
+    assert_same_chunks(''.join(rng.choice(list('TAHN......'), size=int(rng.integers(0, 60)))))
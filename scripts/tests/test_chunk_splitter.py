@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+import pytest
+from chunk_splitter import resample_session, data_columns
+
+# A session with irregular sample times, like the simulator writes them, in miliseconds
+def simulator_session(seed, samples=1500):
+    rng = np.random.default_rng(seed)
+    timestamps = 1_600_000_000_000 + np.cumsum(rng.integers(1, 30, samples)).astype(float)
+    return pd.DataFrame({'TIMESTAMP': timestamps, **{c: rng.normal(size=samples).cumsum() for c in data_columns}})
+
+# Same as pd.read_csv(..., chunksize=chunksize)
+def read_in_chunks(df, chunksize):
+    return (df.iloc[start:start + chunksize] for start in range(0, len(df), chunksize))
+
+# @ RESAMPLING @ #
+@pytest.mark.parametrize('seed', range(4))
+@pytest.mark.parametrize('chunksize', [1, 2, 3, 777, 1000])
+def test_resampling_does_not_depend_on_the_chunksize(seed, chunksize):
+    df = simulator_session(seed)
+    whole = resample_session(read_in_chunks(df, len(df)), 0)
+    pd.testing.assert_frame_equal(resample_session(read_in_chunks(df, chunksize), 0), whole, check_exact=True)
+
+# Grid points on a sample are interpolated in the chunk where the sample is the last one
+def test_resampling_on_samples_at_chunk_boundaries():
+    df = simulator_session(0, 200)
+    df['TIMESTAMP'] = 1_600_000_000_000 + np.arange(len(df)) * 20.0
+    whole = resample_session(read_in_chunks(df, len(df)), 0)
+    pd.testing.assert_frame_equal(resample_session(read_in_chunks(df, 7), 0), whole, check_exact=True)
+
+# One big chunk gives the grid np.arange gave before the resampling was streamed
+def test_resampling_matches_arange_grid():
+    df = simulator_session(1)
+    resampled = resample_session(read_in_chunks(df, len(df)), 0)
+    grid = np.arange(df['TIMESTAMP'].iloc[0] / 1000, df['TIMESTAMP'].iloc[-1] / 1000, 1 / 50)
+    assert np.array_equal(resampled['TIMESTAMP'].to_numpy(), grid[grid < df['TIMESTAMP'].iloc[-1] / 1000])
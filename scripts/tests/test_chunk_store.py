@@ -0,0 +1,35 @@
+import numpy as np
+import pandas as pd
+from helpers.chunk_store import write_chunk_store, open_chunk_store, read_chunk, store_exists, remove_chunk_store
+
+def resampled_session(frames):
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({
+        'FRAME': np.arange(frames),
+        'TIMESTAMP': 1_600_000_000 + np.arange(frames) / 50,
+        'SPEED': rng.normal(50, 10, frames),
+        'AUTO_DRIVE': rng.integers(0, 5, frames).astype(float),
+    })
+
+# Every chunk read back from the store is the same as the rows it was written from, also overlapping ones
+def test_chunks_round_trip(tmp_path):
+    df = resampled_session(100)
+    bounds = [(0, 30), (20, 55), (55, 56), (90, 100)]
+    write_chunk_store(str(tmp_path), 'user_1_s1', df, bounds)
+    assert store_exists(str(tmp_path), 'user_1_s1')
+
+    data, offsets = open_chunk_store(str(tmp_path), 'user_1_s1')
+    assert isinstance(data, np.memmap)
+    assert len(offsets) == len(bounds)
+    for chunk_num, (start, stop) in enumerate(bounds):
+        chunk = read_chunk(data, offsets, chunk_num)
+        assert list(chunk.dtype.names) == list(df.columns)
+        for column in df.columns:
+            assert np.array_equal(chunk[column], df[column].to_numpy()[start:stop])
+
+def test_session_without_chunks(tmp_path):
+    write_chunk_store(str(tmp_path), 'user_1_s1', resampled_session(10), [])
+    data, offsets = open_chunk_store(str(tmp_path), 'user_1_s1')
+    assert len(data) == 10 and offsets.shape == (0, 2)
+    remove_chunk_store(str(tmp_path), 'user_1_s1')
+    assert not store_exists(str(tmp_path), 'user_1_s1')
@@ -0,0 +1,250 @@
+import numpy as np
+import pandas as pd
+import pytest
+from helpers.labels import encode_seen_objects
+from grading import grade_sessions, sweep_thresholds, default_thresholds, threshold_columns, grading_columns, window_columns, window_frames, window_suffix, FPS
+
+# The original loop divides by the empty windows
+pytestmark = pytest.mark.filterwarnings('ignore:invalid value encountered:RuntimeWarning')
+
+# @ ORIGINAL GRADING @ #
+# The per-chunk loop grading.py ran before the grading was vectorized, without the file handling
+# The 5 seconds after the mode switch were head(5 * FPS), extra windows are the same loop over iloc[start:end]
+# An empty window gave nan after TO but stopped the loop with a ZeroDivisionError after ADL, here both give nan
+def original_grading(sessions, windows=()):
+    columns = grading_columns + window_columns(windows)
+    windows = [('', (0, 5))] + [(window_suffix(window), window) for window in windows]
+    data = {column: [] for column in columns}
+
+    def append(column, window, value):
+        data[column + window[0]].append(value)
+
+    def adl_looking(chunk, window):
+        start, end = window_frames(window[1])
+        mask = (chunk['DRIVING_MODE'] == 'AUTOMATIC')
+        frames = chunk[mask].iloc[start:end]
+        all_frames = len(frames)
+        road_frames = 0
+        disctraction_frames = 0
+        other_frames = 0
+        for idx, row in frames.iterrows():
+            objects = str(row['SEEN_OBJECTS']).split(',')
+            if 'road' in objects:
+                road_frames += 1
+            elif 'distraction' in objects:
+                disctraction_frames += 1
+            else:
+                other_frames += 1
+        if all_frames == 0:
+            road_frames = disctraction_frames = other_frames = all_frames = np.float64(np.nan)
+        append('ADL_ROAD', window, road_frames / all_frames)
+        append('ADL_DISTRACTION', window, disctraction_frames / all_frames)
+        append('ADL_OTHER_OR_UNDEFINED', window, other_frames / all_frames)
+
+    def tor_looking(chunk):
+        mask = (chunk['DRIVING_MODE'] == 'AUTOMATIC')
+        all_frames = len(chunk[mask])
+        mirror_frames = 0
+        road_frames = 0
+        dashboard_frames = 0
+        hud_frames = 0
+        other_frames = 0
+        for idx, row in chunk[mask].iterrows():
+            objects = str(row['SEEN_OBJECTS']).split(',')
+            if 'road' in objects:
+                road_frames += 1
+            elif 'mirror' in objects or 'rearview_mirror' in objects or 'right_mirror' in objects or 'left_mirror' in objects:
+                mirror_frames += 1
+            elif 'dashboard' in objects:
+                dashboard_frames += 1
+            elif 'header_display' in objects:
+                hud_frames += 1
+            else:
+                other_frames += 1
+        data['TOR_MIRRORS'].append(mirror_frames / all_frames)
+        data['TOR_ROAD'].append(road_frames / all_frames)
+        data['TOR_DASHBOARD'].append(dashboard_frames / all_frames)
+        data['TOR_HUD'].append(hud_frames / all_frames)
+        data['TOR_OTHER_OR_UNDEFINED'].append(other_frames / all_frames)
+
+    def after_tor(chunk, window):
+        start, end = window_frames(window[1])
+        mask = (chunk['DRIVING_MODE'] == 'MANUAL')
+        chunk = chunk[mask].iloc[start:end]
+        all_frames = len(chunk)
+        append('TOR_SPEEDING', window, chunk[(chunk['SPEED'] > (chunk['SPEED_LIMIT'])*1.10)]['FRAME'].count() / all_frames)
+        append('TOR_ACC', window, chunk[(chunk['ACCELERATION'] > 1.0)]['ACCELERATION'].count() / all_frames)
+        append('TOR_DCC', window, chunk[(chunk['ACCELERATION'] < -2.0)]['ACCELERATION'].count() / all_frames)
+        append('TOR_ACC_Y', window, chunk[(chunk['ACCELERATION_Y'].abs() > 0.5)]['ACCELERATION_Y'].count() / all_frames)
+
+    for user, df in sessions:
+        scenario = user.split('_s', 1)
+        num_of_chunks = df['CHUNK'].tail(1).values[0]
+        for chunk_num, chunk in df.groupby('CHUNK'):
+            data['USER'].append(scenario[0])
+            data['HUD'].append(scenario[-1] == '1.csv')
+            data['ADL_FAIL'].append(num_of_chunks != 7)
+            driving_mode = chunk.head(1)['DRIVING_MODE'].values
+            if driving_mode == 'MANUAL':
+                data['REQUEST_TYPE'].append('AUTO_DRIVE')
+                for column in ['TOR_RT', 'TOR_RESPONSE', 'TOR_MIRRORS', 'TOR_ROAD', 'TOR_DASHBOARD', 'TOR_HUD', 'TOR_OTHER_OR_UNDEFINED']:
+                    data[column].append('-')
+                for window in windows:
+                    for column in ['TOR_SPEEDING', 'TOR_ACC', 'TOR_DCC', 'TOR_ACC_Y']:
+                        append(column, window, '-')
+                data['ADL_UNDER_THRESHOLD'].append(len(chunk[chunk['DRIVING_MODE'] == 'MANUAL']) < 5 * FPS)
+                for window in windows:
+                    adl_looking(chunk, window)
+            elif driving_mode == 'AUTOMATIC':
+                data['REQUEST_TYPE'].append('TAKE_OVER')
+                data['ADL_UNDER_THRESHOLD'].append('-')
+                for window in windows:
+                    for column in ['ADL_ROAD', 'ADL_DISTRACTION', 'ADL_OTHER_OR_UNDEFINED']:
+                        append(column, window, '-')
+                tor_looking(chunk)
+                rt = len(chunk[chunk['DRIVING_MODE'] == 'AUTOMATIC']) / FPS
+                data['TOR_RT'].append(rt)
+                data['TOR_RESPONSE'].append('VISUAL' if rt < 10 else 'AUDITORY' if rt < 15 else 'NO_RESPONSE')
+                for window in windows:
+                    after_tor(chunk, window)
+    return pd.DataFrame.from_dict(data)
+
+# @ FIXTURES @ #
+seen_objects = [np.nan, 'road,', 'distraction,', 'left_mirror,road,', 'dashboard,', 'header_display,', 'rearview_mirror,',
+                'car,distraction,', 'right_mirror,', 'mirror,dashboard,', 'person,']
+
+# The rows of one chunk, modes is a string of 'A' for AUTOMATIC and 'M' for MANUAL frames
+# The other columns cycle through a few values unless they are given
+def chunk(number, modes, **columns):
+    n = len(modes)
+    rng = np.random.default_rng(number * 1000 + n)
+    rows = {
+        'CHUNK': np.full(n, number),
+        'DRIVING_MODE': ['AUTOMATIC' if mode == 'A' else 'MANUAL' for mode in modes],
+        'SEEN_OBJECTS': [seen_objects[i] for i in rng.integers(0, len(seen_objects), n)],
+        'ACCELERATION': rng.normal(0, 2, n),
+        'ACCELERATION_Y': rng.normal(0, 0.6, n),
+        'SPEED': rng.uniform(0, 150, n),
+        'SPEED_LIMIT': rng.choice([50.0, 90.0, 130.0], n),
+    }
+    rows.update({column: np.broadcast_to(values, n) for column, values in columns.items()})
+    return pd.DataFrame(rows)
+
+def session(*chunks):
+    df = pd.concat(chunks, ignore_index=True)
+    df.insert(1, 'FRAME', np.arange(len(df)))
+    return df
+
+# Long enough for the windows after the mode switch to be full
+def adl(number, **columns):
+    return chunk(number, 'M' * 120 + 'A' * 400, **columns)
+
+def tor(number, **columns):
+    return chunk(number, 'A' * 300 + 'M' * 400, **columns)
+
+edge_cases = {
+    'adl and tor': [('user_1_s1.csv', session(adl(0), tor(1)))],
+    'all eight chunks': [('user_1_s3.csv', session(*[adl(c) if c % 2 else tor(c) for c in range(8)]))],
+    'nan speed limits': [('user_1_s1.csv', session(tor(0, SPEED_LIMIT=np.nan), tor(1, SPEED_LIMIT=[np.nan, 50.0] * 350)))],
+    'zero speed limits': [('user_1_s1.csv', session(tor(0, SPEED_LIMIT=0.0), tor(1, SPEED_LIMIT=0.0, SPEED=[0.0, 1.0] * 350)))],
+    'nan values': [('user_1_s1.csv', session(tor(0, SPEED=np.nan, ACCELERATION=np.nan, ACCELERATION_Y=np.nan)))],
+    # The TOR chunk has no frames after the switch, its window is empty
+    'no frames after the switch': [('user_1_s1.csv', session(chunk(0, 'A' * 30), tor(1)))],
+    # Fewer frames after the switch than the window is long
+    'short windows': [('user_1_s1.csv', session(chunk(0, 'M' * 3 + 'A' * 7), chunk(1, 'A' * 5 + 'M' * 2)))],
+    'single row chunks': [('user_1_s1.csv', session(chunk(0, 'A'), chunk(1, 'A'), chunk(2, 'M' * 400 + 'A')))],
+    'mode switching back': [('user_1_s1.csv', session(chunk(0, 'A' * 40 + 'M' * 30 + 'A' * 20 + 'M' * 300)))],
+    'nothing seen': [('user_1_s1.csv', session(adl(0, SEEN_OBJECTS=np.nan), tor(1, SEEN_OBJECTS=np.nan)))],
+    # Rows of a chunk that don't follow each other, groupby collects them
+    'chunks out of order': [('user_1_s1.csv', session(tor(2), adl(0), tor(1), adl(2), tor(0)))],
+    'several sessions': [
+        ('user_1_s1.csv', session(adl(0), tor(1))),
+        ('user_1_s3.csv', session(tor(0))),
+        ('user_2_s1.csv', session(adl(0), tor(1), adl(7))),
+    ],
+}
+
+# The same sessions with SEEN_OBJECTS as bitmasks
+def as_masks(sessions):
+    return [(user, df.assign(SEEN_OBJECTS=[encode_seen_objects(text) for text in df['SEEN_OBJECTS']])) for user, df in sessions]
+
+def assert_same_grading(sessions, windows=()):
+    expected = original_grading(sessions, windows)
+    pd.testing.assert_frame_equal(grade_sessions(sessions, windows), expected)
+    pd.testing.assert_frame_equal(grade_sessions(as_masks(sessions), windows), expected)
+
+# @ TESTS @ #
+@pytest.mark.parametrize('case', edge_cases)
+def test_edge_cases_match_the_original_grading(case):
+    assert_same_grading(edge_cases[case])
+
+# Windows that overlap each other, the default one and the ends of the chunks
+@pytest.mark.parametrize('windows', [[(0, 2)], [(0, 2), (1, 3)], [(2.5, 10), (0, 5), (4, 4.5)], [(0.01, 0.03)]])
+def test_overlapping_windows_match_the_original_grading(windows):
+    assert_same_grading(edge_cases['several sessions'] + edge_cases['short windows'], windows)
+
+@pytest.mark.parametrize('seed', range(5))
+def test_random_sessions_match_the_original_grading(seed):
+    rng = np.random.default_rng(seed)
+    sessions = []
+    for user in range(3):
+        for scenario in (1, 3):
+            chunks = []
+            for number in range(int(rng.integers(1, 9))):
+                first, other = ('M', 'A') if rng.random() < 0.5 else ('A', 'M')
+                modes = first * int(rng.integers(1, 400)) + other * int(rng.integers(1, 400))
+                if rng.random() < 0.3:
+                    modes += first * int(rng.integers(1, 50)) + other * int(rng.integers(1, 50))
+                chunks.append(chunk(number, modes))
+            sessions.append((f'user_{user}_s{scenario}.csv', session(*chunks)))
+    assert_same_grading(sessions, [(1, 3)])
+
+# The original divided the counts of an ADL chunk without AUTOMATIC frames by zero and stopped,
+# the grading gives nan like it does after TO
+def test_adl_chunk_without_automatic_frames_is_nan():
+    sessions = [('user_1_s1.csv', session(chunk(0, 'M' * 20)))]
+    assert_same_grading(sessions)
+    graded = grade_sessions(sessions)
+    assert graded['ADL_UNDER_THRESHOLD'].tolist() == [True]
+    assert all(np.isnan(graded[column].iloc[0]) for column in ['ADL_ROAD', 'ADL_DISTRACTION', 'ADL_OTHER_OR_UNDEFINED'])
+
+# @ THRESHOLD SWEEP @ #
+# Every parameter set of a sweep has to grade like grade_sessions with its thresholds, empty where a column doesn't apply
+def assert_sweep_matches_grading(sessions, grid):
+    sweep = sweep_thresholds(sessions, grid)
+    for parameter_set in sweep.index.unique():
+        rows = sweep.loc[[parameter_set]]
+        thresholds = {name: rows[name].iloc[0] for name in default_thresholds}
+        graded = grade_sessions(sessions, thresholds=thresholds)
+        for column in threshold_columns:
+            expected = graded[column].to_numpy()
+            applies = expected != '-'
+            assert rows[column][~applies].isna().all()
+            values = rows[column][applies].tolist()
+            assert len(values) == np.count_nonzero(applies)
+            for value, graded_value in zip(values, expected[applies]):
+                assert value == graded_value or (pd.isna(value) and pd.isna(graded_value))
+
+# Speeds right at the speed limit times a factor, where speed / speed_limit > factor rounds the other way
+def boundary_speeds(number, factors=(1.05, 1.10, 1.15)):
+    limits = np.arange(10.0, 140.0, 10.0)
+    speeds = np.concatenate([limits * factor for factor in factors] + [np.round(limits * factor, 1) for factor in factors])
+    limits = np.tile(limits, 2 * len(factors))
+    return chunk(number, 'A' + 'M' * len(speeds), SPEED=np.r_[0.0, speeds], SPEED_LIMIT=np.r_[50.0, limits])
+
+sweep_sessions = [
+    ('user_1_s1.csv', session(adl(0), tor(1), tor(2, SPEED_LIMIT=[np.nan, 50.0, 0.0] * 233 + [np.nan]), boundary_speeds(3))),
+    ('user_2_s3.csv', session(tor(0, SPEED_LIMIT=np.nan), chunk(1, 'A' * 30), tor(2, SPEED=np.nan), adl(3))),
+]
+
+def test_sweep_of_the_default_thresholds_matches_the_grading():
+    assert_sweep_matches_grading(sweep_sessions, {})
+    assert_sweep_matches_grading(edge_cases['nan speed limits'] + edge_cases['zero speed limits'], {})
+
+def test_sweep_matches_the_grading_of_every_parameter_set():
+    assert_sweep_matches_grading(sweep_sessions, {
+        'speeding_factor': [1.05, 1.10, 1.15],
+        'acceleration': [0.5, 1.0],
+        'deceleration': [-2.0, -1.0],
+        'visual_seconds': [5, 10],
+    })
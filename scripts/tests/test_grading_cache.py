@@ -0,0 +1,111 @@
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import pytest
+import grading
+from helpers import grading_cache
+from grading import grade_sessions, grade_incrementally, read_sessions
+
+@pytest.fixture(autouse=True)
+def temporary_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(grading_cache, 'cache_dir', str(tmp_path / 'cache'))
+
+# A results file of video_analysis.py with a few ADL and TOR chunks
+def write_results(path, seed):
+    rng = np.random.default_rng(seed)
+    rows = []
+    for chunk in range(int(rng.integers(1, 5))):
+        first, other = ('MANUAL', 'AUTOMATIC') if rng.random() < 0.5 else ('AUTOMATIC', 'MANUAL')
+        modes = [first] * int(rng.integers(1, 400)) + [other] * int(rng.integers(1, 400))
+        for mode in modes:
+            rows.append({
+                'CHUNK': chunk,
+                'FRAME': len(rows),
+                'DRIVING_MODE': mode,
+                'SEEN_OBJECTS': rng.choice(['', 'road,', 'distraction,', 'left_mirror,road,', 'dashboard,', 'header_display,']),
+                'ACCELERATION': rng.normal(0, 2),
+                'ACCELERATION_Y': rng.normal(0, 0.6),
+                'SPEED': rng.uniform(0, 150) if rng.random() > 0.05 else np.nan,
+                'SPEED_LIMIT': rng.choice([50.0, 90.0, np.nan]),
+            })
+    pd.DataFrame(rows).to_csv(path, sep=';', index=False)
+
+@pytest.fixture
+def results_dir(tmp_path):
+    path = tmp_path / 'video_analysis'
+    path.mkdir()
+    for seed, name in enumerate(['user_1_s1.csv', 'user_1_s3.csv', 'user_2_s1.csv', 'user_2_s3.csv']):
+        write_results(path / name, seed)
+    return str(path)
+
+# grading_data.csv as grading.py writes it
+def grading_data(res):
+    return res.to_csv(sep=';')
+
+def full_grading(results_dir, windows=()):
+    return grading_data(grade_sessions(read_sessions(results_dir), windows))
+
+# Records the sessions every call of grade_sessions grades
+@pytest.fixture
+def graded_sessions(monkeypatch):
+    calls = []
+    def record(sessions, *args, **kwargs):
+        calls.append([name for name, _ in sessions])
+        return grade_sessions(sessions, *args, **kwargs)
+    monkeypatch.setattr(grading, 'grade_sessions', record)
+    return calls
+
+def test_first_run_matches_the_full_grading(results_dir):
+    res, graded = grade_incrementally(results_dir)
+    assert graded == 4
+    assert grading_data(res) == full_grading(results_dir)
+
+def test_only_changed_sessions_are_graded_again(results_dir, graded_sessions):
+    grade_incrementally(results_dir)
+    res, graded = grade_incrementally(results_dir)
+    assert graded == 0
+    assert grading_data(res) == full_grading(results_dir)
+
+    write_results(os.path.join(results_dir, 'user_2_s1.csv'), 100)
+    res, graded = grade_incrementally(results_dir)
+    assert graded == 1
+    assert graded_sessions[-1] == ['user_2_s1.csv']
+    assert grading_data(res) == full_grading(results_dir)
+
+def test_settings_change_grades_everything_again(results_dir):
+    grade_incrementally(results_dir)
+    res, graded = grade_incrementally(results_dir, windows=[(0, 2)])
+    assert graded == 4
+    assert grading_data(res) == full_grading(results_dir, [(0, 2)])
+    assert grade_incrementally(results_dir, windows=[(0, 2)])[1] == 0
+    assert grade_incrementally(results_dir, windows=[(0, 2)], force=True)[1] == 4
+
+# Any change of grading.py grades everything again, the code could grade differently
+def test_code_change_grades_everything_again(results_dir, tmp_path, monkeypatch):
+    grade_incrementally(results_dir)
+    changed_code = str(tmp_path / 'grading.py')
+    shutil.copy(grading.__file__, changed_code)
+    with open(changed_code, 'a') as file:
+        file.write('\n# changed\n')
+    monkeypatch.setattr(grading, '__file__', changed_code)
+    res, graded = grade_incrementally(results_dir)
+    assert graded == 4
+    assert grading_data(res) == full_grading(results_dir)
+
+def test_deleted_sessions_are_pruned(results_dir):
+    grade_incrementally(results_dir)
+    os.remove(os.path.join(results_dir, 'user_1_s3.csv'))
+    res, graded = grade_incrementally(results_dir)
+    assert graded == 0
+    assert grading_data(res) == full_grading(results_dir)
+    assert not os.path.exists(os.path.join(grading_cache.cache_dir, 'user_1_s3.csv'))
+    assert 'user_1_s3.csv' not in grading_cache.GradingCache(grading.grading_config((), grading.default_thresholds)).sessions
+
+def test_no_results_give_an_empty_table(tmp_path):
+    empty_dir = tmp_path / 'empty'
+    empty_dir.mkdir()
+    res, graded = grade_incrementally(str(empty_dir))
+    assert graded == 0
+    assert list(res.columns) == grading.grading_columns
+    assert len(res) == 0
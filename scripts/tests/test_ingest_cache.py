@@ -0,0 +1,78 @@
+import os
+import numpy as np
+import pandas as pd
+from helpers import ingest_cache
+
+columns = ['TIMESTAMP', 'SPEED']
+
+def write_csv(path, speeds):
+    with open(path, 'w') as file:
+        file.write('TIMESTAMP;SPEED\n')
+        for i, speed in enumerate(speeds):
+            file.write(f'{1000 + i * 20};{speed}\n')
+
+# A file rewritten with the same size and modification time is only caught by its hash
+def test_same_size_rewrite_is_not_loaded_from_the_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(ingest_cache, 'cache_dir', str(tmp_path / 'cache'))
+    csv_file = str(tmp_path / 'user_1_s1.csv')
+    write_csv(csv_file, [10, 11, 12])
+    ingest_cache.ingest_session(csv_file, columns)
+    stat = os.stat(csv_file)
+
+    write_csv(csv_file, [10, 11, 19])
+    os.utime(csv_file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert ingest_cache.source_signature(csv_file) == (stat.st_mtime_ns, stat.st_size)
+
+    assert ingest_cache.load_session(csv_file, columns) is None
+    # Skipping the hash trusts the size and modification time
+    assert ingest_cache.load_session(csv_file, columns, verify_hash=False) is not None
+    assert np.array_equal(ingest_cache.read_session(csv_file, columns)['SPEED'], [10, 11, 19])
+
+def test_unchanged_file_is_loaded_from_the_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(ingest_cache, 'cache_dir', str(tmp_path / 'cache'))
+    csv_file = str(tmp_path / 'user_1_s1.csv')
+    write_csv(csv_file, [10, 11, 12])
+    ingest_cache.ingest_session(csv_file, columns)
+    assert np.array_equal(ingest_cache.load_session(csv_file, columns)['SPEED'], [10, 11, 12])
+
+# A session ingested a few rows at a time is the same as the whole file parsed at once
+def test_blockwise_ingest_matches_the_whole_csv(tmp_path, monkeypatch):
+    monkeypatch.setattr(ingest_cache, 'cache_dir', str(tmp_path / 'cache'))
+    monkeypatch.setattr(ingest_cache, 'rows_per_block', 7)
+    monkeypatch.setattr(ingest_cache, 'pyarrow_block_size', 256)
+    rng = np.random.default_rng(0)
+    n = 100
+    df = pd.DataFrame({
+        'TIMESTAMP': 1_600_000_000_000 + np.arange(n) * 20,
+        'SPEED': rng.normal(50, 10, n),
+        'AUTO_DRIVE': rng.integers(0, 5, n),
+        'INDICATORS': np.r_[rng.integers(0, 3, n - 1), 0.5],
+    })
+    df.loc[10, 'SPEED'] = np.nan
+    csv_file = str(tmp_path / 'user_1_s1.csv')
+    df.to_csv(csv_file, sep=';', index=False)
+
+    session_columns = list(df.columns)
+    arrays = ingest_cache.ingest_session(csv_file, session_columns)
+    assert all(isinstance(arrays[c], np.memmap) for c in session_columns)
+    assert arrays['TIMESTAMP'].dtype == np.float64
+    assert arrays['SPEED'].dtype == np.float32
+    assert arrays['AUTO_DRIVE'].dtype == np.int8
+    # A value that isn't a small integer keeps the whole column as float32
+    assert arrays['INDICATORS'].dtype == np.float32
+
+    expected = pd.read_csv(csv_file, sep=';')
+    for c in session_columns:
+        assert np.array_equal(arrays[c], expected[c].to_numpy().astype(arrays[c].dtype), equal_nan=True)
+    chunks = list(ingest_cache.iterate_session(csv_file, session_columns, chunksize=30))
+    assert [len(chunk) for chunk in chunks] == [30, 30, 30, 10]
+    assert np.array_equal(pd.concat(chunks)['SPEED'], arrays['SPEED'], equal_nan=True)
+
+def test_empty_csv_is_cached(tmp_path, monkeypatch):
+    monkeypatch.setattr(ingest_cache, 'cache_dir', str(tmp_path / 'cache'))
+    csv_file = str(tmp_path / 'user_1_s1.csv')
+    write_csv(csv_file, [])
+    ingest_cache.ingest_session(csv_file, columns)
+    arrays = ingest_cache.load_session(csv_file, columns)
+    assert arrays is not None and len(arrays['SPEED']) == 0
+    assert list(ingest_cache.iterate_session(csv_file, columns)) == []
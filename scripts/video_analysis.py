@@ -1,33 +1,364 @@
 import os
 import sys
+import time
+import argparse
+import multiprocessing
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 import cv2
-import torch
 import pandas as pd
+from helpers.chunk_store import store_paths, store_exists, open_chunk_store, read_chunk
+from helpers.frame_source import decoders, read_frames, open_video, parse_crop
+from helpers.detector import backends, detections_key, load_model, detect, set_threads, iterate_batches
+from helpers.detection_cache import DetectionCache, video_signature
+from helpers.precision import is_reduced, approval
+from helpers.checkpoints import SessionCheckpoint
+from helpers.labels import label_names, seen_objects_masks
+from helpers.attribution import attribute_batch, ViewMarkerResolver
+from helpers.review_queue import ReviewQueue, queue_path
+from helpers.cockpit_layout import CockpitLayout
+from helpers.video_writer import VideoWriterThread, max_queued_frames
+from helpers.progress_bar import printProgressBar
+from helpers.pipeline import END, StageStats, new_queue, iterate_queue, start_thread, run_source, run_batched_stage, run_sink
 
 # @ cv2 labeling video @ #
 # Define functions that will help us later
-def center_point(coords):
-    x_coords = [c[0] for c in coords]
-    y_coords = [c[1] for c in coords]
-    center_x = sum(x_coords) / len(x_coords)
-    center_y = sum(y_coords) / len(y_coords)
-    return (int(center_x), int(center_y))
-
-def rectangles_intersect(rect1_tl, rect1_br, rect2_tl, rect2_br):
-    x1_tl, y1_tl = rect1_tl
-    x1_br, y1_br = rect1_br
-    x2_tl, y2_tl = rect2_tl
-    x2_br, y2_br = rect2_br
-    w1 = x1_br - x1_tl
-    h1 = y1_br - y1_tl
-    w2 = x2_br - x2_tl
-    h2 = y2_br - y2_tl
-    if x1_tl > x2_tl + w2 or x2_tl > x1_tl + w1:
-        return False
-    if y1_tl > y2_tl + h2 or y2_tl > y1_tl + h1:
-        return False
-    return True
+# Read the chunks of one session, from the binary chunk store if the splitter wrote one, otherwise from the .csv files
+def iterate_chunks(user):
+    if store_exists(chunks_parent_dir, user):
+        data, offsets = open_chunk_store(chunks_parent_dir, user)
+        for chunk_num in range(len(offsets)):
+            # A slice of the memory-mapped session, nothing is copied
+            yield read_chunk(data, offsets, chunk_num)
+    else:
+        chunks_dir = os.path.join(chunks_parent_dir, f'chunks_{user}')
+        for chunk in sorted(os.listdir(chunks_dir)):
+            yield pd.read_csv(os.path.join(chunks_dir, chunk))
+
+# Draw the labels and the current frame info onto the frame
+def draw_frame(frame, user, f, frame_labels, looking_at_object, auto_drive_text, is_lead_time, is_hud_5019):
+    # Get frame dimensions
+    height = frame.shape[0]
+
+    # Displaying the labels
+    for i in np.flatnonzero(frame_labels['shown']):
+        x1, y1 = int(frame_labels['x1'][i]), int(frame_labels['y1'][i])
+        x2, y2 = int(frame_labels['x2'][i]), int(frame_labels['y2'][i])
+        center = (int(frame_labels['center_x'][i]), int(frame_labels['center_y'][i]))
+        color = label_colors[frame_labels['class'][i]]
+        cv2.rectangle(frame, (x1, y1), (x2, y2), color, 2)
+        cv2.putText(frame, frame_labels['name'][i], (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.9, color, 2)
+        cv2.circle(frame, center, 3, color, 1)
+
+    # Display current frame and other dataframe info
+    cv2.rectangle(frame, (0, height), (300, height - 110), (0, 0, 0), -1)
+    cv2.putText(frame, 'Looking at: ' + looking_at_object, (10, height - 50), cv2.FONT_HERSHEY_PLAIN, 1, (255, 255, 255), 1)
+    cv2.putText(frame, 'Frame: ' + str(int(f)), (10, height - 70), cv2.FONT_HERSHEY_PLAIN, 1, (255, 255, 255), 1)
+
+    if auto_drive_text == 'AUTOMATIC':
+        auto_drive_text_color = (100, 255, 50)
+    else:
+        auto_drive_text_color = (50, 100, 255)
+    cv2.putText(frame, 'Driving mode: ', (10, height - 30), cv2.FONT_HERSHEY_PLAIN, 1, (255, 255, 255), 1)
+    cv2.putText(frame, auto_drive_text, (130, height - 30), cv2.FONT_HERSHEY_PLAIN, 1, auto_drive_text_color, 1)
+
+    if is_lead_time > 0:
+        cv2.putText(frame, 'Take over request', (10, height - 10), cv2.FONT_HERSHEY_PLAIN, 1, (50, 100, 255), 1)
+
+    if is_hud_5019 > 0:
+        cv2.putText(frame, 'Automatic drive request', (10, height - 10), cv2.FONT_HERSHEY_PLAIN, 1, (100, 255, 50), 1)
+
+    # Display which user we are watching
+    cv2.putText(frame, user, (10, height - 90), cv2.FONT_HERSHEY_PLAIN, 1, (255, 100, 255), 1)
+
+# @ FRAME ANALYSIS @ #
+# If there are multiple view_markers in one frame, the script will ask you about the correct one
+# Returns the index of the chosen view_marker among the labels of the frame
+def choose_view_marker(frame, frame_labels, state):
+    # Copy of the current frame for drawing the view_markers, allocated once and reused
+    view_markers_frame = state['view_markers_frame']
+    if view_markers_frame is None or view_markers_frame.shape != frame.shape:
+        view_markers_frame = np.empty_like(frame)
+        state['view_markers_frame'] = view_markers_frame
+    np.copyto(view_markers_frame, frame)
+
+    view_marker_index = -1
+    for i in np.flatnonzero(frame_labels['is_view_marker']):
+        x1, y1 = int(frame_labels['x1'][i]), int(frame_labels['y1'][i])
+        x2, y2 = int(frame_labels['x2'][i]), int(frame_labels['y2'][i])
+        color = label_colors[frame_labels['class'][i]]
+        is_correct_marker = False
+        if view_marker_index == -1:
+            cv2.putText(view_markers_frame, frame_labels['name'][i], (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.9, color, 2)
+            cv2.rectangle(view_markers_frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
+        elif state['check_for_multiple_view_markers']:
+            cv2.putText(view_markers_frame, 'Is this the view marker? (Y/N)', (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.9, color, 2)
+            cv2.rectangle(view_markers_frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
+            cv2.imshow('frame', view_markers_frame)
+            while True:
+                key = cv2.waitKey(0) & 0xFF
+                if key == ord('y'):
+                    is_correct_marker = True
+                    break
+                elif key == ord('n'):
+                    break
+                elif key == ord('c') or key == ord('q'):
+                    state['check_for_multiple_view_markers'] = not state['check_for_multiple_view_markers']
+                    break
+        if is_correct_marker or view_marker_index == -1:
+            view_marker_index = int(frame_labels['index'][i])
+
+    return view_marker_index
+
+# @ PIPELINE STAGES @ #
+# Decode stage, yields every frame of every chunk, the chunk frames are already in ascending order
+# A chunk ends early if a frame does not exist or if it's skipped by pressing 'q'
+def decode_chunks(cap, user, control):
+    for index, df in enumerate(iterate_chunks(user)):
+        # Finished in an earlier run
+        if index in control['done']:
+            continue
+        chunk = chunk_arrays(df)
+        for fidx, (f, frame) in enumerate(read_frames(cap, chunk['FRAME'])):
+            if control['skip_chunk'] >= index:
+                break
+            yield index, chunk, fidx, f, frame
+
+# Decode stage when replaying from the detection cache without drawing, only the frame size is needed,
+# so the video isn't decoded at all
+# A chunk ends at the first frame that isn't cached, that's where the analysis that filled the cache stopped
+def replay_chunks(cap, user, control, detection_cache):
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    # Stands in for every frame, only its shape is read
+    frame = np.empty((height, width, 0), dtype=np.uint8)
+
+    for index, df in enumerate(iterate_chunks(user)):
+        if index in control['done']:
+            continue
+        chunk = chunk_arrays(df)
+        for fidx, f in enumerate(chunk['FRAME']):
+            if control['skip_chunk'] >= index or int(f) not in detection_cache:
+                break
+            yield index, chunk, fidx, int(f), frame
+
+# Inference stage, get results for the whole batch using the trained model and extract labels/objects and coordinates
+# Frames found in the detection cache skip the model, the rest are added to it
+def infer_batch(detection_cache, batch):
+    detections = [None] * len(batch)
+    if detection_cache is not None:
+        detections = [detection_cache.get(f) for _, _, _, f, _ in batch]
+
+    missing = [i for i, detection in enumerate(detections) if detection is None]
+    if missing:
+        if model is None:
+            raise RuntimeError(f'Frame {batch[missing[0]][3]} is not in the detection cache, run the analysis without --replay first')
+        for i, detection in zip(missing, detect(model, [batch[i][4] for i in missing])):
+            detections[i] = detection
+            if detection_cache is not None:
+                detection_cache.put(batch[i][3], *detection)
+
+    return [item + detection for item, detection in zip(batch, detections)]
+
+# Inference stage with the cockpit layout cache, the model only runs on keyframes and on frames where
+# the view_marker is lost, the other frames get the layout with the tracked view_marker
+# Tracked frames aren't model results, so they don't go into the detection cache
+def infer_with_layout(detection_cache, layout, batch):
+    detections = []
+    for index, _, fidx, f, frame in batch:
+        detection = detection_cache.get(f) if detection_cache is not None else None
+        if detection is None and not layout.keyframe_due(index, fidx):
+            detection = layout.locate(frame)
+            if detection is not None:
+                detections.append(detection)
+                continue
+
+        if detection is None:
+            if model is None:
+                raise RuntimeError(f'Frame {f} is not in the detection cache, run the analysis without --replay first')
+            detection = detect(model, [frame])[0]
+            if detection_cache is not None:
+                detection_cache.put(f, *detection)
+
+        # Every full detection is a new keyframe
+        layout.update(frame, index, fidx, *detection)
+        detections.append(detection)
+
+    return [item + detection for item, detection in zip(batch, detections)]
+
+# Attribution stage, finds the looked at objects of the whole batch at once
+# All frames of a video have the same size
+def attribute_frames(batch):
+    height, width = batch[0][4].shape[:2]
+    attributions = attribute_batch([(labels, cord_thres) for *_, labels, cord_thres in batch], width, height, label_names)
+    return [item + attribution for item, attribution in zip(batch, attributions)]
+
+# Attribution stage without asking about multiple view_markers, the resolver picks one and the frame goes into
+# the review queue, so the pick can be checked later with review_view_markers.py
+def attribute_frames_unattended(resolver, review_queue, batch):
+    height, width = batch[0][4].shape[:2]
+    view_marker_indexes = []
+    for index, _, fidx, f, frame, labels, cord_thres in batch:
+        view_marker_index, ambiguous = resolver.resolve(index, fidx, labels, cord_thres)
+        view_marker_indexes.append(view_marker_index)
+        if ambiguous:
+            review_queue.put(index, fidx, f, frame, labels, cord_thres, view_marker_index)
+
+    attributions = attribute_batch([(labels, cord_thres) for *_, labels, cord_thres in batch], width, height, label_names, view_marker_indexes)
+    return [item + attribution for item, attribution in zip(batch, attributions)]
+
+# Writer stage, collects the results of every frame
+# Only the position of the frame inside its chunk and the looked at objects are kept per frame
+# Once the first frame of the next chunk arrives, the previous chunk is finished and goes to disk
+def collect_result(checkpoint, results, item):
+    index, chunk, fidx, looked_at_objects = item
+    if not results or results[-1]['index'] != index:
+        if results:
+            write_chunk(checkpoint, results.pop())
+        results.append({'index': index, 'chunk': chunk, 'fidx': [], 'seen_objects': []})
+    results[-1]['fidx'].append(fidx)
+    results[-1]['seen_objects'].append(looked_at_objects)
+
+# Build the dataframe for the final .csv file column-wise, the chunk columns are taken at the analysed positions
+def build_export(results):
+    data_export = {column: [] for column in export_columns}
+    for result in results:
+        chunk = result['chunk']
+        fidx = np.array(result['fidx'], dtype=np.int64)
+
+        data_export['CHUNK'].append(np.full(len(fidx), result['index']))
+        data_export['FRAME'].append(chunk['FRAME'][fidx])
+        data_export['DRIVING_MODE'].append(chunk['DRIVING_MODE'][fidx])
+        seen_objects = np.array(result['seen_objects'], dtype=object)
+        data_export['SEEN_OBJECTS'].append(seen_objects if readable_seen_objects else seen_objects_masks(seen_objects))
+        for column in telemetry_columns:
+            data_export[column].append(chunk[column][fidx])
+
+    return pd.DataFrame({
+        column: np.concatenate(values) if values else np.empty(0)
+        for column, values in data_export.items()
+    })
+
+# @ CHECKPOINTS @ #
+# Everything the results of a session depend on, a change means the session is analysed again
+def session_signature(mp4_file, user):
+    if store_exists(chunks_parent_dir, user):
+        chunk_files = list(store_paths(chunks_parent_dir, user))
+    else:
+        chunks_dir = os.path.join(chunks_parent_dir, f'chunks_{user}')
+        chunk_files = [os.path.join(chunks_dir, chunk) for chunk in sorted(os.listdir(chunks_dir))]
+    return {
+        'video': video_signature(mp4_file),
+        'chunks': [(os.path.basename(path), *video_signature(path)) for path in chunk_files],
+        'model': model_key,
+        'keyframe_interval': keyframe_interval,
+        'stride': stride,
+        'stride_tolerance': stride_tolerance,
+        'auto_view_markers': auto_view_markers,
+        'readable_seen_objects': readable_seen_objects,
+    }
+
+def write_chunk(checkpoint, result):
+    checkpoint.write_chunk(result['index'], build_export([result]))
+
+# Save data export into a .csv file, put together from the finished chunks
+def finish_session(checkpoint, user):
+    checkpoint.finish()
+    checkpoint.assemble(f'{os.path.join(output_dir, user)}.csv', build_export([]))
+
+# @ CHUNK DATA @ #
+# Columns of the final .csv file
+export_columns = [
+    'CHUNK',
+    'FRAME',
+    'DRIVING_MODE',
+    'SEEN_OBJECTS', # All of the looked at objects in one frame as a bitmask of helpers/labels.py, or separated by a coma
+    'STEERING_WHEEL_ANGLE',
+    'ACCELERATION',
+    'ACCELERATION_Y',
+    'SPEED',
+    'SPEED_LIMIT',
+    'BRAKE_PEDAL',
+    'INDICATORS',
+]
+# Columns copied from the chunk as they are
+telemetry_columns = export_columns[4:]
+
+# Extract the chunk columns into numpy arrays once, the frames then read them by position
+# A chunk from the store is a structured array, its columns are views into the memory-mapped session
+def chunk_arrays(df):
+    columns = df.dtype.names if isinstance(df, np.ndarray) else df.columns
+    chunk = {column: np.asarray(df[column]) for column in columns}
+    chunk['FRAME'] = chunk['FRAME'].astype(np.int64)
+    chunk['DRIVING_MODE'] = np.where(chunk['AUTO_DRIVE'] == 4, 'AUTOMATIC', 'MANUAL')
+    return chunk
+
+# @ ADAPTIVE STRIDE @ #
+# Analyse the frames at the given positions of a chunk without the pipeline
+# Returns the looked at objects by position, positions past the end of the video are left out
+def analyse_positions(cap, index, chunk, positions, detection_cache, attribution):
+    positions = sorted(positions)
+    frame_numbers = chunk['FRAME'][positions]
+    fidx_of = dict(zip(frame_numbers.tolist(), positions))
+    items = ((index, chunk, fidx_of[f], f, frame) for f, frame in read_frames(cap, frame_numbers))
+
+    seen = {}
+    for batch in iterate_batches(items, batch_size):
+        for item in attribution(infer_batch(detection_cache, batch)):
+            seen[item[2]] = item[-2]
+    return seen
+
+# Only every stride-th frame of a chunk is analysed at first, when two neighbouring analysed frames don't see
+# the same objects, the frame in the middle of them is analysed too, until the change is found to within
+# stride_tolerance frames
+# The frames in between get the objects of the closest analysed frame
+# Returns the positions of the existing frames, their looked at objects and the number of analysed frames
+def analyse_chunk_with_stride(cap, index, chunk, detection_cache, attribution):
+    n = len(chunk['FRAME'])
+    # Looked at objects by position, None if the frame is past the end of the video
+    seen = {}
+    positions = set(range(0, n, stride)) | {n - 1}
+    while positions:
+        found = analyse_positions(cap, index, chunk, positions, detection_cache, attribution)
+        for position in positions:
+            seen[position] = found.get(position)
+
+        positions = set()
+        analysed = sorted(seen)
+        for a, b in zip(analysed, analysed[1:]):
+            if b - a > 1 and seen[a] != seen[b]:
+                # The end of the video is always found exactly
+                if seen[a] is None or seen[b] is None or b - a > stride_tolerance + 1:
+                    positions.add((a + b) // 2)
+
+    analysed = np.array([position for position in sorted(seen) if seen[position] is not None], dtype=np.int64)
+    if len(analysed) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=object), 0
+    values = np.array([seen[position] for position in analysed], dtype=object)
+
+    fidx = np.arange(analysed[-1] + 1)
+    left = np.searchsorted(analysed, fidx, side='right') - 1
+    right = np.minimum(left + 1, len(analysed) - 1)
+    closer_right = analysed[right] - fidx < fidx - analysed[left]
+    return fidx, np.where(closer_right, values[right], values[left]), len(analysed)
+
+# Every chunk is written to disk once it's done
+def analyse_with_stride(cap, user, detection_cache, checkpoint, attribution):
+    analysed_frames = 0
+    frames = 0
+    for index, df in enumerate(iterate_chunks(user)):
+        # Finished in an earlier run
+        if checkpoint.is_done(index):
+            continue
+        chunk = chunk_arrays(df)
+        fidx, seen_objects, analysed = analyse_chunk_with_stride(cap, index, chunk, detection_cache, attribution)
+        analysed_frames += analysed
+        frames += len(fidx)
+        write_chunk(checkpoint, {'index': index, 'chunk': chunk, 'fidx': fidx, 'seen_objects': seen_objects})
+
+    share = analysed_frames / frames if frames else 0.0
+    print(f'stride: {analysed_frames} of {frames} frames analysed ({share:.1%})')
 
 # @ MAIN ANALYSIS FUNCTION @ #
 def video_analysis(video):
@@ -35,280 +366,363 @@ def video_analysis(video):
     video_split = video.split('.', 1)
     user = video_split[0]
     mp4_file = os.path.join(videos_dir, video)
-    chunks_dir = os.path.join('../post_analysis', 'chunks', f'chunks_{user}')
 
     # Check if the csv and txt files exist in the current directory
     if os.path.isfile(mp4_file):
+        # Chunks finished by an earlier run are skipped, the whole session if all of them are
+        checkpoint = SessionCheckpoint(os.path.join(output_dir, '.checkpoints'), user, session_signature(mp4_file, user))
+        if force:
+            checkpoint.clear()
+        if checkpoint.complete:
+            if not os.path.isfile(f'{os.path.join(output_dir, user)}.csv'):
+                finish_session(checkpoint, user)
+            print(f'{user} is up to date')
+            return
+
         # Load in the video
-        cap = cv2.VideoCapture(mp4_file)
+        cap = open_video(mp4_file, decoder, decode_width, decode_crop, frame_buffers())
 
         # Enable/disable checking for multiple view_markers by pressing 'C' key
-        check_for_multiple_view_markers = False
-
-        # Dictionary for creating a dataframe for the final .csv file
-        data_export = {
-            'CHUNK': [],
-            'FRAME': [],
-            'DRIVING_MODE': [],
-            'SEEN_OBJECTS': [], # All of the looked at objects in one frame separated by a coma
-            'STEERING_WHEEL_ANGLE': [],
-            'ACCELERATION': [],
-            'ACCELERATION_Y': [],
-            'SPEED': [],
-            'SPEED_LIMIT': [],
-            'BRAKE_PEDAL': [],
-            'INDICATORS': [],
+        state = {
+            'check_for_multiple_view_markers': False,
+            'view_markers_frame': None,
         }
 
-        # Get a list of all chunks inside the chunks directory
-        chunks = [c for c in sorted(os.listdir(chunks_dir))]
-        for i in range(len(chunks)):
-            chunks[i] = os.path.join(chunks_dir, chunks[i])
-
-        for index, chunk in enumerate(chunks):
-            df = pd.read_csv(chunk)
-
-            # Takes one frame per loop
-            for fidx, f in enumerate(df['FRAME']):
-                cap.set(cv2.CAP_PROP_POS_FRAMES, f)
-                _, frame = cap.read()
-                _, view_markers_frame = cap.read()
-
-                # Get frame dimensions
-                height = frame.shape[0]
-                width = frame.shape[1]
+        # Results of the analysed frames of the current chunk
+        results = []
+
+        # Model results of earlier runs on this video
+        detection_cache = None
+        if use_detection_cache:
+            detection_cache = DetectionCache(mp4_file, model_key)
+
+        # Frames with multiple view_markers are resolved without asking and queued for review,
+        # the queue of an earlier run is only continued if its chunks are
+        review_queue = None
+        attribution = attribute_frames
+        if auto_view_markers:
+            width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+            height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+            review_queue = ReviewQueue(queue_path(output_dir, user), width, height, resume=bool(checkpoint.chunks))
+            resolver = ViewMarkerResolver(label_names)
+            attribution = partial(attribute_frames_unattended, resolver, review_queue)
+
+        # Adaptive stride doesn't use the pipeline, nothing is drawn
+        if stride > 1:
+            try:
+                analyse_with_stride(cap, user, detection_cache, checkpoint, attribution)
+            finally:
+                if detection_cache is not None:
+                    detection_cache.save()
+                if review_queue is not None:
+                    review_queue.save()
+            cap.release()
+            if review_queue is not None:
+                print(f'view markers: {resolver.ambiguous} frames resolved automatically, {len(review_queue)} in the review queue')
+            finish_session(checkpoint, user)
+            return
+
+        # Labels of the last keyframe, when the model only runs on keyframes
+        layout = None
+        if keyframe_interval > 1:
+            layout = CockpitLayout(label_names, keyframe_interval)
+            inference = partial(infer_with_layout, detection_cache, layout)
+        else:
+            inference = partial(infer_batch, detection_cache)
+
+        # Annotated video is written in a separate thread
+        video_writer = None
+        if render_video:
+            os.makedirs(rendered_videos_dir, exist_ok=True)
+            fps = cap.get(cv2.CAP_PROP_FPS) or 50
+            video_writer = VideoWriterThread(os.path.join(rendered_videos_dir, video), fps)
+            video_writer.start()
+
+        # Decoding, inference, attribution and writing run in their own threads, post-processing stays in the main thread,
+        # because that's the only place cv2 windows work from
+        control = {'skip_chunk': -1, 'done': set(checkpoint.chunks)}
+        decode_stats = StageStats('decode')
+        inference_stats = StageStats('inference')
+        attribution_stats = StageStats('attribution')
+        post_processing_stats = StageStats('post-processing')
+        writer_stats = StageStats('writer')
+
+        frames_queue = new_queue(2 * batch_size)
+        detections_queue = new_queue(2 * batch_size)
+        attributions_queue = new_queue(2 * batch_size)
+        rows_queue = new_queue(2 * batch_size)
+        if replay and layout is None and not display and video_writer is None:
+            frames = replay_chunks(cap, user, control, detection_cache)
+        else:
+            frames = decode_chunks(cap, user, control)
+        threads = [
+            start_thread(run_source, frames, frames_queue, decode_stats),
+            start_thread(run_batched_stage, inference, frames_queue, detections_queue, inference_stats, batch_size),
+            start_thread(run_batched_stage, attribution, detections_queue, attributions_queue, attribution_stats, batch_size),
+            start_thread(run_sink, partial(collect_result, checkpoint, results), rows_queue, writer_stats),
+        ]
+
+        # The cached detections and the review queue are saved even if the analysis is stopped or fails
+        try:
+            # Post-processing stage, takes one frame per loop
+            for index, chunk, fidx, f, frame, labels, cord_thres, frame_labels, looked_at_objects, looking_at_object in iterate_queue(attributions_queue):
+                # Frames of a skipped chunk that were already decoded
+                if index <= control['skip_chunk']:
+                    continue
+                start = time.perf_counter()
+
+                # Only a frame with another view_marker picked by hand is attributed again
+                if display and review_queue is None and state['check_for_multiple_view_markers'] and np.count_nonzero(frame_labels['is_view_marker']) > 1:
+                    view_marker_index = choose_view_marker(frame, frame_labels, state)
+                    frame_labels, looked_at_objects, looking_at_object = attribute_batch(
+                        [(labels, cord_thres)], frame.shape[1], frame.shape[0], label_names, [view_marker_index]
+                    )[0]
+
+                # Draw the labels and dataframe info, skipped entirely in headless mode
+                if display or video_writer is not None:
+                    auto_drive_text = chunk['DRIVING_MODE'][fidx]
+                    is_lead_time = chunk['LEAD_TIME'][fidx]
+                    is_hud_5019 = chunk['HUD_5019'][fidx]
+                    draw_frame(frame, user, f, frame_labels, looking_at_object, auto_drive_text, is_lead_time, is_hud_5019)
 
-                # Quits if frame does not exist
-                if frame is None:
-                    break
+                # Show single frame
+                if display:
+                    cv2.imshow('frame', frame)
 
-                # Reset labels in frame
-                labels_in_frame = []
-                view_marker_index = -1
-
-                # Get results for one frame using the trained model and extract labels/objects and coordinates
-                results = model(frame)
-                labels, cord_thres = results.xyxyn[0][:, -1].numpy(), results.xyxyn[0][:, :-1].numpy()
-
-                # Goes through each label/object found in one frame of the video
-                for i in range(len(labels)):
-                    # Gets confidence of every label
-                    confidence = cord_thres[i][4]
-                    if confidence < 0.5:
-                        continue
-
-                    # Save coordinates to variables and map them to pixels
-                    x1 = int(cord_thres[i][0] * frame.shape[1])
-                    y1 = int(cord_thres[i][1] * frame.shape[0])
-                    x2 = int(cord_thres[i][2] * frame.shape[1])
-                    y2 = int(cord_thres[i][3] * frame.shape[0])
-
-                    # Extract needer properties for a label
-                    name = label_names[int(labels[i])]
-                    color = label_colors[int(labels[i])]
-                    center = center_point([(x1, y1), (x2, y2)])
-
-                    # Adding a new label to the array
-                    labels_in_frame.append({
-                        'index': i,
-                        'name': label_names[int(labels[i])],
-                        'x1': x1,
-                        'x2': x2,
-                        'y1': y1,
-                        'y2': y2,
-                        'center': center,
-                        'color': label_colors[int(labels[i])]
-                    })
-
-                    # Save view marker on each frame to be able to check for intersections
-                    if label_names[int(labels[i])] == 'view_marker':
-                        is_correct_marker = False
-                        if view_marker_index == -1:
-                            cv2.putText(view_markers_frame, name, (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.9, color, 2)
-                            cv2.rectangle(view_markers_frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
-                        elif check_for_multiple_view_markers:
-                            # If there are multiple view_markers in one frame, the script will ask you about the correct one
-                            cv2.putText(view_markers_frame, 'Is this the view marker? (Y/N)', (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.9, color, 2)
-                            cv2.rectangle(view_markers_frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
-                            cv2.imshow('frame', view_markers_frame)
-                            while True:
-                                key = cv2.waitKey(0) & 0xFF
-                                if key == ord('y'):
-                                    is_correct_marker = True
-                                    break
-                                elif key == ord('n'):
-                                    break
-                                elif key == ord('c') or key == ord('q'):
-                                    check_for_multiple_view_markers = not check_for_multiple_view_markers
-                                    break
-                        if is_correct_marker or view_marker_index == -1:
-                            view_marker_index = i
-
-                # Retrieving the view_marker from labels_in_frame
-                view_marker = None
-                if view_marker_index != -1:
-                    view_marker = labels_in_frame[view_marker_index]
-
-                # Looking at variables
-                looking_at_object = ''
-                looked_at_objects = ''
-
-                # Mirrors
-                mirrors = []
-                for label in labels_in_frame:
-                    if label['name'] == 'mirror':
-                        mirrors.append(label)
-                if len(mirrors) > 0:
-                    # Sort the mirrors by their x-coordinate
-                    mirrors_sorted = sorted(mirrors, key=lambda m: m['center'][0])
-                    left_mirror = mirrors_sorted[0]
-                    right_mirror = mirrors_sorted[-1]
-                    # Find the mirror with an x-coordinate between the left and right mirrors (rear-view mirror)
-                    rearview_mirror = None
-                    for mirror in mirrors_sorted:
-                        if mirror != left_mirror and mirror != right_mirror:
-                            if left_mirror['center'][0] < mirror['center'][0] < right_mirror['center'][0]:
-                                rearview_mirror = mirror
-                                break
-
-                    for label in labels_in_frame:
-                        if label == left_mirror:
-                            label['name'] = 'left_mirror'
-                        if label == right_mirror:
-                            label['name'] = 'right_mirror'
-                        if label == rearview_mirror:
-                            label['name'] = 'rearview_mirror'
-
-                # Going over all labels found in one frame
-                for label in labels_in_frame:
-                    # Skip duplicate view_markers
-                    if label['name'] == 'view_marker' and label != view_marker:
-                        continue
-
-                    # Change the name of 'marker' to 'road'
-                    if label['name'] == 'marker':
-                        label['name'] = 'road'
-
-                    # Checking for intersections with the view_marker in one frame
-                    if label['name'] != 'view_marker' and view_marker is not None:
-                        intersects = rectangles_intersect(
-                            (view_marker['x1'], view_marker['y1']),
-                            (view_marker['x2'], view_marker['y2']),
-                            (label['x1'], label['y1']),
-                            (label['x2'], label['y2'])
-                        )
-                        if intersects:
-                            # Get the name of the object the driver is looking at and add it to the string
-                            # of all looked at objects in this frame, separated with a coma
-                            looking_at_object = str(label['name'])
-                            looked_at_objects += f'{looking_at_object},'
-
-                    # Displaying the labels
-                    cv2.rectangle(frame, (label['x1'], label['y1']), (label['x2'], label['y2']), label['color'], 2)
-                    cv2.putText(frame, label['name'], (label['x1'], label['y1'] - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.9, label['color'], 2)
-                    cv2.circle(frame, label['center'], 3, label['color'], 1)
-
-                # Display current frame and other dataframe info
-                cv2.rectangle(frame, (0, height), (300, height - 110), (0, 0, 0), -1)
-                cv2.putText(frame, 'Looking at: ' + looking_at_object, (10, height - 50), cv2.FONT_HERSHEY_PLAIN, 1, (255, 255, 255), 1)
-                cv2.putText(frame, 'Frame: ' + str(int(f)), (10, height - 70), cv2.FONT_HERSHEY_PLAIN, 1, (255, 255, 255), 1)
-                
-                is_auto_drive = df.query(f'FRAME=={f}')['AUTO_DRIVE'].values[0]
-                if is_auto_drive == 4:
-                    auto_drive_text_color = (100, 255, 50)
-                    auto_drive_text = 'AUTOMATIC'
-                else:
-                    auto_drive_text = 'MANUAL'
-                    auto_drive_text_color = (50, 100, 255)
-                cv2.putText(frame, 'Driving mode: ', (10, height - 30), cv2.FONT_HERSHEY_PLAIN, 1, (255, 255, 255), 1)
-                cv2.putText(frame, auto_drive_text, (130, height - 30), cv2.FONT_HERSHEY_PLAIN, 1, auto_drive_text_color, 1)
-
-                is_lead_time = float(df.query(f'FRAME=={f}')['LEAD_TIME'].values[0]) # type: ignore 
-                if is_lead_time > 0:
-                    cv2.putText(frame, 'Take over request', (10, height - 10), cv2.FONT_HERSHEY_PLAIN, 1, (50, 100, 255), 1)
-                
-                is_hud_5019 = float(df.query(f'FRAME=={f}')['HUD_5019'].values[0]) # type: ignore 
-                if is_hud_5019 > 0:
-                    cv2.putText(frame, 'Automatic drive request', (10, height - 10), cv2.FONT_HERSHEY_PLAIN, 1, (100, 255, 50), 1)
-
-                # Display which user we are watching
-                cv2.putText(frame, user, (10, height - 90), cv2.FONT_HERSHEY_PLAIN, 1, (255, 100, 255), 1)
+                # The annotated frame is written in the writer thread
+                if video_writer is not None:
+                    video_writer.put(frame)
 
-                # Show single frame
-                cv2.imshow('frame', frame)
-
-                # Save frame data into data export
-                data_export['CHUNK'].append(index)
-                data_export['FRAME'].append(int(f))
-                data_export['DRIVING_MODE'].append(auto_drive_text)
-                data_export['SEEN_OBJECTS'].append(looked_at_objects)
-                data_export['STEERING_WHEEL_ANGLE'].append(df['STEERING_WHEEL_ANGLE'][fidx])
-                data_export['ACCELERATION'].append(df['ACCELERATION'][fidx])
-                data_export['ACCELERATION_Y'].append(df['ACCELERATION_Y'][fidx])
-                data_export['SPEED'].append(df['SPEED'][fidx])
-                data_export['SPEED_LIMIT'].append(df['SPEED_LIMIT'][fidx])
-                data_export['BRAKE_PEDAL'].append(df['BRAKE_PEDAL'][fidx])
-                data_export['INDICATORS'].append(df['INDICATORS'][fidx])
+                # Send frame data to the writer stage
+                rows_queue.put((index, chunk, fidx, looked_at_objects))
 
                 # Quit if 'q' is pressed, change to waitKey(0) to freeze each frame
-                key = cv2.waitKey(1) & 0xFF
-                if key == ord('c'):
-                    check_for_multiple_view_markers = not check_for_multiple_view_markers
-                if key == ord('p'):
-                    continue
-                elif key == ord('q'):
-                    break
-                elif key == 27:
-                    sys.exit(0)
-
-        # Save data export into a .csv file
-        df_export = pd.DataFrame(data_export)
-        df_export.to_csv(f'{os.path.join(video_analysis_data_dir, user)}.csv', index=False, sep=';')
+                if display:
+                    key = cv2.waitKey(1) & 0xFF
+                    if key == ord('c'):
+                        state['check_for_multiple_view_markers'] = not state['check_for_multiple_view_markers']
+                    if key == ord('q'):
+                        control['skip_chunk'] = index
+                    elif key == 27:
+                        sys.exit(0)
+
+                post_processing_stats.add(1, time.perf_counter() - start)
+
+            # Wait for the writer to get the last rows
+            rows_queue.put(END)
+            for thread in threads:
+                thread.join()
+        finally:
+            if detection_cache is not None:
+                detection_cache.save()
+            if review_queue is not None:
+                review_queue.save()
 
         # Close the video
         cap.release()
-        cv2.destroyAllWindows()
+        if video_writer is not None:
+            video_writer.close()
+        if display:
+            cv2.destroyAllWindows()
+
+        all_stats = [decode_stats, inference_stats, attribution_stats, post_processing_stats, writer_stats]
+        for stats in all_stats:
+            if stats.error is not None:
+                raise stats.error
+
+        # Report the throughput of every stage
+        for stats in all_stats:
+            print(stats.report())
+        if layout is not None:
+            print(layout.report())
+        if review_queue is not None:
+            print(f'view markers: {resolver.ambiguous} frames resolved automatically, {len(review_queue)} in the review queue')
+
+        # The last chunk is only finished if nothing failed
+        if results:
+            write_chunk(checkpoint, results.pop())
+        finish_session(checkpoint, user)
 
 # Check for argv
-if len(sys.argv) != 1 and len(sys.argv) != 3:
-    print('Incorrectly provided arguments, please run the script as follows:')
-    print('> python3 video_analysis.py user_id scenario_id')
-    exit(1)
-
-# Read the labels file and assign a random color to each label
-label_names = []
+parser = argparse.ArgumentParser()
+parser.add_argument('ids', nargs='*', help='user_id scenario_id, all videos are analysed if omitted')
+parser.add_argument('--batch-size', type=int, default=8, help='number of frames sent through the model at once')
+parser.add_argument('--headless', action='store_true', help='no drawing and no windows, only the results are saved')
+parser.add_argument('--render-video', action='store_true', help='write the annotated frames into an .mp4 file')
+parser.add_argument('--no-detection-cache', action='store_true', help='always run the model, nothing is read from or saved into the detection cache')
+parser.add_argument('--replay', action='store_true', help='only use the detection cache, the model is not loaded')
+parser.add_argument('--backend', choices=backends, default='hub', help='how the model is loaded and run')
+parser.add_argument('--decoder', choices=decoders, default='opencv', help='ffmpeg decodes in its own process and can scale and crop the frames')
+parser.add_argument('--decode-width', type=int, default=None, help='with --decoder ffmpeg, scale the frames to this width')
+parser.add_argument('--decode-crop', type=parse_crop, default=None, help='with --decoder ffmpeg, crop the frames to W:H:X:Y before scaling')
+parser.add_argument('--image-size', type=int, default=None, help='smaller image size of the hub and local backends, only once calibrate_precision.py let it through')
+parser.add_argument('--keyframe-interval', type=int, default=0, help='run the model only every N frames of a chunk and track the view_marker over the cached cockpit layout in between')
+parser.add_argument('--stride', type=int, default=1, help='analyse only every N-th frame and find the changes of the looked at objects in between, headless only')
+parser.add_argument('--stride-tolerance', type=int, default=0, help='with --stride, the changes are only found to within this many frames')
+parser.add_argument('--auto-view-markers', action='store_true', help='pick the view_marker of frames with more than one without asking and queue them for review_view_markers.py')
+parser.add_argument('--readable-seen-objects', action='store_true', help='write SEEN_OBJECTS as the names separated by a coma instead of a bitmask')
+parser.add_argument('--output-dir', default=None, help='directory for the result .csv files, post_analysis/video_analysis by default')
+parser.add_argument('--force', action='store_true', help='analyse the sessions again even if they are up to date, finished chunks of earlier runs are dropped')
+parser.add_argument('--workers', type=int, default=1, help='number of processes analysing the videos at once, each with its own model')
+parser.add_argument('--threads', type=int, default=0, help='torch and OpenCV threads per worker, the cores are split between the workers by default')
+
+# The ffmpeg decoder reuses its frame buffers in turn, every frame that can be held at the same time needs its own:
+# one per place in the three queues between the stages, the batches of inference and attribution, the frames in the
+# decode and post-processing stages and the one being read, plus the queue of the video writer
+def frame_buffers():
+    buffers = 8 * batch_size + 4
+    if render_video:
+        buffers += max_queued_frames + 1
+    return buffers
+
+# Frames decoded by ffmpeg, scaled or cropped give other detections, so they get a separate detection cache
+def decoder_key():
+    if decoder == 'opencv':
+        return ''
+    key = f'_{decoder}'
+    if decode_width is not None:
+        key += f'_w{decode_width}'
+    if decode_crop is not None:
+        key += '_crop' + 'x'.join(str(value) for value in decode_crop)
+    return key
+
+# Set the options the analysis functions read, workers is the number of processes the videos are really analysed in
+def configure(args, workers):
+    global readable_seen_objects, decoder, decode_width, decode_crop, backend, image_size, keyframe_interval, stride, stride_tolerance, auto_view_markers, output_dir, force, batch_size, display, render_video, use_detection_cache, replay
+    readable_seen_objects = args.readable_seen_objects
+    decoder = args.decoder
+    decode_width = args.decode_width
+    decode_crop = args.decode_crop
+    backend = args.backend
+    image_size = args.image_size
+    keyframe_interval = args.keyframe_interval
+    stride = args.stride
+    stride_tolerance = max(args.stride_tolerance, 0)
+    auto_view_markers = args.auto_view_markers
+    output_dir = args.output_dir or video_analysis_data_dir
+    force = args.force
+    batch_size = max(args.batch_size, 1)
+    # Workers never open windows
+    display = not args.headless and workers <= 1
+    render_video = args.render_video
+    use_detection_cache = not args.no_detection_cache
+    replay = args.replay
+
+# Load in the trained model, replaying only needs the key of the model to find its detections
+def load_analysis_model():
+    global model, model_key
+    model = None if replay else load_model(backend, image_size)
+    model_key = detections_key(backend, image_size) + decoder_key()
+
+# Assign a random color to each label
 label_colors = []
 
-with open('helpers/labels.txt', 'r') as file:
-    lines = file.read().splitlines()
-    for line in lines:
-        label_names.append(line.split(' ')[0])
-        color = np.random.randint(0, 255, size=(3,)).tolist()
-        color = [int(c) for c in color]
-        label_colors.append(color)
-
-# Load in the trained model
-model = torch.hub.load('ultralytics/yolov5', 'custom', path='../yolo/best.pt')
+for _ in label_names:
+    color = np.random.randint(0, 255, size=(3,)).tolist()
+    color = [int(c) for c in color]
+    label_colors.append(color)
 
 # Path to videos directory
 parent_dir = '../simulator_data'
 videos_dir = os.path.join(parent_dir, 'videos')
+chunks_parent_dir = os.path.join('../post_analysis', 'chunks')
+
+# Directory for the annotated videos
+rendered_videos_dir = '../post_analysis/rendered_videos'
 
-# Create the results directory
+# Directory for the results
 video_analysis_data_dir = '../post_analysis/video_analysis'
-if not os.path.exists(video_analysis_data_dir):
-    os.mkdir(video_analysis_data_dir)
+
+# @ WORKERS @ #
+# Every worker process loads its own model once and then analyses whole videos
+# The thread budget keeps the workers from fighting over the same cores
+def init_worker(args, workers, threads):
+    set_threads(threads)
+    cv2.setNumThreads(threads)
+    configure(args, workers)
+    load_analysis_model()
+
+def analyse_in_parallel(videos, args, workers, threads):
+    errors = {}
+
+    # Print progress bar, only the parent process prints it
+    printProgressBar(0, len(videos), prefix = f'Analysing with {workers} workers:', suffix = 'Complete', length = 50)
+
+    # Workers are started fresh instead of forked, torch doesn't survive a fork once its threads are running
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_worker, initargs=(args, workers, threads)) as executor:
+        futures = {executor.submit(video_analysis, video): video for video in videos}
+        for done, future in enumerate(as_completed(futures)):
+            try:
+                future.result()
+            except Exception as e:
+                errors[futures[future]] = e
+
+            # Print progress bar
+            printProgressBar(done + 1, len(videos), prefix = f'Analysing with {workers} workers:', suffix = 'Complete', length = 50)
+
+    for video, error in sorted(errors.items()):
+        print(f'{video} failed: {error!r}')
+
+    return errors
 
 # @ MAIN LOOP @ #
-# If specific video provided, call once, otherwise loop through all
-if len(sys.argv) == 3:
-    print(sys.argv[1])
-    video_analysis(f'user_{sys.argv[1]}_s{sys.argv[2]}.mp4')
-elif len(sys.argv) == 1:
-    for video in os.listdir(videos_dir):
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    if len(args.ids) != 0 and len(args.ids) != 2:
+        print('Incorrectly provided arguments, please run the script as follows:')
+        print('> python3 video_analysis.py user_id scenario_id [--decoder D] [--decode-width N] [--decode-crop W:H:X:Y] [--backend B] [--image-size N] [--keyframe-interval N] [--stride N] [--stride-tolerance N] [--auto-view-markers] [--readable-seen-objects] [--output-dir DIR] [--force] [--batch-size N] [--headless] [--render-video] [--no-detection-cache] [--replay]')
+        print('> python3 video_analysis.py [--workers N] [--threads N] [--decoder D] [--decode-width N] [--decode-crop W:H:X:Y] [--backend B] [--image-size N] [--keyframe-interval N] [--stride N] [--stride-tolerance N] [--auto-view-markers] [--readable-seen-objects] [--output-dir DIR] [--force] [--batch-size N] [--headless] [--render-video] [--no-detection-cache] [--replay]')
+        exit(1)
+
+    if args.replay and args.no_detection_cache:
+        print('--replay needs the detection cache')
+        exit(1)
+
+    if (args.decode_width is not None or args.decode_crop is not None) and args.decoder != 'ffmpeg':
+        print('--decode-width and --decode-crop only work with --decoder ffmpeg')
+        exit(1)
+
+    if args.image_size is not None and args.backend not in ('hub', 'local'):
+        print('--image-size only works with the hub and local backends, the exported models have the size they were exported at')
+        exit(1)
+
+    # int8 and smaller image sizes are only used once they agree closely enough with the fp32 model
+    if is_reduced(args.backend, args.image_size) and approval(args.backend, args.image_size) is None:
+        setup = args.backend if args.image_size is None else f'{args.backend} at image size {args.image_size}'
+        print(f'{setup} has not passed the accuracy gate for the current model, run calibrate_precision.py first')
+        exit(1)
+
+    if args.stride > 1 and (not args.headless or args.render_video or args.keyframe_interval > 1):
+        print('--stride only works with --headless, without --render-video and --keyframe-interval')
+        exit(1)
+
+    # Create the results directory
+    os.makedirs(args.output_dir or video_analysis_data_dir, exist_ok=True)
+
+    # If specific video provided, call once, otherwise loop through all
+    if len(args.ids) == 2:
+        videos = [f'user_{args.ids[0]}_s{args.ids[1]}.mp4']
+    else:
         # Skip file if it's not .mp4
-        video_split = video.split('.', 1)
-        suffix = video_split[-1]
-        if suffix != 'mp4':
-            continue
-        video_analysis(video)
\ No newline at end of file
+        videos = [video for video in os.listdir(videos_dir) if video.split('.', 1)[-1] == 'mp4']
+
+    workers = min(max(args.workers, 1), len(videos))
+    if workers > 1:
+        threads = args.threads or max((os.cpu_count() or 1) // workers, 1)
+        # The longest videos go first, so no worker is left with a long one at the end
+        videos.sort(key=lambda video: os.path.getsize(os.path.join(videos_dir, video)), reverse=True)
+        errors = analyse_in_parallel(videos, args, workers, threads)
+        if errors:
+            exit(1)
+    else:
+        if args.threads:
+            set_threads(args.threads)
+            cv2.setNumThreads(args.threads)
+        configure(args, workers)
+        load_analysis_model()
+        if len(args.ids) == 2:
+            print(args.ids[0])
+        for video in videos:
+            video_analysis(video)